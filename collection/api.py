@@ -2,8 +2,9 @@ from flask import Flask, request
 from flask_restful import Resource, Api, reqparse, abort
 from OpenSSL import SSL
 from expiringdict import ExpiringDict
-from chalicelib import *
+from chalicelib import ConfigStage, BidPredictor, open_index, eprint, to_epoch, utc
 import dateutil
+import datetime
 from pprint import pformat
 import json
 import itertools
@@ -46,19 +47,21 @@ bid_index_dict = config.items("bid_index", {})
 bid_index = bid_index_dict.pop("name", "spot_bids")
 bid_doc_type = bid_index_dict.pop("doc_type", "bid")
 bid_mappings = json.loads(bid_index_dict.pop("mappings", "{}"))
+bid_artifacts = bid_index_dict.pop("artifacts", "index")
+bid_artifacts = bid_artifacts if bid_artifacts != "none" else None
 
-instances_index = IndexData(elastic_url, instance_index, doc_type=instance_doc_type, connection_options=elastic_dict,
-                            index_settings=instance_index_dict, index_mappings=instance_mappings, alias=True)
+instances_index = open_index(elastic_url, instance_index, doc_type=instance_doc_type, connection_options=elastic_dict,
+                             index_settings=instance_index_dict, index_mappings=instance_mappings, alias=True)
 
-bid_index = IndexData(elastic_url, bid_index, doc_type=bid_doc_type, connection_options=elastic_dict,
-                      index_settings=bid_index_dict, index_mappings=bid_mappings)
+bid_index = open_index(elastic_url, bid_index, doc_type=bid_doc_type, connection_options=elastic_dict,
+                       index_settings=bid_index_dict, index_mappings=bid_mappings)
 
-predictor = BidPredictor(None, bid_index)
+predictor = BidPredictor(None, bid_index, artifacts=bid_artifacts)
 
 # Get Bid endpoint
 class GetBid(Resource):
     @staticmethod
-    def get_bid_cache_key(instance, region, os, timestamp, duration):
+    def get_bid_cache_key(instance, region, os, timestamp, duration, percentile=None):
         """
         pieces together our key format
         :param instance:
@@ -66,12 +69,13 @@ class GetBid(Resource):
         :param os:
         :param timestamp: datetime
         :param duration: int: hours?
+        :param percentile: float: survival percentile (Default: None - trained model)
         :return: string: key
         """
-        epoch_hour = long(to_epoch(timestamp) / bid_cache_ttl)
-        return "{0}.{1}.{2}.{3}.{4}".format(instance, region, os, epoch_hour, duration)
+        epoch_hour = int(to_epoch(timestamp) // bid_cache_ttl)
+        return "{0}.{1}.{2}.{3}.{4}.{5}".format(instance, region, os, epoch_hour, duration, percentile)
 
-    def get_bid_cache(self, instance, region, os, timestamp, duration):
+    def get_bid_cache(self, instance, region, os, timestamp, duration, percentile=None):
         """
         looks for value in cache
         :param instance:
@@ -79,12 +83,13 @@ class GetBid(Resource):
         :param os:
         :param timestamp: datetime
         :param duration: int: hours?
+        :param percentile: float: survival percentile (Default: None - trained model)
         :return: float: bid
         """
-        bid = bid_cache.get(self.get_bid_cache_key(instance, region, os, timestamp, duration))
+        bid = bid_cache.get(self.get_bid_cache_key(instance, region, os, timestamp, duration, percentile))
         return bid if bid is not None else [None, None]
 
-    def put_bid_cache(self, instance, region, os, timestamp, duration, bid):
+    def put_bid_cache(self, instance, region, os, timestamp, duration, bid, percentile=None):
         """
         puts a value on the cache (miss)
         :param instance:
@@ -93,12 +98,13 @@ class GetBid(Resource):
         :param timestamp: datetime
         :param duration: int: hours?
         :param bid:
+        :param percentile: float: survival percentile (Default: None - trained model)
         :return: None
         """
         bid = bid if bid is not None else -1.0
-        bid_cache[self.get_bid_cache_key(instance, region, os, timestamp, duration)] = bid
+        bid_cache[self.get_bid_cache_key(instance, region, os, timestamp, duration, percentile)] = bid
 
-    def get_bid(self, instance, region, os, timestamp, duration):
+    def get_bid(self, instance, region, os, timestamp, duration, percentile=None):
         """
         returns the bid value evaluated for the input parameters
         :param instance:
@@ -106,14 +112,16 @@ class GetBid(Resource):
         :param os:
         :param timestamp: datetime
         :param duration: int: hours?
+        :param percentile: float: survival percentile (Default: None - trained model)
         :return: float: bid
         """
 
-        eprint("Getting bid for params - {}".format([instance, region, os, timestamp.strftime('%Y-%m-%d %H:%M:%S'), duration]))
-        bid = predictor.get_bid(region, instance, os, duration)
+        eprint("Getting bid for params - {}".format([instance, region, os, timestamp.strftime('%Y-%m-%d %H:%M:%S'),
+                                                     duration, percentile]))
+        bid = predictor.get_bid(region, instance, os, duration, percentile)
         eprint("Modeled price: {}".format(bid))
 
-        self.put_bid_cache(instance, region, os, timestamp, duration, bid)
+        self.put_bid_cache(instance, region, os, timestamp, duration, bid, percentile)
         return bid
 
     @staticmethod
@@ -145,7 +153,8 @@ class GetBid(Resource):
             instances = set()
 
         if len(instances) == 0:
-            search_results = instances_index.search_terms(query, numeric_as_min=numeric_as_min)
+            search_results = instances_index.search_terms(query, numeric_as_min=numeric_as_min,
+                                                          source=["InstanceType", "Region"])
             for instance in search_results:
                 instances.add((instance.get("InstanceType"), instance.get("Region")))
             if len(instances) > 0 and cache_key is not None:
@@ -161,7 +170,7 @@ class GetBid(Resource):
         :return: bid response (dict)
         """
 
-        query = byteify(request.get_json(force=True))
+        query = request.get_json(force=True)
         timestamp = query.pop("timestamp", None)
         os = query.pop("os", "Linux/Unix").lower()
 
@@ -171,6 +180,14 @@ class GetBid(Resource):
             timestamp = utc.localize(dateutil.parser.parse(timestamp))
 
         numeric_as_min = query.pop("numeric_as_min", "true").lower()[0] == "t"
+        percentile = query.pop("percentile", None)
+        if percentile is not None:
+            try:
+                percentile = float(percentile)
+            except (TypeError, ValueError):
+                abort(400, reason="ERROR: percentile must be a number")
+            if not 0 < percentile <= 100:
+                abort(400, reason="ERROR: percentile must be between 0 and 100")
 
         instance_matches = self.get_instances(query, numeric_as_min)
 
@@ -183,9 +200,9 @@ class GetBid(Resource):
             instance = instance.lower()
             region = region.lower()
             # Try cache, fallback to model
-            az, bid = self.get_bid_cache(instance, region, os, timestamp, duration)
+            az, bid = self.get_bid_cache(instance, region, os, timestamp, duration, percentile)
             if bid is None:
-                az, bid = self.get_bid(instance, region, os, timestamp, duration)
+                az, bid = self.get_bid(instance, region, os, timestamp, duration, percentile)
             elif bid < 0:
                 bid = None
 
@@ -198,6 +215,10 @@ class GetBid(Resource):
         if out_instance is None:
             abort(404, reason="ERROR: Not Found - no instances can be found matching criteria")
         else:
+            # one line per request (cache hits too) for the key that served it, the training scheduler counts them
+            # for popularity
+            eprint("Bid served - {}".format([out_instance, out_region, os, duration, percentile,
+                                             len(instance_matches)]))
             return {
                 'instance': out_instance,
                 'region': out_region,
@@ -1,10 +1,97 @@
-from chalice import Chalice
+from chalice import Chalice, BadRequestError, NotFoundError
+from chalicelib.ConfigStage import ConfigStage
+from chalicelib.BidSnapshot import BidSnapshot
+import os
+import json
+import time
 
 app = Chalice(app_name='collection')
+app_dir = os.path.dirname(os.path.abspath(__file__))
+config = ConfigStage(os.path.join(app_dir, 'chalicelib', 'collection.ini'))
+
+snapshot_file = os.path.join(app_dir, 'chalicelib', config.get("snapshot", "file", "bid_snapshot.json.gz"))
+# loaded once per container (in the init phase of a cold start) and reused by every request it serves
+snapshot = BidSnapshot.load(snapshot_file) if os.path.isfile(snapshot_file) else None
+snapshot_max_age = float(config.get("snapshot", "max_age", 0))
+fallback = None
+
 
 def get_stage():
     return app.current_request.context['stage']
 
+
+def get_fallback():
+    """
+    Opens the indexes for requests the snapshot can not answer (percentiles, bids missing from a snapshot older than
+    snapshot_max_age), on first use only: the bid model and ES client libraries are not loaded by the other requests
+    :return: pair: (BidPredictor, instance IndexData)
+    """
+    global fallback
+    if fallback is None:
+        from chalicelib import BidPredictor, open_index
+
+        elastic_dict = config.items("elastic", {})
+        elastic_url = elastic_dict.pop("url", "localhost").split(",")
+
+        instance_index_dict = config.items("instance_index", {})
+        instance_index = instance_index_dict.pop("name", "instance_map")
+        instance_doc_type = instance_index_dict.pop("doc_type", "instance")
+        instance_mappings = json.loads(instance_index_dict.pop("mappings", "{}"))
+
+        bid_index_dict = config.items("bid_index", {})
+        bid_index = bid_index_dict.pop("name", "spot_bids")
+        bid_doc_type = bid_index_dict.pop("doc_type", "bid")
+        bid_mappings = json.loads(bid_index_dict.pop("mappings", "{}"))
+        bid_artifacts = bid_index_dict.pop("artifacts", "index")
+        bid_artifacts = bid_artifacts if bid_artifacts != "none" else None
+
+        instances_index = open_index(elastic_url, instance_index, doc_type=instance_doc_type,
+                                     connection_options=elastic_dict, index_settings=instance_index_dict,
+                                     index_mappings=instance_mappings, alias=True)
+        bid_index = open_index(elastic_url, bid_index, doc_type=bid_doc_type, connection_options=elastic_dict,
+                               index_settings=bid_index_dict, index_mappings=bid_mappings)
+        fallback = (BidPredictor(None, bid_index, artifacts=bid_artifacts), instances_index)
+
+    return fallback
+
+
+def get_instances(query, numeric_as_min):
+    """
+    gets a list of instances matching the search criteria (from the snapshot when there is one)
+    :param query: query parsed from post (dict)
+    :param numeric_as_min: should numeric parameters be treated as min values (instead of max)
+    :return: list((instance, region))
+    """
+    if snapshot is not None:
+        return snapshot.search_instances(query, numeric_as_min=numeric_as_min)
+
+    search_results = get_fallback()[1].search_terms(query, numeric_as_min=numeric_as_min,
+                                                    source=["InstanceType", "Region"])
+    return list(set((instance.get("InstanceType"), instance.get("Region")) for instance in search_results))
+
+
+def lookup_bid(instance, region, os_name, duration, percentile=None):
+    """
+    returns the bid for the input parameters (from the snapshot, bids missing from it are only read from ES once the
+    snapshot is older than snapshot_max_age)
+    :param instance:
+    :param region:
+    :param os_name:
+    :param duration: int: days
+    :param percentile: float: survival percentile (Default: None - trained model)
+    :return: Pair [az, bid] - returns [None, -1] if not found
+    """
+    if snapshot is not None and percentile is None:
+        bid = snapshot.get_bid(region, instance, os_name, duration)
+        if bid is not None:
+            return bid
+        # broad searches match many keys without bids, a round trip (and ES client load) each would defeat the snapshot
+        if snapshot_max_age <= 0 or time.time() - snapshot.created < snapshot_max_age:
+            return [None, -1]
+
+    return get_fallback()[0].get_bid(region, instance, os_name, duration, percentile)
+
+
 @app.route('/')
 def index():
     stage = get_stage()
@@ -12,22 +99,55 @@ def index():
             'stage': stage}
 
 
-# The view function above will return {"hello": "world"}
-# whenever you make an HTTP GET request to '/'.
-#
-# Here are a few more examples:
-#
-# @app.route('/hello/{name}')
-# def hello_name(name):
-#    # '/hello/james' -> {"hello": "james"}
-#    return {'hello': name}
-#
-# @app.route('/users', methods=['POST'])
-# def create_user():
-#     # This is the JSON body the user sent in their POST request.
-#     user_as_json = app.current_request.json_body
-#     # We'll echo the json body back to the user in a 'user' key.
-#     return {'user': user_as_json}
-#
-# See the README documentation for more examples.
-#
+@app.route('/get_bid/{duration}', methods=['POST'])
+def get_bid(duration):
+    """
+    Get bid endpoint (as the api.py /get_bid/<duration> resource)
+    :param duration: int: days
+    :return: bid response (dict)
+    """
+    try:
+        duration = int(duration)
+    except ValueError:
+        raise BadRequestError("ERROR: duration must be a whole number of days")
+
+    query = dict(app.current_request.json_body or {})
+    query.pop("timestamp", None)
+    os_name = query.pop("os", "Linux/Unix").lower()
+    numeric_as_min = str(query.pop("numeric_as_min", "true")).lower()[0] == "t"
+    percentile = query.pop("percentile", None)
+    if percentile is not None:
+        try:
+            percentile = float(percentile)
+        except (TypeError, ValueError):
+            raise BadRequestError("ERROR: percentile must be a number")
+        if not 0 < percentile <= 100:
+            raise BadRequestError("ERROR: percentile must be between 0 and 100")
+
+    instance_matches = get_instances(query, numeric_as_min)
+
+    out_instance = None
+    out_region = None
+    out_az = None
+    bid_price = -1.0
+    for instance, region in instance_matches:
+        instance = instance.lower()
+        region = region.lower()
+        az, bid = lookup_bid(instance, region, os_name, duration, percentile)
+        if az is not None and (out_instance is None or bid < bid_price):
+            out_instance = instance
+            out_region = region
+            out_az = az
+            bid_price = bid
+
+    if out_instance is None:
+        raise NotFoundError("ERROR: Not Found - no instances can be found matching criteria")
+
+    return {
+        'instance': out_instance,
+        'region': out_region,
+        'availability_zone': out_az,
+        'os': os_name,
+        'bid_price': bid_price,
+        'matching_instances': len(instance_matches)
+    }
@@ -0,0 +1,102 @@
+from chalicelib import ConfigStage, Backtester, BidPredictor, open_index, eprint, utc
+from optparse import OptionParser
+import datetime
+import dateutil.parser
+import ijson
+import json
+import time
+
+
+config = ConfigStage('chalicelib/collection.ini')
+
+elastic_dict = config.items("elastic", {})
+elastic_url = elastic_dict.pop("url", "localhost")
+
+index_dict = config.items("history_index", {})
+index = index_dict.pop("name", "spot_price_history")
+doc_type = index_dict.pop("doc_type", "price")
+mappings = json.loads(index_dict.pop("mappings", "{}"))
+rollover = index_dict.pop("rollover", None)
+
+quantile = float(config.get("predict", "quantile", 0.95))
+
+opt_parser = OptionParser(usage="usage: %prog [options]\n\n"
+                                "Walk-forward backtest of the bid models on the price history (or a collection.py "
+                                "file export): accuracy, cost and training time per model")
+opt_parser.add_option("--elasticurl", "-e", action="store", type="string", dest="elastic_url", default=elastic_url,
+                      help="URL for the elasticsearch server (Default: {})".format(elastic_url))
+opt_parser.add_option("--file", "-f", action="store", type="string", dest="filename", default=None,
+                      help="Read the history from a collection.py file export instead of the index")
+opt_parser.add_option("--instances", "-i", action="store", type="string", dest="instances", default=None,
+                      help="Comma separated instance types (Default: all)")
+opt_parser.add_option("--region", "-r", action="store", type="string", dest="region", default=None,
+                      help="Region (Default: all)")
+opt_parser.add_option("--days", "-d", action="store", type="int", dest="history_days", default=0,
+                      help="Days of history to replay, 0 for all (Default: 0)")
+opt_parser.add_option("--models", "-m", action="store", type="string", dest="models",
+                      default=",".join(BidPredictor.get_model_names()),
+                      help="Comma separated models (Default: {})".format(",".join(BidPredictor.get_model_names())))
+opt_parser.add_option("--train-days", "-t", action="store", type="int", dest="train_days", default=90,
+                      help="Days of history before the first cutoff (Default: 90)")
+opt_parser.add_option("--step-days", "-s", action="store", type="int", dest="step_days", default=7,
+                      help="Days between cutoffs (Default: 7)")
+opt_parser.add_option("--quantile", "-q", action="store", type="float", dest="quantile", default=quantile,
+                      help="Quantile for the quantile model (Default: {})".format(quantile))
+opt_parser.add_option("--processes", "-p", action="store", type="int", dest="processes", default=None,
+                      help="Worker processes (Default: one per CPU)")
+opt_parser.add_option("--output", "-o", action="store", type="string", dest="output", default=None,
+                      help="Write the results to this JSON file")
+
+
+
+def read_export(filename, terms, since):
+    """
+    Reads price history from a collection.py file export
+    :param filename: export file (JSON list of history documents)
+    :param terms: dict of field to value (or list of values) to keep
+    :param since: datetime of the oldest history to keep (None - all)
+    :return: generator of history documents
+    """
+    with open(filename, 'rb') as export:
+        for h in ijson.items(export, 'item'):
+            if since is not None and utc.localize(dateutil.parser.parse(h.get("Timestamp"))) < since:
+                continue
+            if all(h.get(term) in (value if type(value) is list else [value]) for term, value in terms.items()):
+                yield h
+
+
+(options, args) = opt_parser.parse_args()
+since = None
+if options.history_days:
+    since = utc.localize(datetime.datetime.now()) - datetime.timedelta(days=options.history_days)
+
+terms = {}
+if options.instances is not None:
+    terms["InstanceType"] = [instance.strip() for instance in options.instances.split(',')]
+if options.region is not None:
+    terms["Region"] = options.region
+
+if options.filename is not None:
+    history = read_export(options.filename, terms, since)
+else:
+    history_index = open_index(options.elastic_url.split(','), index, doc_type=doc_type,
+                               connection_options=elastic_dict, index_settings=index_dict, index_mappings=mappings,
+                               rollover=rollover)
+    history = history_index.search_terms(terms, since=since, page_size=0,
+                                         source=BidPredictor.history_fields + ["InstanceType"])
+
+started = time.time()
+backtester = Backtester(models=options.models.split(','), train_days=options.train_days, step_days=options.step_days,
+                        quantile=options.quantile, processes=options.processes)
+results = backtester.run(history)
+eprint("Backtest complete in {:.1f}s".format(time.time() - started))
+
+for model in sorted(results):
+    metrics = results[model]
+    eprint("{:<10} accuracy {:.3f}  mean bid {:.4f}  cost/day {:.4f}  uptime {:.3f}  training {:.2f}s/{}  "
+           "confidence {}".format(model, metrics["accuracy"], metrics["mean_bid"], metrics["cost_per_day"],
+                                  metrics["uptime"], metrics["seconds"], metrics["trainings"], metrics["confidence"]))
+
+if options.output is not None:
+    with open(options.output, 'w') as outfile:
+        json.dump(results, outfile, indent=4, sort_keys=True)
@@ -0,0 +1,111 @@
+from chalicelib import ConfigStage, FastJSONSerializer, open_index, eprint
+from optparse import OptionParser
+import itertools
+import random
+import json
+import time
+
+
+config = ConfigStage('chalicelib/collection.ini')
+
+elastic_dict = config.items("elastic", {})
+elastic_url = elastic_dict.pop("url", "localhost")
+elastic_dict.pop("serializer", None)
+
+index_dict = config.items("history_index", {})
+index = index_dict.pop("name", "spot_price_history")
+doc_type = index_dict.pop("doc_type", "price")
+mappings = json.loads(index_dict.pop("mappings", "{}"))
+rollover = index_dict.pop("rollover", None)
+
+opt_parser = OptionParser(usage="usage: %prog [options]\n\n"
+                                "Measures history scan decode throughput for each JSON serializer, on generated scroll "
+                                "pages (Default) or a live scan of the history index (--live)")
+opt_parser.add_option("--elasticurl", "-e", action="store", type="string", dest="elastic_url", default=elastic_url,
+                      help="URL for the elasticsearch server (Default: {})".format(elastic_url))
+opt_parser.add_option("--live", "-l", action="store_true", dest="live", default=False,
+                      help="Scan the history index instead of generated pages")
+opt_parser.add_option("--rows", "-n", action="store", type="int", dest="rows", default=200000,
+                      help="Documents to decode per serializer (Default: 200000)")
+opt_parser.add_option("--page", "-p", action="store", type="int", dest="page", default=1000,
+                      help="Documents per scroll page (Default: 1000)")
+
+(options, args) = opt_parser.parse_args()
+
+
+def copy_document(i):
+    """
+    Deep copies a decoded document the way the old byteify read pass did (baseline for comparison)
+    :param i: object
+    :return: object
+    """
+    if isinstance(i, dict):
+        return {copy_document(key): copy_document(value) for key, value in i.items()}
+    elif isinstance(i, list):
+        return [copy_document(element) for element in i]
+    else:
+        return i
+
+
+def build_page(size):
+    """
+    Builds a scroll response page of history documents (as collection.py writes them)
+    :param size: documents in the page
+    :return: string: JSON response body
+    """
+    hits = []
+    for i in range(size):
+        hits.append({
+            "_index": index, "_type": doc_type, "_id": str(i), "_score": None,
+            "_source": {
+                "Timestamp": "2018-05-{:02d}T{:02d}:{:02d}:00+0000".format(i % 28 + 1, i % 24, i % 60),
+                "SpotPrice": "{:.6f}".format(random.random()),
+                "AvailabilityZone": "us-east-1{}".format("abcdef"[i % 6]),
+                "InstanceType": random.choice(["m4.large", "c5.xlarge", "r4.2xlarge", "t2.micro"]),
+                "ProductDescription": random.choice(["Linux/UNIX", "Windows", "SUSE Linux"]),
+                "Region": "us-east-1",
+                "Attributes": {"vcpu": "2", "memory": "8 GiB", "storage": "EBS only", "ecu": "6.5",
+                               "networkPerformance": "Moderate", "processorArchitecture": "64-bit",
+                               "clockSpeed": "2.4 GHz", "instanceFamily": "General purpose",
+                               "physicalProcessor": "Intel Xeon E5-2676 v3 (Haswell)", "memorySize": 8.0}
+            }
+        })
+
+    return json.dumps({"_scroll_id": "x" * 120, "took": 10, "timed_out": False,
+                       "hits": {"total": size * 100, "max_score": None, "hits": hits}})
+
+
+def report(name, rows, size, elapsed):
+    eprint("{:<24} {:>9} docs  {:>8.3f}s  {:>10.0f} docs/s  {:>7.1f} MB/s".format(
+        name, rows, elapsed, rows / elapsed, size / elapsed / 1048576 if size else 0))
+
+
+if options.live:
+    elastic_url = options.elastic_url.split(',')
+    for backend in FastJSONSerializer.backends:
+        connection_options = dict(elastic_dict, serializer=backend)
+        history_index = open_index(elastic_url, index, doc_type=doc_type, connection_options=connection_options,
+                                   index_settings=index_dict, index_mappings=mappings, rollover=rollover)
+        start = time.time()
+        rows = sum(1 for _ in itertools.islice(history_index.scan(), options.rows))
+        report(backend, rows, 0, time.time() - start)
+else:
+    page = build_page(options.page)
+    pages = max(options.rows // options.page, 1)
+    rows = pages * options.page
+    size = len(page) * pages
+
+    serializer = FastJSONSerializer("json")
+    start = time.time()
+    for _ in range(pages):
+        [copy_document(hit.get("_source")) for hit in serializer.loads(page).get("hits").get("hits")]
+    report("json + byteify copy", rows, size, time.time() - start)
+
+    for backend in FastJSONSerializer.backends:
+        serializer = FastJSONSerializer(backend)
+        if serializer.backend != backend:
+            continue
+        start = time.time()
+        for _ in range(pages):
+            [hit.get("_source") for hit in serializer.loads(page).get("hits").get("hits")]
+        report(backend, rows, size, time.time() - start)
@@ -0,0 +1,99 @@
+from optparse import OptionParser
+import subprocess
+import random
+import json
+import time
+import sys
+
+opt_parser = OptionParser(usage="usage: %prog [options]\n\n"
+                                "Measures the Chalice app's cold start (a fresh interpreter importing the app and "
+                                "serving one /get_bid request) and warm request latency, from the packaged snapshot")
+opt_parser.add_option("--cold", "-c", action="store", type="int", dest="cold", default=10,
+                      help="Cold starts to measure (Default: 10)")
+opt_parser.add_option("--requests", "-n", action="store", type="int", dest="requests", default=2000,
+                      help="Warm requests to measure (Default: 2000)")
+opt_parser.add_option("--duration", "-d", action="store", type="int", dest="duration", default=7,
+                      help="Bid duration requested (Default: 7)")
+(options, args) = opt_parser.parse_args()
+
+# modules the app should not need to load to answer from the snapshot
+heavy_modules = ["numpy", "pandas", "scipy", "sklearn", "elasticsearch", "boto3", "bs4", "requests"]
+
+cold_start = """
+import time
+started = time.perf_counter()
+import sys
+import json
+import types
+import app
+imported = time.perf_counter()
+instance = sorted(app.snapshot.bids)[0].split("~")[1]
+app.app.current_request = types.SimpleNamespace(json_body={{"InstanceType": instance}}, context={{"stage": "benchmark"}})
+app.get_bid({duration})
+served = time.perf_counter()
+print(json.dumps({{"import": imported - started, "first": served - imported,
+                  "heavy": [module for module in {heavy} if module in sys.modules]}}))
+"""
+
+
+def percentile(values, share):
+    """
+    Gets a percentile of a list of measurements
+    :param values: list of numbers
+    :param share: percentile (0-1)
+    :return: value
+    """
+    values = sorted(values)
+    return values[min(int(len(values) * share), len(values) - 1)]
+
+
+def report(name, seconds):
+    """
+    Prints the median and tail of a list of measurements
+    :param name: measurement name
+    :param seconds: list of seconds
+    :return: None
+    """
+    print("{:<14} p50 {:8.3f} ms  p90 {:8.3f} ms  max {:8.3f} ms".format(
+        name, percentile(seconds, 0.5) * 1000, percentile(seconds, 0.9) * 1000, max(seconds) * 1000))
+
+
+if options.cold > 0:
+    imports, firsts, totals = [], [], []
+    heavy = set()
+    for run in range(options.cold):
+        started = time.perf_counter()
+        output = subprocess.check_output([sys.executable, "-c", cold_start.format(duration=options.duration,
+                                                                                  heavy=heavy_modules)])
+        totals.append(time.perf_counter() - started)
+        result = json.loads(output.decode("utf-8").strip().splitlines()[-1])
+        imports.append(result["import"])
+        firsts.append(result["first"])
+        heavy.update(result["heavy"])
+
+    print("Cold start ({} runs)".format(options.cold))
+    report("import app", imports)
+    report("first request", firsts)
+    report("process", totals)
+    print("heavy modules loaded: {}".format(sorted(heavy) if len(heavy) > 0 else "none"))
+
+if options.requests > 0:
+    import types
+    import app
+
+    if app.snapshot is None:
+        print("No bid snapshot at {} (build one with snapshot.py)".format(app.snapshot_file))
+        exit(1)
+
+    instances = sorted(set(key.split("~")[1] for key in app.snapshot.bids))
+    latencies = []
+    for i in range(options.requests):
+        app.app.current_request = types.SimpleNamespace(json_body={"InstanceType": random.choice(instances)},
+                                                        context={"stage": "benchmark"})
+        started = time.perf_counter()
+        app.get_bid(options.duration)
+        latencies.append(time.perf_counter() - started)
+
+    print("Warm requests ({} requests over {} bids, {} instances)".format(
+        options.requests, len(app.snapshot.bids), len(app.snapshot.instances)))
+    report("get_bid", latencies)
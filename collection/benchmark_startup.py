@@ -0,0 +1,98 @@
+from optparse import OptionParser
+import subprocess
+import json
+import ast
+import sys
+
+entry_points = ["app.py", "api.py", "collection.py", "delete.py", "predict.py", "rollup.py", "snapshot.py",
+                "backtest.py", "migrate_bids.py"]
+
+opt_parser = OptionParser(usage="usage: %prog [options] [entry point scripts]\n\n"
+                                "Measures the startup of each entry point (Default: {}): a fresh interpreter runs "
+                                "the script's top level imports and reports the import time, peak RSS and the heavy "
+                                "modules loaded. Exits non zero when a limit is exceeded".format(", ".join(entry_points)))
+opt_parser.add_option("--runs", "-r", action="store", type="int", dest="runs", default=5,
+                      help="Runs per entry point, the median is reported (Default: 5)")
+opt_parser.add_option("--max-seconds", "-t", action="store", type="float", dest="max_seconds", default=None,
+                      help="Import time limit in seconds (Default: None)")
+opt_parser.add_option("--max-rss", "-m", action="store", type="float", dest="max_rss", default=None,
+                      help="Peak RSS limit in MB (Default: None)")
+(options, args) = opt_parser.parse_args()
+if len(args) > 0:
+    entry_points = args
+
+# modules only some entry points should need
+heavy_modules = ["numpy", "pandas", "scipy", "sklearn", "elasticsearch", "boto3", "bs4", "requests", "lxml"]
+
+startup = """
+import time
+started = time.perf_counter()
+{imports}
+imported = time.perf_counter()
+import json
+import resource
+import sys
+print(json.dumps({{"import": imported - started, "rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+                  "heavy": [module for module in {heavy} if module in sys.modules]}}))
+"""
+
+
+def get_imports(script):
+    """
+    Gets the top level import statements of a script (running only those measures its startup without its side effects
+    e.g. connecting to ES)
+    :param script: script file name
+    :return: string: import statements
+    """
+    with open(script, 'r') as source:
+        code = source.read()
+    # imports guarded by try (e.g. python 2 fallbacks) are kept
+    return "\n".join(ast.get_source_segment(code, node) for node in ast.parse(code).body
+                     if all(isinstance(n, (ast.Import, ast.ImportFrom, ast.Try))
+                            for n in ast.walk(node) if isinstance(n, ast.stmt)))
+
+
+def measure(imports):
+    """
+    Runs the imports in a fresh interpreter
+    :param imports: string: import statements
+    :return: dict: import (seconds), rss (MB), heavy (list of modules) - None if the imports failed
+    """
+    process = subprocess.run([sys.executable, "-c", startup.format(imports=imports, heavy=heavy_modules)],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if process.returncode != 0:
+        error = process.stderr.decode("utf-8").strip().splitlines()
+        raise ImportError(error[-1] if len(error) > 0 else "exit code {}".format(process.returncode))
+    return json.loads(process.stdout.decode("utf-8").strip().splitlines()[-1])
+
+
+def median(values):
+    """
+    Gets the median of a list of measurements
+    :param values: list of numbers
+    :return: value
+    """
+    return sorted(values)[len(values) // 2]
+
+
+print("{:<18} {:>10} {:>10}  {}".format("entry point", "import ms", "RSS MB", "heavy modules"))
+exceeded = []
+for name in ["(python)"] + entry_points:
+    try:
+        imports = get_imports(name) if name != "(python)" else "pass"
+        results = [measure(imports) for run in range(options.runs)]
+    except (IOError, SyntaxError, ImportError) as e:
+        print("{:<18} failed: {}".format(name, e))
+        continue
+
+    seconds = median([result["import"] for result in results])
+    rss = median([result["rss"] for result in results])
+    print("{:<18} {:>10.1f} {:>10.1f}  {}".format(name, seconds * 1000, rss, ", ".join(results[0]["heavy"]) or "-"))
+    if options.max_seconds is not None and seconds > options.max_seconds:
+        exceeded.append("{} import time {:.3f}s > {}s".format(name, seconds, options.max_seconds))
+    if options.max_rss is not None and rss > options.max_rss:
+        exceeded.append("{} RSS {:.1f}MB > {}MB".format(name, rss, options.max_rss))
+
+if len(exceeded) > 0:
+    print("Limits exceeded:\n  " + "\n  ".join(exceeded))
+    exit(1)
@@ -0,0 +1,202 @@
+import numpy as np
+import multiprocessing
+import time
+from .BidPredictor import BidPredictor
+from .BidArtifact import BidArtifact
+from .common import eprint
+
+
+class Backtester:
+    """
+    Walk-forward evaluation of the registered bid models on historical prices
+
+    For every (region, instance, os) each model is trained on the history before a series of cutoff days, and its bids
+    are replayed against the daily maximum prices that followed: a bid survives a duration if no day in it had a higher
+    price. Keys are evaluated in parallel processes, results are totalled per model.
+    """
+    __totals = ["bids", "survived", "bid_sum", "days_run", "cost", "seconds", "trainings", "confidence", "scores"]
+
+    def __init__(self, models=None, n_days=30, train_days=90, step_days=7, quantile=0.95, processes=None):
+        """
+        Constructor
+        :param models: names of the registered models to evaluate (Default: None - all)
+        :param n_days: number of durations (days) to bid for (Default: 30)
+        :param train_days: days of history before the first cutoff (Default: 90)
+        :param step_days: days between cutoffs (Default: 7)
+        :param quantile: quantile for the quantile model (Default: 0.95)
+        :param processes: worker processes (Default: None - one per CPU)
+        """
+        self.models = models if models is not None else BidPredictor.get_model_names()
+        [BidPredictor.get_model(model) for model in self.models]
+        self.n_days = n_days
+        self.train_days = train_days
+        self.step_days = step_days
+        self.quantile = quantile
+        self.processes = processes
+
+    @staticmethod
+    def group(history):
+        """
+        Groups price history by bid key
+        :param history: iterable of price history documents (BidPredictor.history_fields and InstanceType)
+        :return: dict of (region, instance, os) to dict of AZ to list of training rows
+        """
+        keys = {}
+        for h in history:
+            row = BidPredictor.get_training_row(h)
+            key = (row.pop("Region"), h.get("InstanceType").lower(), row.pop("OS"))
+            keys.setdefault(key, {}).setdefault(row.pop("AvailabilityZone"), []).append(row)
+
+        return keys
+
+    def run(self, history):
+        """
+        Backtests every model on the price history
+        :param history: iterable of price history documents (BidPredictor.history_fields and InstanceType)
+        :return: dict of model name to metrics (see summarize)
+        """
+        keys = self.group(history)
+        eprint("Backtesting {} keys with {}".format(len(keys), self.models))
+
+        totals = dict((model, self.empty_totals()) for model in self.models)
+        pool = multiprocessing.Pool(self.processes)
+        try:
+            for result in pool.imap_unordered(self.evaluate_key, keys.items()):
+                for model in result:
+                    totals[model] = self.merge(totals[model], result[model])
+        finally:
+            pool.close()
+            pool.join()
+
+        return dict((model, self.summarize(totals[model])) for model in totals)
+
+    def empty_totals(self):
+        """Returns zeroed totals for a model (per_duration holds the bids and the survived bids per duration)"""
+        totals = dict((name, 0.0) for name in self.__totals)
+        totals["per_duration"] = np.zeros((2, self.n_days))
+        return totals
+
+    @staticmethod
+    def merge(totals, other):
+        """
+        Adds two sets of totals
+        :param totals: totals (see empty_totals)
+        :param other: totals
+        :return: merged totals
+        """
+        return dict((name, totals[name] + other[name]) for name in totals)
+
+    @staticmethod
+    def summarize(totals):
+        """
+        Converts totals to metrics
+        :param totals: totals (see empty_totals)
+        :return: dict: accuracy (share of bids that survived their duration), accuracy_by_duration, mean_bid,
+            cost_per_day (mean daily maximum price over the days run), uptime (share of the bid days run),
+            seconds (training time), trainings and confidence (mean model confidence, None if the model has none)
+        """
+        bids = max(totals["bids"], 1)
+        per_duration = totals["per_duration"]
+        bid_days = float((per_duration[0] * np.arange(1, per_duration.shape[1] + 1)).sum())
+        return {
+            "accuracy": totals["survived"] / bids,
+            "accuracy_by_duration": (per_duration[1] / np.maximum(per_duration[0], 1)).round(4).tolist(),
+            "mean_bid": totals["bid_sum"] / bids,
+            "cost_per_day": totals["cost"] / max(totals["days_run"], 1),
+            "uptime": totals["days_run"] / max(bid_days, 1),
+            "seconds": totals["seconds"],
+            "trainings": int(totals["trainings"]),
+            "confidence": totals["confidence"] / totals["scores"] if totals["scores"] > 0 else None
+        }
+
+    def evaluate_key(self, item):
+        """
+        Backtests every model on one key (runs in a worker process)
+        :param item: pair: (key, dict of AZ to list of training rows)
+        :return: dict of model name to totals
+        """
+        data = item[1]
+        azs = {}
+        for az in data:
+            dates = np.array([row.get("Date") for row in data[az]], dtype='datetime64[D]')
+            order = np.argsort(dates, kind='mergesort')
+            rows = [data[az][i] for i in order]
+            dates = dates[order]
+            prices = np.array([row.get("Price") for row in rows], dtype=float)
+            azs[az] = (rows, dates, BidArtifact.get_daily_max(dates, prices))
+
+        first = min(dates[0] for (rows, dates, daily) in azs.values())
+        last = max(dates[-1] for (rows, dates, daily) in azs.values())
+        cutoffs = np.arange(first + np.timedelta64(self.train_days, 'D'), last - np.timedelta64(self.n_days - 1, 'D'),
+                            np.timedelta64(self.step_days, 'D'))
+
+        result = dict((model, self.empty_totals()) for model in self.models)
+        for cutoff in cutoffs:
+            training = dict((az, azs[az][0][:np.searchsorted(azs[az][1], cutoff)]) for az in azs)
+            training = dict((az, rows) for az, rows in training.items() if len(rows) > 0)
+            # prices for the days after the cutoff, NaN past the end of an AZs history
+            futures = {}
+            for az, (rows, dates, daily) in azs.items():
+                start = int((cutoff - dates[0]).astype(int))
+                future = np.full(self.n_days, np.nan)
+                if 0 <= start < len(daily):
+                    window = daily[start:start + self.n_days]
+                    future[:len(window)] = window
+                futures[az] = future
+
+            for model in self.models:
+                scores = []
+                started = time.time()
+                estimates = BidPredictor.get_estimates(BidPredictor.get_model(model), training, self.n_days,
+                                                       quantile=self.quantile, scores=scores)
+                totals = result[model]
+                totals["seconds"] += time.time() - started
+                totals["trainings"] += 1
+                scores = np.array(scores, dtype=float)
+                totals["confidence"] += float(np.nansum(scores))
+                totals["scores"] += int(np.isfinite(scores).sum())
+                if len(estimates) > 0:
+                    self.score_bid(BidPredictor.build_bid(estimates, self.n_days), futures, totals)
+
+        return result
+
+    def score_bid(self, bid, futures, totals):
+        """
+        Replays a bid document against the prices that followed it and adds the outcome to the totals
+        :param bid: bid document (see BidPredictor.build_bid)
+        :param futures: dict of AZ to array of daily maximum prices after the cutoff (NaN - unknown)
+        :param totals: totals to add to (see empty_totals)
+        :return: None
+        """
+        bid_az = np.array(bid.get("bid_az"))
+        bid_price = np.array(bid.get("bid_price"))
+        durations = np.arange(1, self.n_days + 1)
+        for position, az in enumerate(bid.get("azs")):
+            chosen = (bid_az == position) & (bid_price < BidArtifact.no_bid)
+            if not chosen.any():
+                continue
+
+            future = futures[az]
+            prices = bid_price[chosen]
+            lengths = durations[chosen]
+            # only durations the history covers completely can be scored
+            complete = np.cumprod(np.isfinite(future))[lengths - 1] > 0
+            prices = prices[complete]
+            lengths = lengths[complete]
+            if len(lengths) == 0:
+                continue
+
+            # days (durations x days) the price was above the bid, within each duration
+            in_duration = np.arange(self.n_days)[None, :] < lengths[:, None]
+            exceeded = (np.nan_to_num(future)[None, :] > prices[:, None]) & in_duration
+            interrupted = exceeded.any(axis=1)
+            days_run = np.where(interrupted, exceeded.argmax(axis=1), lengths)
+            paid = np.r_[0, np.cumsum(np.nan_to_num(future))]
+
+            totals["bids"] += len(lengths)
+            totals["survived"] += int((~interrupted).sum())
+            totals["bid_sum"] += float(prices.sum())
+            totals["days_run"] += float(days_run.sum())
+            totals["cost"] += float(paid[days_run].sum())
+            np.add.at(totals["per_duration"][0], lengths - 1, 1)
+            np.add.at(totals["per_duration"][1], lengths - 1, (~interrupted).astype(float))
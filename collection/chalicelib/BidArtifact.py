@@ -0,0 +1,230 @@
+import numpy as np
+import base64
+import io
+from collections import OrderedDict
+
+
+class BidArtifact:
+    """
+    Packed model parameters for one (region, instance, os), one set per AZ, for computing bids at request time
+
+    For every AZ it keeps the recent daily maximum prices (rolling maximum quantiles for any duration or percentile) and
+    the linear model parameters per duration (price scaling, slope and intercept, and the recent prices they apply to).
+    Bid tables are computed on first use and cached, so a lookup is an index into a small array.
+    """
+    history_days = 365
+    no_bid = 999
+    # requested percentiles are rounded to this many decimals, and this many bid tables are cached per artifact
+    percentile_decimals = 1
+    max_tables = 16
+
+    def __init__(self, azs, daily_max, linear, scale, recent, model="linear", quantile=0.95):
+        """
+        Constructor
+        :param azs: list of AZ names
+        :param daily_max: list (per AZ) of daily maximum price arrays (oldest first)
+        :param linear: list (per AZ) of (n_days x 2) arrays of slope and intercept per duration (NaN - no fit)
+        :param scale: list (per AZ) of (mean, standard deviation) of the prices the linear model was fit on
+        :param recent: list (per AZ) of the most recent prices (oldest first)
+        :param model: model the bids were trained with, used when no percentile is requested (Default: linear)
+        :param quantile: quantile the bids were trained with (Default: 0.95)
+        """
+        self.azs = list(azs)
+        self.daily_max = daily_max
+        self.linear = linear
+        self.scale = scale
+        self.recent = recent
+        self.model = model
+        self.quantile = quantile
+        self.__tables = OrderedDict()
+
+    @classmethod
+    def from_history(cls, data, n_days, model="linear", quantile=0.95):
+        """
+        Builds an artifact from training data
+        :param data: dict of AZ to list of rows (dictionaries), fields: Date, Price
+        :param n_days: number of durations (days) the linear model is fit for
+        :param model: model the bids were trained with (Default: linear)
+        :param quantile: quantile the bids were trained with (Default: 0.95)
+        :return: BidArtifact (None if there is no data)
+        """
+        azs, daily_max, linear, scale, recent = [], [], [], [], []
+        for az in sorted(data):
+            if len(data[az]) == 0:
+                continue
+
+            dates = np.array([row.get("Date") for row in data[az]], dtype='datetime64[D]')
+            prices = np.array([row.get("Price") for row in data[az]], dtype=float)
+            order = np.argsort(dates, kind='mergesort')
+            dates = dates[order]
+            prices = prices[order]
+
+            azs.append(az)
+            daily_max.append(cls.get_daily_max(dates, prices)[-cls.history_days:].astype(np.float32))
+            az_linear, az_scale = cls.fit_linear(prices, n_days)
+            linear.append(az_linear)
+            scale.append(az_scale)
+            recent.append(prices[-n_days:])
+
+        if len(azs) == 0:
+            return None
+        return cls(azs, daily_max, linear, scale, recent, model=model, quantile=quantile)
+
+    @staticmethod
+    def get_daily_max(dates, prices):
+        """
+        Gets the maximum price per day, days without a price change keep the last price seen
+        :param dates: datetime64[D] array, sorted
+        :param prices: price array in the same order
+        :return: array of daily maximum prices (one per day from the first date to the last)
+        """
+        days = (dates - dates[0]).astype(int)
+        last = np.r_[days[1:] != days[:-1], True]
+        daily = np.full(days[-1] + 1, np.nan)
+        daily[days[last]] = np.maximum.reduceat(prices, np.flatnonzero(np.r_[True, last[:-1]]))
+        filled = np.where(np.isnan(daily), 0, np.arange(len(daily)))
+        return daily[np.maximum.accumulate(filled)]
+
+    @classmethod
+    def get_window_quantiles(cls, daily, n_days, quantile):
+        """
+        Gets, for each duration, the quantile of the maximum price over every window of that many days
+        :param daily: array of daily maximum prices
+        :param n_days: number of durations (days)
+        :param quantile: share of windows (0-1)
+        :return: array of prices, one per duration (no_bid where the history is shorter than the duration)
+        """
+        estimates = np.full(n_days, float(cls.no_bid))
+        window_max = daily
+        for duration in range(1, min(n_days, len(daily) - 1) + 1):
+            if duration > 1:
+                window_max = np.maximum(window_max[:-1], daily[duration - 1:])
+            estimates[duration - 1] = np.ceil(np.percentile(window_max, quantile * 100) * 1000) / 1000
+
+        return estimates
+
+    @staticmethod
+    def fit_linear(prices, n_days):
+        """
+        Fits the price against the price a duration later for every duration (the linear model of BidPredictor.predict)
+        :param prices: price array (oldest first)
+        :param n_days: number of durations (days)
+        :return: pair: ((n_days x 2) array of slope and intercept, (mean, standard deviation))
+        """
+        mean = prices.mean()
+        std = prices.std()
+        std = std if std > 0 else 1.0
+        x_all = (prices - mean) / std
+
+        linear = np.full((n_days, 2), np.nan)
+        for days in range(1, min(n_days, len(prices) - 1) + 1):
+            x = x_all[:-days]
+            y = prices[days:]
+            x_var = ((x - x.mean()) ** 2).sum()
+            slope = ((x - x.mean()) * (y - y.mean())).sum() / x_var if x_var > 0 else 0.0
+            linear[days - 1] = (slope, y.mean() - slope * x.mean())
+
+        return linear, np.array([mean, std])
+
+    def get_linear_estimates(self, i):
+        """
+        Gets the linear model price per duration for an AZ (geometric mean of the forecasts from the recent prices)
+        :param i: AZ position
+        :return: array of prices, one per duration (no_bid where the model could not be fit)
+        """
+        n_days = len(self.linear[i])
+        estimates = np.full(n_days, float(self.no_bid))
+        x = (self.recent[i] - self.scale[i][0]) / self.scale[i][1]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            for days in range(1, n_days + 1):
+                slope, intercept = self.linear[i][days - 1]
+                forecast = slope * x[-days:] + intercept
+                price = np.exp(np.log(forecast).mean())
+                if not np.isnan(price):
+                    estimates[days - 1] = np.ceil(price * 1000) / 1000
+
+        return estimates
+
+    def get_table(self, percentile=None):
+        """
+        Gets the bid table (AZ x duration) for a percentile, bids for a duration have to last every shorter duration
+        :param percentile: survival percentile (0-100), rounded to percentile_decimals (Default: None - the model the
+            bids were trained with)
+        :return: 2d array of prices
+        """
+        if percentile is None and self.model == "quantile":
+            percentile = self.quantile * 100
+        if percentile is not None:
+            percentile = round(float(percentile), self.percentile_decimals)
+
+        table = self.__tables.get(percentile)
+        if table is not None:
+            self.__tables.move_to_end(percentile)
+        else:
+            if percentile is None:
+                table = np.array([self.get_linear_estimates(i) for i in range(len(self.azs))])
+            else:
+                n_days = max(len(self.linear[0]), max(len(daily) for daily in self.daily_max))
+                table = np.array([self.get_window_quantiles(daily.astype(float), n_days, percentile / 100.0)
+                                  for daily in self.daily_max])
+            table = np.maximum.accumulate(table, axis=1)
+            self.__tables[percentile] = table
+            # percentiles come from API clients, keep only the recently used tables
+            if len(self.__tables) > self.max_tables:
+                self.__tables.popitem(last=False)
+
+        return table
+
+    def compute_bid(self, duration, percentile=None):
+        """
+        Computes the bid for a duration
+        :param duration: days the bid should last (longer than the model covers uses its longest duration)
+        :param percentile: survival percentile (0-100) (Default: None - the model the bids were trained with)
+        :return: Pair [az, bid] - returns [None, -1] if no AZ has enough data
+        """
+        table = self.get_table(percentile)
+        duration = min(max(int(duration), 1), table.shape[1])
+        column = table[:, duration - 1]
+        i = int(column.argmin())
+        if column[i] >= self.no_bid:
+            return [None, -1]
+        return [self.azs[i], float(column[i])]
+
+    def pack(self):
+        """
+        Packs the artifact into a compressed npz
+        :return: bytes
+        """
+        arrays = {"azs": np.array(self.azs), "model": np.array(self.model), "quantile": np.array(self.quantile)}
+        for i in range(len(self.azs)):
+            arrays["daily_max_{}".format(i)] = self.daily_max[i]
+            arrays["linear_{}".format(i)] = self.linear[i]
+            arrays["scale_{}".format(i)] = self.scale[i]
+            arrays["recent_{}".format(i)] = self.recent[i]
+
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, **arrays)
+        return buffer.getvalue()
+
+    @classmethod
+    def unpack(cls, packed):
+        """
+        Loads a packed artifact
+        :param packed: bytes from pack
+        :return: BidArtifact
+        """
+        with np.load(io.BytesIO(packed), allow_pickle=False) as arrays:
+            azs = [str(az) for az in arrays["azs"]]
+            n = range(len(azs))
+            return cls(azs, [arrays["daily_max_{}".format(i)] for i in n], [arrays["linear_{}".format(i)] for i in n],
+                       [arrays["scale_{}".format(i)] for i in n], [arrays["recent_{}".format(i)] for i in n],
+                       model=str(arrays["model"]), quantile=float(arrays["quantile"]))
+
+    def encode(self):
+        """Packs the artifact for an ES binary field (base64)"""
+        return base64.b64encode(self.pack()).decode("ascii")
+
+    @classmethod
+    def decode(cls, encoded):
+        """Loads an artifact from an ES binary field (base64)"""
+        return cls.unpack(base64.b64decode(encoded))
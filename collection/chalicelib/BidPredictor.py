@@ -1,21 +1,78 @@
-import pandas as pd
-import pandas
 import numpy as np
-from scipy import stats
 from math import ceil, isnan
-
-from sklearn.linear_model import LinearRegression
-from sklearn import preprocessing, cross_validation
 from threading import Thread
-from common import eprint
+from .BidArtifact import BidArtifact
+from .DailyRollup import DailyRollup
+from .Instrumentation import Instrumentation
+from .common import eprint, utc
+import datetime
 import dateutil
+import time
+# "os" is the bid OS throughout this module
+from os import rename
+from os.path import join, exists
 
 
 class BidPredictor:
-    def __init__(self, history_index, bid_index, n_days = 30):
+    history_fields = ["Region", "Timestamp", "ProductDescription", "SpotPrice", "AvailabilityZone"]
+    __models = {}
+
+    def __init__(self, history_index, bid_index, n_days = 30, history_days=None, scan_slices=None, model="linear",
+                 quantile=0.95, artifacts="index", artifact_ttl=3600, rollup_index=None):
+        """
+        Constructor
+        :param history_index: IndexData of the price history
+        :param bid_index: IndexData to write bids to
+        :param n_days: number of durations (days) to bid for (Default: 30)
+        :param history_days: days of history to train on (Default: None - all)
+        :param scan_slices: parallel scroll slices per history read (Default: None - single scroll)
+        :param model: name of the registered model to train with (Default: linear)
+        :param quantile: share of the historic windows a "quantile" model bid should have survived (Default: 0.95)
+        :param artifacts: where model artifacts (BidArtifact) are kept: "index" (the "artifact" field of the bid
+            document), a directory path or None to not write or read them (Default: index)
+        :param artifact_ttl: seconds to cache artifacts read for get_bid (Default: 3600)
+        :param rollup_index: IndexData of the daily price rollup (see DailyRollup) to train on, keys without rollup
+            days are read from the history (Default: None - always read the history)
+        """
         self.__history_index = history_index
         self.__bid_index = bid_index
+        self.__rollup_index = rollup_index
         self.n_days = n_days
+        self.history_days = history_days
+        self.scan_slices = scan_slices
+        self.model = self.get_model(model)
+        self.model_name = model
+        self.quantile = quantile
+        self.artifacts = artifacts
+        self.artifact_ttl = artifact_ttl
+        self.__artifact_cache = {}
+
+    @classmethod
+    def register_model(cls, name, model):
+        """
+        Registers a bid model for use by name
+        :param name: model name (e.g. for the predict.py --model option)
+        :param model: function(data, n_days, **options): list of n_days bids (999 where the data is insufficient)
+            data is a list of dictionaries, fields: Date, Price - options are passed through from the predictor
+        :return: None
+        """
+        cls.__models[name] = model
+
+    @classmethod
+    def get_model(cls, name):
+        """
+        Gets a registered bid model
+        :param name: model name
+        :return: model function
+        """
+        if name not in cls.__models:
+            raise ValueError("Unknown bid model: {} (registered: {})".format(name, cls.get_model_names()))
+        return cls.__models[name]
+
+    @classmethod
+    def get_model_names(cls):
+        """Returns the names of the registered models"""
+        return sorted(cls.__models.keys())
 
     def thread_process_instance(self, instances):
         """
@@ -41,67 +98,254 @@ class BidPredictor:
         """ Generates an ElasticSearch document id for input """
         return "{}~{}~{}".format(region, instance, os)
 
-    def get_bid(self, region, instance, os, duration):
+    def get_bid(self, region, instance, os, duration, percentile=None):
         """
         Gets the bid from ElasticSearch for the given parameters
+        (the trained bid prices, percentile bids are computed from the model artifact)
         :param region:
         :param instance:
         :param os:
         :param duration:
-        :return: Pair [az, bid] - returns [None, -1] on not found/error
+        :param percentile: survival percentile (0-100) to bid for, needs an artifact (Default: None - trained model)
+        :return: Pair [az, bid] - returns [None, -1] on not found/error (and for a percentile without an artifact)
         """
         if duration < 1:
             duration = 1
 
-        bid = self.__bid_index.get_doc(self.get_bid_es_key(region, instance, os))
+        if percentile is not None:
+            # the trained bid is for the training quantile, never answer a percentile with it
+            artifact = self.get_artifact(region, instance, os)
+            if artifact is None:
+                return [None, -1]
+            return artifact.compute_bid(duration, percentile)
+
+        bid = self.__bid_index.get_doc(self.get_bid_es_key(region, instance, os),
+                                       source=["azs", "bid_price", "bid_az", "summary"])
         if bid is None:
             return [None, -1]
-        else:
-            summary = bid.get("summary")
-            n_days = len(summary)
-            if duration > n_days:
-                duration = n_days
-            if self.n_days != n_days:
-                self.n_days = n_days
-
-            result = summary[duration - 1].split('/')
-            if len(result) != 2:
+        if "bid_price" not in bid:
+            # trained before the typed bid schema
+            try:
+                bid = self.convert_bid(bid)
+            except ValueError:
                 eprint("Internal Error - Malformed Bid data for request: {}, {}, {}, {}".format(region, instance,
                                                                                                 os, duration))
                 return [None, -1]
+
+        prices = bid.get("bid_price")
+        n_days = len(prices)
+        if duration > n_days:
+            duration = n_days
+        if self.n_days != n_days:
+            self.n_days = n_days
+
+        position = bid.get("bid_az")[duration - 1]
+        if position < 0:
+            return [None, -1]
+        return [bid.get("azs")[position], float(prices[duration - 1])]
+
+    @staticmethod
+    def build_bid(estimates, n_days):
+        """
+        Builds a bid document, the cheapest AZ and its price per duration (a bid has to last every shorter duration)
+        :param estimates: dict of AZ to list of prices (one per duration)
+        :param n_days: number of durations (days)
+        :return: dict: azs (AZ table), bid_price (float per duration), bid_az (position in azs per duration, -1 for
+            none) and estimates
+        """
+        azs = sorted(estimates)
+        bid_price = []
+        bid_az = []
+        az_max = {}
+        for day in range(0, n_days):
+            min_az = None
+            min_price = -1
+            for az in azs:
+                az_max[az] = max(az_max.get(az, -1), estimates[az][day])
+                if min_az is None or az_max[az] < min_price:
+                    min_az = az
+                    min_price = az_max[az]
+
+            if min_az is not None:
+                bid_az.append(azs.index(min_az))
+                bid_price.append(float(min_price))
             else:
-                return result
+                bid_az.append(-1)
+                bid_price.append(999.0)
+
+        return {"azs": azs, "bid_price": bid_price, "bid_az": bid_az, "estimates": estimates}
 
     @staticmethod
-    def predict(data, days):
+    def convert_bid(bid):
+        """
+        Converts a bid document from the "az/price" summary strings to the typed bid schema
+        :param bid: bid document (summary and a list of prices per AZ)
+        :return: bid document (see build_bid), other fields (e.g. artifact) are kept
+        """
+        bid = dict(bid)
+        summary = bid.pop("summary")
+        estimates = bid.pop("estimates", {})
+        for az in [field for field in bid if type(bid[field]) is list]:
+            estimates[az] = bid.pop(az)
+
+        azs = sorted(estimates)
+        bid_price = []
+        bid_az = []
+        for entry in summary:
+            result = entry.split('/')
+            if len(result) != 2:
+                raise ValueError("Malformed bid summary: {}".format(entry))
+            (az, price) = result
+            if az == "None":
+                bid_az.append(-1)
+            else:
+                if az not in azs:
+                    azs.append(az)
+                bid_az.append(azs.index(az))
+            bid_price.append(float(price))
+
+        bid.update({"azs": azs, "bid_price": bid_price, "bid_az": bid_az, "estimates": estimates})
+        return bid
+
+    @staticmethod
+    def predict(data, days, scores=None):
         """
         Generates a prediction for the given timeseries
         :param data: a dataframe to train on 2 fields: Date, Price
         :param days: Number of days out to predict
+        :param scores: list to append the regression confidence (R^2 on a random 20% of the rows) to (Default: None)
         :return: predicted price
         """
+        # pandas, SciPy and scikit-learn are imported by training only, serving bids does not need them
+        import pandas as pd
+        from scipy import stats
+        from sklearn.linear_model import LinearRegression
+        from sklearn import preprocessing, model_selection
+
         df = pd.DataFrame(data)
         df = df[['Price']]
         forecast_out = int(days)  # predicting 30 days into future
         df['Prediction'] = df[['Price']].shift(-forecast_out)
-        X = np.array(df.drop(['Prediction'], 1))
+        X = np.array(df.drop(['Prediction'], axis=1))
         X = preprocessing.scale(X)
         X_forecast = X[-forecast_out:]  # set X_forecast equal to last 30
         X = X[:-forecast_out]  # remove last 30 from X
         y = np.array(df['Prediction'])
         y = y[:-forecast_out]
-        X_train, X_test, y_train, y_test = cross_validation.train_test_split(X, y, test_size=0.2)
         # Training
         clf = LinearRegression()
-        if len(X) == 0:
+        if len(X) < 2:
             return 999
         else:
+            X_train, X_test, y_train, y_test = model_selection.train_test_split(X, y, test_size=0.2)
             clf.fit(X, y)
             # Testing
-            confidence = clf.score(X_test, y_test)
+            if scores is not None:
+                scores.append(clf.score(X_test, y_test))
             forecast_prediction = clf.predict(X_forecast)
             return ceil(float(stats.gmean(forecast_prediction)) * 1000) / 1000
 
+    def get_artifact_file(self, key):
+        """ Generates the artifact file name for a bid document id (artifacts kept in a directory) """
+        return join(self.artifacts, "{}.npz".format(key.replace("/", "_")))
+
+    def get_artifact(self, region, instance, os):
+        """
+        Gets the model artifact for the given parameters (cached for artifact_ttl seconds)
+        :param region:
+        :param instance:
+        :param os:
+        :return: BidArtifact (None if there is none)
+        """
+        if self.artifacts is None:
+            return None
+
+        key = self.get_bid_es_key(region, instance, os)
+        entry = self.__artifact_cache.get(key)
+        if entry is not None and time.time() - entry[0] < self.artifact_ttl:
+            return entry[1]
+
+        artifact = None
+        if self.artifacts == "index":
+            doc = self.__bid_index.get_doc(key, source=["artifact"])
+            if doc is not None and doc.get("artifact") is not None:
+                artifact = BidArtifact.decode(doc.get("artifact"))
+        elif exists(self.get_artifact_file(key)):
+            with open(self.get_artifact_file(key), 'rb') as packed:
+                artifact = BidArtifact.unpack(packed.read())
+
+        self.__artifact_cache[key] = (time.time(), artifact)
+        return artifact
+
+    def write_artifact(self, key, artifact, document):
+        """
+        Saves a model artifact
+        :param key: bid document id
+        :param artifact: BidArtifact
+        :param document: bid document (the artifact is added to it when kept in the index)
+        :return: None
+        """
+        if self.artifacts == "index":
+            document["artifact"] = artifact.encode()
+        else:
+            filename = self.get_artifact_file(key)
+            with open(filename + '.tmp', 'wb') as packed:
+                packed.write(artifact.pack())
+            rename(filename + '.tmp', filename)
+
+    @classmethod
+    def predict_linear(cls, data, n_days, scores=None, **options):
+        """
+        Linear model: a regression per duration of the price against the price that many days later
+        :param data: a dataframe to train on 2 fields: Date, Price
+        :param n_days: number of durations (days) to predict
+        :param scores: list to append the confidence of each regression to (Default: None)
+        :param options: ignored
+        :return: list of predicted prices (one per duration)
+        """
+        return [cls.predict(data, days, scores) for days in range(1, n_days + 1)]
+
+    @staticmethod
+    def predict_quantile(data, n_days, quantile=0.95, **options):
+        """
+        Quantile model: for each duration, the empirical quantile of the maximum price over every window of that many
+        days in the history (a bid at that price would have lasted the duration in that share of past windows)
+        :param data: a dataframe to train on 2 fields: Date, Price
+        :param n_days: number of durations (days) to predict
+        :param quantile: share of windows the bid should survive (Default: 0.95)
+        :param options: ignored
+        :return: list of predicted prices (one per duration, 999 where the history is shorter than the duration)
+        """
+        import pandas as pd
+
+        df = pd.DataFrame(data)
+        if len(df) == 0:
+            return [999] * n_days
+
+        dates = df['Date'].values.astype('datetime64[D]')
+        prices = df['Price'].values.astype(float)
+        order = np.argsort(dates, kind='mergesort')
+        daily = BidArtifact.get_daily_max(dates[order], prices[order])
+        estimates = BidArtifact.get_window_quantiles(daily, n_days, quantile).tolist()
+        return [999 if x >= BidArtifact.no_bid else x for x in estimates]
+
+    @staticmethod
+    def get_training_row(history):
+        """
+        Converts a price history document to a training row
+        :param history: price history document (see history_fields)
+        :return: dict: Region, Date, OS, Price, AvailabilityZone
+        """
+        import pandas
+
+        return {
+            "Region": history.get("Region"),
+            "Date": pandas.to_datetime(dateutil.parser.parse(history.get("Timestamp")).strftime("%Y-%m-%d")),
+            "OS": history.get("ProductDescription").lower(),
+            "Price": float(history.get("SpotPrice")),
+            "AvailabilityZone": history.get("AvailabilityZone")
+        }
+
     @staticmethod
     def split_data(instance_history):
         """
@@ -127,47 +371,127 @@ class BidPredictor:
 
         return instance_az_history
 
-    def model_data(self, instance, region, os, data):
+    @staticmethod
+    def get_estimates(model, data, n_days, **options):
         """
-        Models data for a given set of input parameters and writes results to ES
-        :param instance:
-        :param region:
-        :param os:
-        :param data: list of fields (dictionary), fields: Date, Price
-        :return: None
+        Runs a model for every AZ, AZs the model can not bid on are left out
+        :param model: model function (see register_model)
+        :param data: dict of AZ to list of rows (dictionaries), fields: Date, Price
+        :param n_days: number of durations (days)
+        :param options: passed to the model
+        :return: dict of AZ to list of prices (one per duration)
         """
         estimates = {}
         for az in data:
-            estimates[az] = []
-            for days in range(1, self.n_days + 1):
-                estimates[az].append(self.predict(data[az], days))
+            estimates[az] = model(data[az], n_days, **options)
 
             if max(estimates[az]) == 999:
                 estimates.pop(az)
             else:
                 estimates[az] = [999 if isnan(x) else x for x in estimates[az]]
 
-        summary = []
-        az_max = {}
-        for day in range(0, self.n_days):
-            min_az = None
-            min_price = -1
-            for az in estimates:
-                az_max[az] = max(az_max.get(az, -1), estimates[az][day])
-                if min_az is None or az_max[az] < min_price:
-                    min_az = az
-                    min_price = az_max[az]
+        return estimates
 
-            if min_az is not None:
-                summary.append("{}/{}".format(min_az, min_price))
-            else:
-                summary.append("{}/{}".format(min_az, 999))
+    def model_data(self, instance, region, os, data):
+        """
+        Models data for a given set of input parameters and writes results to ES
+        :param instance:
+        :param region:
+        :param os:
+        :param data: list of fields (dictionary), fields: Date, Price
+        :return: None
+        """
+        key = self.get_bid_es_key(region, instance, os)
+        with Instrumentation.timed_key("train", key), Instrumentation.stage("train." + self.model_name):
+            estimates = self.get_estimates(self.model, data, self.n_days, quantile=self.quantile)
+        Instrumentation.count("train.keys")
+        Instrumentation.count("train.azs", len(data))
 
         if len(estimates) > 0:
-            estimates["summary"] = summary
+            bid = self.build_bid(estimates, self.n_days)
+            bid["trained"] = utc.localize(datetime.datetime.utcnow()).strftime('%Y-%m-%dT%H:%M:%S%z')
+            if self.artifacts is not None:
+                with Instrumentation.stage("train.artifact"):
+                    artifact = BidArtifact.from_history(dict((az, data[az]) for az in estimates),
+                                                        self.n_days, model=self.model_name, quantile=self.quantile)
+                    self.write_artifact(key, artifact, bid)
 
             eprint("Trained: {}, {}, {}".format(region, instance, os))
-            self.__bid_index.write(estimates, self.get_bid_es_key(region, instance, os))
+            with Instrumentation.stage("bid.write"):
+                self.__bid_index.write(bid, key)
+            Instrumentation.count("bid.writes")
+        else:
+            Instrumentation.count("train.no_bid")
+
+    def get_history(self, terms, history_index=None):
+        """
+        Reads and splits the training history for a query, a row per day from the rollup when it has any of the query's
+        days (the days before the rollup starts are added from the history, see add_history_days)
+        :param terms: dict of history field to value (see IndexData.search_terms)
+        :param history_index: IndexData of the price history (Default: the predictor's)
+        :return: Multilevel dictionary of Rows (see split_data)
+        """
+        history_index = history_index if history_index is not None else self.__history_index
+        since = None
+        if self.history_days:
+            since = utc.localize(datetime.datetime.now()) - datetime.timedelta(days=self.history_days)
+
+        if self.__rollup_index is not None:
+            rollup = self.__rollup_index.search_terms(terms, since=since, slices=self.scan_slices, page_size=0,
+                                                      source=DailyRollup.fields)
+            rollup = Instrumentation.timed("rollup.scroll", rollup, counter="rollup.rows")
+            rows = Instrumentation.timed("rollup.parse", (DailyRollup.get_training_row(r) for r in rollup))
+            with Instrumentation.stage("history.split"):
+                instance_az_history = self.split_data(rows)
+            if len(instance_az_history) > 0:
+                return self.add_history_days(instance_az_history, terms, history_index, since)
+        history = history_index.search_terms(terms, since=since, slices=self.scan_slices, page_size=0,
+                                             source=self.history_fields)
+        # the scroll, row conversion and split are chained lazily, time each link on its own
+        history = Instrumentation.timed("history.scroll", history, counter="history.rows")
+        rows = Instrumentation.timed("history.parse", (self.get_training_row(h) for h in history))
+        with Instrumentation.stage("history.split"):
+            return self.split_data(rows)
+
+    def add_history_days(self, instance_az_history, terms, history_index, since=None):
+        """
+        Adds the days before the rollup starts to rollup training rows, from the history ticks (the day's maximum price
+        per AZ, as a rollup row). Ingestion rolls up every key from the day it started keeping the rollup, so only the
+        ticks before the query's first rollup day are read: none once rollup.py has backfilled the rollup, the days
+        (and keys without any rollup days) from before the rollup otherwise
+        :param instance_az_history: Multilevel dictionary of rollup Rows (see split_data), extended in place
+        :param terms: dict of history field to value (see IndexData.search_terms)
+        :param history_index: IndexData of the price history
+        :param since: datetime to read the history from (Default: None - all history)
+        :return: Multilevel dictionary of Rows (see split_data)
+        """
+        firsts = {}
+        for region in instance_az_history:
+            for os in instance_az_history[region]:
+                for az, rows in instance_az_history[region][os].items():
+                    firsts[(region, os, az)] = min(row.get("Date") for row in rows)
+        until = min(firsts.values())
+
+        history = history_index.search_terms(terms, since=since, until=utc.localize(until.to_pydatetime()),
+                                             slices=self.scan_slices, page_size=0, source=self.history_fields)
+        history = Instrumentation.timed("history.scroll", history, counter="history.rows")
+        daily = {}
+        for row in Instrumentation.timed("history.parse", (self.get_training_row(h) for h in history)):
+            key = (row.get("Region"), row.get("OS"), row.get("AvailabilityZone"))
+            # only the days before the AZ's own first rollup day (keys missing from the rollup take every day read)
+            if row.get("Date") < firsts.get(key, until):
+                day = key + (row.get("Date"),)
+                daily[day] = max(daily.get(day, row.get("Price")), row.get("Price"))
+
+        added = {}
+        for (region, os, az, date) in sorted(daily):
+            added.setdefault((region, os, az), []).append({"Date": date, "Price": daily[(region, os, az, date)]})
+        for (region, os, az), rows in added.items():
+            azs = instance_az_history.setdefault(region, {}).setdefault(os, {})
+            azs[az] = rows + azs.get(az, [])
+        Instrumentation.count("history.added_days", len(daily))
+
+        return instance_az_history
 
     def model_instance(self, instance, history_index):
         """
@@ -177,18 +501,27 @@ class BidPredictor:
         :return:
         """
         eprint("Fetching data for: {}".format(instance))
-        instance_history = history_index.search_terms({"InstanceType": instance})
-        instance_history = (
-            {
-                "Region": h.get("Region"),
-                "Date": pandas.to_datetime(dateutil.parser.parse(h.get("Timestamp")).strftime("%Y-%m-%d")),
-                "OS": h.get("ProductDescription").lower(),
-                "Price": float(h.get("SpotPrice")),
-                "AvailabilityZone": h.get("AvailabilityZone")
-            } for h in instance_history)
-
-        instance_az_history = self.split_data(instance_history)
+        with Instrumentation.timed_key("history", instance):
+            instance_az_history = self.get_history({"InstanceType": instance}, history_index)
+        Instrumentation.count("history.groups", sum(len(oses) for oses in instance_az_history.values()))
 
         for region in instance_az_history:
             for os in instance_az_history[region]:
                 self.model_data(instance, region, os, instance_az_history[region][os])
+
+    def model_key(self, region, instance, os):
+        """
+        Models a single bid key and writes the result to ES
+        :param region:
+        :param instance:
+        :param os: lower case OS (as in the bid key)
+        :return: None
+        """
+        instance_az_history = self.get_history({"InstanceType": instance, "Region": region})
+        data = instance_az_history.get(region, {}).get(os)
+        if data is not None:
+            self.model_data(instance, region, os, data)
+
+
+BidPredictor.register_model("linear", BidPredictor.predict_linear)
+BidPredictor.register_model("quantile", BidPredictor.predict_quantile)
@@ -0,0 +1,137 @@
+import gzip
+import json
+import os
+import time
+
+
+class BidSnapshot:
+    """
+    Compact read only copy of the trained bids and the instance map, for serving bids without ES or the model libraries
+
+    Bids are kept as the typed bid arrays (AZ table, price and AZ position per duration) per bid key, instances as a
+    column list and rows of attribute values, with the fields the instance index maps as numbers (so searches match
+    IndexData.search_terms). The snapshot is a gzipped JSON file built by snapshot.py and packaged with the Chalice app,
+    it needs nothing outside the standard library to load or answer from.
+    """
+    version = 2
+
+    def __init__(self, bids, fields, instances, numeric_fields, created=None):
+        """
+        Constructor
+        :param bids: dict of bid key (see BidPredictor.get_bid_es_key) to dict: azs, bid_price, bid_az
+        :param fields: list of instance attribute names
+        :param instances: list of instance rows (attribute values in fields order)
+        :param numeric_fields: list of the instance attributes the instance index maps as numbers
+        :param created: epoch seconds the snapshot was built (Default: None - now)
+        """
+        self.bids = bids
+        self.fields = fields
+        self.instances = instances
+        self.created = created if created is not None else time.time()
+        self.numeric_fields = numeric_fields
+        self.__columns = dict((field, i) for i, field in enumerate(fields))
+
+    @classmethod
+    def build(cls, bid_index, instance_index):
+        """
+        Builds a snapshot from the indexes
+        :param bid_index: IndexData of the bids
+        :param instance_index: IndexData of the instance map
+        :return: BidSnapshot
+        """
+        # bids trained before the typed bid schema (not yet migrated with migrate_bids.py) are converted
+        from .BidPredictor import BidPredictor
+
+        bids = {}
+        for (id, bid) in bid_index.scan(ids=True, source={"excludes": ["artifact", "estimates"]}):
+            if "bid_price" not in bid:
+                try:
+                    bid = BidPredictor.convert_bid(bid)
+                except (KeyError, ValueError):
+                    # malformed, BidPredictor.get_bid does not serve it either
+                    continue
+            bids[id] = {"azs": bid.get("azs"), "bid_price": bid.get("bid_price"), "bid_az": bid.get("bid_az")}
+
+        documents = list(instance_index.scan())
+        fields = sorted(set(field for document in documents for field in document))
+        instances = [[document.get(field) for field in fields] for document in documents]
+        return cls(bids, fields, instances, sorted(set(instance_index.get_numeric_fields()) & set(fields)))
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads a snapshot file
+        :param path: snapshot file name
+        :return: BidSnapshot
+        """
+        with gzip.open(path, 'rt') as snapshot:
+            data = json.load(snapshot)
+        if data.get("version") != cls.version:
+            raise ValueError("Unsupported bid snapshot version: {}".format(data.get("version")))
+        return cls(data.get("bids"), data.get("fields"), data.get("instances"), data.get("numeric_fields"),
+                   created=data.get("created"))
+
+    def save(self, path):
+        """
+        Writes the snapshot file (replaced atomically)
+        :param path: snapshot file name
+        :return: None
+        """
+        with gzip.open(path + '.tmp', 'wt') as snapshot:
+            json.dump({"version": self.version, "created": self.created, "bids": self.bids, "fields": self.fields,
+                       "instances": self.instances, "numeric_fields": self.numeric_fields}, snapshot,
+                      separators=(',', ':'))
+        os.rename(path + '.tmp', path)
+
+    def search_instances(self, terms, numeric_as_min=False):
+        """
+        Searches the instances for a series of terms (as IndexData.search_terms on the instance index)
+        :param terms: a dictionary of attributes to search with either a single or list of terms to match
+        :param numeric_as_min: should numbers be treated as min values (or absolute) (Default: False)
+        :return: list of (instance, region)
+        """
+        numeric_fields = self.numeric_fields if numeric_as_min else []
+        conditions = []
+        for term, value in terms.items():
+            if term not in self.__columns:
+                return []
+            values = value if type(value) is list else [value]
+            if term in numeric_fields:
+                minimum = float(min(values))
+                conditions.append((self.__columns[term], lambda x, minimum=minimum: x is not None and x >= minimum))
+            else:
+                conditions.append((self.__columns[term], lambda x, values=values: x in values))
+
+        instance = self.__columns.get("InstanceType")
+        region = self.__columns.get("Region")
+        matches = []
+        for row in self.instances:
+            for (i, match) in conditions:
+                # list attributes match on any of their values
+                values = row[i] if type(row[i]) is list else [row[i]]
+                if not any(match(x) for x in values):
+                    break
+            else:
+                matches.append((row[instance], row[region]))
+
+        return matches
+
+    def get_bid(self, region, instance, os, duration):
+        """
+        Gets the trained bid for the given parameters
+        :param region:
+        :param instance:
+        :param os:
+        :param duration: days the bid should last
+        :return: Pair [az, bid] - returns [None, -1] if no AZ has enough data, None if the key is not in the snapshot
+        """
+        bid = self.bids.get("{}~{}~{}".format(region, instance, os))
+        if bid is None:
+            return None
+
+        prices = bid.get("bid_price")
+        duration = min(max(int(duration), 1), len(prices))
+        position = bid.get("bid_az")[duration - 1]
+        if position < 0:
+            return [None, -1]
+        return [bid.get("azs")[position], float(prices[duration - 1])]
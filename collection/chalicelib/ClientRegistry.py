@@ -0,0 +1,150 @@
+from elasticsearch import Elasticsearch, RequestsHttpConnection
+import json
+import threading
+import time
+from .FastJSONSerializer import FastJSONSerializer
+
+
+class ClientRegistry:
+    """
+    Process wide registry of ES clients (one per cluster configuration) and cache of index metadata
+
+    Clients are thread safe and keep a connection pool per node, so every IndexData for the same cluster shares one
+    client. Use the "maxsize" connection option to size the pools for the number of threads using them.
+    """
+    __clients = {}
+    __metadata = {}
+    __lock = threading.Lock()
+    metadata_ttl = 300
+
+    @staticmethod
+    def normalize(url, connection_options):
+        """
+        Converts URL and connection options (e.g. from the ini file) to ES client constructor arguments
+        :param url: ES URL (or list of URL's)
+        :param connection_options: map of connection options (this is not modified)
+        :return: pair: (hosts, options)
+        """
+        if type(url) is not list:
+            url = [url]
+
+        connection_options = dict(connection_options)
+        port = connection_options.pop("port", None)
+        full_urls = []
+        for addr in url:
+            if type(addr) is dict:
+                full_urls.append(addr)
+            elif ":" in addr:
+                full_urls.append({"host": addr.split(":")[0], "port": int(addr.split(":")[1])})
+            elif port is not None:
+                full_urls.append({"host": addr, "port": int(port)})
+            else:
+                full_urls.append(addr)
+
+        use_ssl = connection_options.pop("use_ssl", None)
+        if use_ssl is not None:
+            connection_options["use_ssl"] = bool(use_ssl)
+
+        verify_certs = connection_options.pop("verify_certs", None)
+        if verify_certs is not None:
+            connection_options["verify_certs"] = bool(verify_certs)
+
+        connection_class = connection_options.pop("connection_class", None)
+        if type(connection_class) is type:
+            connection_options["connection_class"] = connection_class
+        elif connection_class == "RequestsHttpConnection":
+            connection_options["connection_class"] = RequestsHttpConnection
+
+        # connections kept open per node
+        maxsize = connection_options.pop("maxsize", None)
+        if maxsize is not None:
+            connection_options["maxsize"] = int(maxsize)
+
+        timeout = connection_options.pop("timeout", None)
+        if timeout is not None:
+            connection_options["timeout"] = float(timeout)
+
+        # JSON library used to encode requests and decode responses (e.g. orjson)
+        serializer = connection_options.pop("serializer", None)
+        if isinstance(serializer, str):
+            connection_options["serializer"] = FastJSONSerializer(serializer)
+        elif serializer is not None:
+            connection_options["serializer"] = serializer
+
+        return full_urls, connection_options
+
+    @classmethod
+    def get_client(cls, url, connection_options={}):
+        """
+        Gets the shared client for a cluster configuration (created on first use)
+        :param url: ES URL (or list of URL's)
+        :param connection_options: map of connection options to pass to the ES client constructor (Default: Empty)
+        :return: pair: (client, registry key)
+        """
+        hosts, options = cls.normalize(url, connection_options)
+        key = json.dumps([hosts, options], sort_keys=True, default=str)
+        with cls.__lock:
+            client = cls.__clients.get(key)
+            if client is None:
+                client = Elasticsearch(hosts, **options)
+                cls.__clients[key] = client
+
+        return client, key
+
+    @classmethod
+    def cached(cls, key, name, fetch, ttl=None):
+        """
+        Gets a piece of index metadata from the cache, fetching it from ES on a miss
+        :param key: registry key of the client (from get_client)
+        :param name: metadata name (e.g. "exists:<index>")
+        :param fetch: function to fetch the value from ES
+        :param ttl: seconds to keep the value (Default: metadata_ttl)
+        :return: metadata value
+        """
+        ttl = ttl if ttl is not None else cls.metadata_ttl
+        entry = cls.__metadata.get((key, name))
+        if entry is not None and time.time() - entry[0] < ttl:
+            return entry[1]
+
+        value = fetch()
+        with cls.__lock:
+            cls.__metadata[(key, name)] = (time.time(), value)
+        return value
+
+    @classmethod
+    def invalidate(cls, key, *names):
+        """
+        Drops cached index metadata (call after changing indexes or aliases)
+        :param key: registry key of the client (from get_client)
+        :param names: metadata names to drop (Default: everything for the client)
+        :return: None
+        """
+        with cls.__lock:
+            for cache_key in list(cls.__metadata.keys()):
+                if cache_key[0] == key and (len(names) == 0 or cache_key[1] in names):
+                    cls.__metadata.pop(cache_key, None)
+
+    @classmethod
+    def stats(cls, key=None):
+        """
+        Reports connection pool usage for tuning "maxsize"
+        :param key: registry key of a single client (Default: None - all clients)
+        :return: list of dicts, one per node connection: host, maxsize, in_use, available, num_connections, num_requests
+        """
+        result = []
+        for client_key, client in list(cls.__clients.items()):
+            if key is not None and client_key != key:
+                continue
+
+            for connection in client.transport.connection_pool.connections:
+                stat = {"host": connection.host}
+                pool = getattr(connection, "pool", None)
+                if pool is not None:
+                    stat["maxsize"] = pool.pool.maxsize
+                    stat["available"] = pool.pool.qsize()
+                    stat["in_use"] = stat["maxsize"] - stat["available"]
+                    stat["num_connections"] = pool.num_connections
+                    stat["num_requests"] = pool.num_requests
+                result.append(stat)
+
+        return result
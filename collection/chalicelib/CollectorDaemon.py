@@ -0,0 +1,144 @@
+import datetime
+import json
+import os
+import threading
+import time
+import dateutil.parser
+from .common import *
+
+
+class CollectorDaemon:
+    """
+    Long running incremental spot price collection
+
+    Keeps the reader (and with it the boto3 clients, index clients and InstanceMap) between polls and a cursor per
+    region: the time the region has been read up to. Each region is polled on its own schedule for the prices since
+    its cursor only, and the cursors are saved to a JSON file after every poll, so a restart continues where the last
+    run stopped. Polls read up to settle_seconds before now, giving late published prices time to appear.
+    """
+
+    def __init__(self, reader, cursor_file="collector_cursors.json", poll_seconds=300, region_poll=None,
+                 settle_seconds=60, initial_minutes=60, instance_loader=None, instance_refresh=86400):
+        """
+        Constructor
+        :param reader: EnhanceSpotPriceData writing to an index (or other non file writer)
+        :param cursor_file: JSON file the region cursors are kept in (Default: collector_cursors.json)
+        :param poll_seconds: seconds between polls of a region (Default: 300)
+        :param region_poll: dict of region to its own seconds between polls (Default: None - poll_seconds for all)
+        :param settle_seconds: seconds before now polls read up to (Default: 60)
+        :param initial_minutes: minutes read for a region without a cursor (Default: 60)
+        :param instance_loader: function returning a fresh InstanceMap (Default: None - keep the reader's)
+        :param instance_refresh: seconds between InstanceMap reloads (Default: 86400)
+        """
+        self.__reader = reader
+        self.cursor_file = cursor_file
+        self.poll_seconds = poll_seconds
+        self.region_poll = region_poll if region_poll is not None else {}
+        self.settle_seconds = settle_seconds
+        self.initial_minutes = initial_minutes
+        self.__instance_loader = instance_loader
+        self.instance_refresh = instance_refresh
+
+        self.__loaded = time.time()
+        self.__cursors = {}
+        self.__due = {}
+        self.__stop = threading.Event()
+
+    def load_cursors(self):
+        """
+        Reads the region cursors from the cursor file
+        :return: None
+        """
+        if os.path.isfile(self.cursor_file):
+            with open(self.cursor_file, 'r') as cursors:
+                self.__cursors = json.load(cursors)
+
+    def save_cursors(self):
+        """
+        Writes the region cursors to the cursor file (replaced atomically)
+        :return: None
+        """
+        with open(self.cursor_file + '.tmp', 'w') as cursors:
+            json.dump(self.__cursors, cursors, indent=4, sort_keys=True)
+        os.rename(self.cursor_file + '.tmp', self.cursor_file)
+
+    def get_cursor(self, region):
+        """
+        Gets the time a region has been read up to
+        :param region: region name
+        :return: datetime (None if the region has not been read)
+        """
+        cursor = self.__cursors.get(region, {}).get("cursor")
+        return dateutil.parser.parse(cursor) if cursor is not None else None
+
+    def refresh_instances(self):
+        """
+        Reloads the InstanceMap every instance_refresh seconds (the reader's is used until the first reload)
+        :return: None
+        """
+        if self.__instance_loader is not None and time.time() - self.__loaded >= self.instance_refresh:
+            self.__reader.set_instances(self.__instance_loader())
+            self.__loaded = time.time()
+
+    def poll_region(self, region):
+        """
+        Reads and writes a region's prices since its cursor and advances the cursor
+        :param region: region name
+        :return: number of rows written
+        """
+        end = utc.localize(datetime.datetime.utcnow()) - datetime.timedelta(seconds=self.settle_seconds)
+        start = self.get_cursor(region)
+        if start is None:
+            start = end - datetime.timedelta(minutes=self.initial_minutes)
+        if start >= end:
+            return 0
+
+        (count, latest) = self.__reader.read_region(region, start, end)
+        cursor = self.__cursors.setdefault(region, {})
+        cursor["cursor"] = end.strftime('%Y-%m-%dT%H:%M:%S%z')
+        cursor["polled"] = utc.localize(datetime.datetime.utcnow()).strftime('%Y-%m-%dT%H:%M:%S%z')
+        if latest is not None:
+            cursor["last_seen"] = latest.strftime('%Y-%m-%dT%H:%M:%S%z')
+        self.save_cursors()
+
+        eprint("Collected {} rows for {} from {} to {} (last seen {})".format(
+            count, region, start.strftime('%Y-%m-%d %H:%M:%S'), end.strftime('%Y-%m-%d %H:%M:%S'),
+            cursor.get("last_seen")))
+        return count
+
+    def run_once(self):
+        """
+        Polls the regions that are due
+        :return: seconds until the next region is due
+        """
+        self.refresh_instances()
+        regions = self.__reader.get_regions()
+        now = time.time()
+        for region in list(regions):
+            if self.__stop.is_set():
+                break
+            if self.__due.get(region, 0) > now:
+                continue
+
+            try:
+                self.poll_region(region)
+            except Exception as e:
+                eprint('Polling region {0} failed: {1}'.format(region, e))
+            self.__due[region] = now + self.region_poll.get(region, self.poll_seconds)
+
+        if len(regions) == 0:
+            return self.poll_seconds
+        return max(min(self.__due.get(region, 0) for region in regions) - time.time(), 0)
+
+    def run(self):
+        """
+        Polls regions until stop is called
+        :return: None
+        """
+        self.load_cursors()
+        while not self.__stop.is_set():
+            self.__stop.wait(self.run_once())
+
+    def stop(self):
+        """Stops the daemon after the region being polled"""
+        self.__stop.set()
@@ -1,9 +1,9 @@
-import ConfigParser
+import configparser
 
 
 class ConfigStage:
     def __init__(self, ini, stage=None):
-        self.config = ConfigParser.ConfigParser()
+        self.config = configparser.ConfigParser()
         self.stage = stage
         self.config.read(ini)
 
@@ -24,7 +24,7 @@ class ConfigStage:
                 return self.config.get(section, option)
 
         if default is None:
-            raise ConfigParser.NoOptionError(option, section)
+            raise configparser.NoOptionError(option, section)
         else:
             return default
 
@@ -41,7 +41,7 @@ class ConfigStage:
                     result[item[0]] = item[1]
 
         if len(result) == 0 and default is None:
-            raise ConfigParser.NoSectionError(section)
+            raise configparser.NoSectionError(section)
         else:
             return result
 
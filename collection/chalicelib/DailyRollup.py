@@ -0,0 +1,217 @@
+import datetime
+import threading
+from .Instrumentation import Instrumentation
+from .common import *
+
+
+class DailyRollup:
+    """
+    Daily spot price summaries per (region, instance, os, AZ), maintained as the price history is ingested
+
+    Each day is one document with the minimum, maximum, time weighted mean and last price, so training reads a row per
+    day instead of every tick. The day's ticks (seconds into the day and price) are kept in the document unindexed, so
+    ticks arriving in any order (e.g. a backfill reading periods backwards) merge exactly. The mean weights every price
+    by how long it held, starting from the previous day's last price (open) when that day is known, up to the end of
+    the day or of the data ingested so far.
+    """
+    fields = ["Region", "InstanceType", "ProductDescription", "AvailabilityZone", "Date", "min", "max", "mean", "last"]
+    day_seconds = 86400
+
+    def __init__(self, rollup_index):
+        """
+        Constructor
+        :param rollup_index: IndexData (or LocalIndexData) to keep the daily documents in
+        """
+        self.__rollup_index = rollup_index
+        self.__pending = {}
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def get_rollup_id(az, instance, os, date):
+        """ Generates the document id for a day (AZ names include the region) """
+        return "{}~{}~{}~{}".format(az, instance, os, date)
+
+    def add(self, region, instance, os, az, timestamp, price):
+        """
+        Adds a price tick, kept until the next flush
+        :param region: region name
+        :param instance: instance type
+        :param os: product description (e.g. Linux/UNIX)
+        :param az: availability zone
+        :param timestamp: tick datetime (UTC if it has no timezone)
+        :param price: spot price
+        :return: None
+        """
+        if timestamp.tzinfo is None:
+            timestamp = utc.localize(timestamp)
+        timestamp = timestamp.astimezone(utc)
+        date = timestamp.strftime('%Y-%m-%d')
+        second = timestamp.hour * 3600 + timestamp.minute * 60 + timestamp.second
+
+        with self.__lock:
+            day = self.__pending.get((region, instance, os, az, date))
+            if day is None:
+                day = self.__pending[(region, instance, os, az, date)] = {}
+            day[second] = float(price)
+
+    @classmethod
+    def summarize(cls, ticks, open_price, covered):
+        """
+        Summarizes a day of ticks
+        :param ticks: dict of seconds into the day to price
+        :param open_price: price at the start of the day (the previous day's last price) or None if unknown
+        :param covered: seconds into the day the data covers (the price after the last tick holds until then)
+        :return: dict: min, max, mean, last
+        """
+        seconds = sorted(ticks)
+        prices = [ticks[second] for second in seconds]
+        # each price holds until the next tick (or the end of the covered part of the day)
+        starts = seconds
+        ends = seconds[1:] + [max(covered, seconds[-1])]
+        if open_price is not None and seconds[0] > 0:
+            prices = [open_price] + prices
+            starts = [0] + starts
+            ends = [seconds[0]] + ends
+
+        weight = float(ends[-1] - starts[0])
+        if weight > 0:
+            mean = sum(price * (end - start) for price, start, end in zip(prices, starts, ends)) / weight
+        else:
+            mean = prices[-1]
+
+        return {
+            "min": min(ticks.values()),
+            "max": max(ticks.values()),
+            "mean": round(mean, 6),
+            "last": ticks[seconds[-1]]
+        }
+
+    def build_doc(self, key, date, ticks, open_price, covered):
+        """
+        Builds a day document
+        :param key: (region, instance, os, az)
+        :param date: day (YYYY-MM-DD)
+        :param ticks: dict of seconds into the day to price
+        :param open_price: price at the start of the day or None
+        :param covered: seconds into the day the data covers
+        :return: dict: document
+        """
+        (region, instance, os, az) = key
+        doc = {
+            "Region": region,
+            "InstanceType": instance,
+            "ProductDescription": os,
+            "AvailabilityZone": az,
+            "Date": date,
+            "Timestamp": utc.localize(datetime.datetime.strptime(date, '%Y-%m-%d')),
+            "open": open_price,
+            "covered": covered,
+            "tick_seconds": sorted(ticks),
+            "tick_prices": [ticks[second] for second in sorted(ticks)]
+        }
+        doc.update(self.summarize(ticks, open_price, covered))
+        return doc
+
+    def get_covered(self, date, until):
+        """
+        Gets how many seconds of a day data was ingested for
+        :param date: day (YYYY-MM-DD)
+        :param until: datetime data was ingested up to
+        :return: seconds (0 - day_seconds)
+        """
+        start = utc.localize(datetime.datetime.strptime(date, '%Y-%m-%d'))
+        return int(min(max((until - start).total_seconds(), 0), self.day_seconds))
+
+    def flush(self, until=None):
+        """
+        Merges the ticks added since the last flush into the day documents (and updates the open price of any
+        following day already in the index)
+        :param until: datetime data has been ingested up to, e.g. the end of the period read (Default: None - now)
+        :return: number of documents written
+        """
+        until = until if until is not None else utc.localize(datetime.datetime.utcnow())
+        if until.tzinfo is None:
+            until = utc.localize(until)
+        with self.__lock:
+            (pending, self.__pending) = (self.__pending, {})
+        if len(pending) == 0:
+            return 0
+
+        # the stored days this flush merges with, opens from or reopens, read in one request
+        ids = set()
+        for (region, instance, os, az, date) in pending:
+            for day in [self.get_date(date, -1), date, self.get_date(date, 1)]:
+                ids.add(self.get_rollup_id(az, instance, os, day))
+        with Instrumentation.stage("rollup.read"):
+            stored = self.__rollup_index.get_docs(sorted(ids))
+
+        written = {}
+        writes = {}
+        with Instrumentation.stage("rollup.flush"):
+            for (region, instance, os, az, date) in sorted(pending):
+                key = (region, instance, os, az)
+                ticks = pending[key + (date,)]
+                id = self.get_rollup_id(az, instance, os, date)
+                current = stored.get(id)
+                covered = self.get_covered(date, until)
+                open_price = None
+                if current is not None:
+                    merged = dict(zip(current.get("tick_seconds"), current.get("tick_prices")))
+                    merged.update(ticks)
+                    ticks = merged
+                    covered = max(covered, current.get("covered", 0))
+                    open_price = current.get("open")
+
+                previous = self.get_date(date, -1)
+                if previous in written.get(key, {}):
+                    open_price = written[key][previous].get("last")
+                elif open_price is None:
+                    day = stored.get(self.get_rollup_id(az, instance, os, previous))
+                    open_price = day.get("last") if day is not None else None
+
+                doc = self.build_doc(key, date, ticks, open_price, covered)
+                writes[id] = doc
+                written.setdefault(key, {})[date] = doc
+
+                # a following day written before this one (e.g. in a backfill) opens at this day's last price
+                following = self.get_date(date, 1)
+                if key + (following,) not in pending:
+                    id = self.get_rollup_id(az, instance, os, following)
+                    day = stored.get(id)
+                    if day is not None and day.get("open") != doc.get("last"):
+                        writes[id] = self.build_doc(key, following,
+                                                    dict(zip(day.get("tick_seconds"), day.get("tick_prices"))),
+                                                    doc.get("last"), day.get("covered"))
+
+            self.__rollup_index.write_many(writes.items())
+
+        count = sum(len(days) for days in written.values())
+        Instrumentation.count("rollup.docs", count)
+        return count
+
+    @staticmethod
+    def get_date(date, days):
+        """
+        Offsets a day
+        :param date: day (YYYY-MM-DD)
+        :param days: days to add
+        :return: day (YYYY-MM-DD)
+        """
+        return (datetime.datetime.strptime(date, '%Y-%m-%d') + datetime.timedelta(days=days)).strftime('%Y-%m-%d')
+
+    @staticmethod
+    def get_training_row(rollup):
+        """
+        Converts a day document to a training row (the day's maximum price, the price a bid has to survive)
+        :param rollup: day document (see fields)
+        :return: dict: Region, Date, OS, Price, AvailabilityZone (as BidPredictor.get_training_row)
+        """
+        import pandas
+
+        return {
+            "Region": rollup.get("Region"),
+            "Date": pandas.Timestamp(rollup.get("Date")),
+            "OS": rollup.get("ProductDescription").lower(),
+            "Price": float(rollup.get("max")),
+            "AvailabilityZone": rollup.get("AvailabilityZone")
+        }
@@ -1,9 +1,9 @@
 import sys
 import json
-import boto3
 import re
-from botocore.exceptions import ClientError
+import threading
 from .InstanceMap import InstanceMap
+from .Instrumentation import Instrumentation
 from .common import *
 import csv
 import dateutil
@@ -11,9 +11,12 @@ import dateutil
 
 class EnhanceSpotPriceData:
     __regionSplit = re.compile('[a-z]*$')
+    __enrichmentModes = ["full", "reference"]
+    __clients = {}
+    __client_lock = threading.Lock()
 
     def __init__(self, period=60, instances=None, writer=sys.stdout, pretty=False,
-                 end=utc.localize(datetime.datetime.now())):
+                 end=utc.localize(datetime.datetime.now()), enrichment="full", attribute_fields=None, rollup=None):
         """
         Constructor
 
@@ -25,11 +28,24 @@ class EnhanceSpotPriceData:
         :param writer: object to write JSON data to (e.g. file), must provide a write() method (default sys.stdout)
         :param pretty: should the JSON be pretty printed (default False)
         :param end: datetime to read based on (default datetime.datetime.now())
+        :param enrichment: how rows are enriched with instance data (default full)
+            full      -- copy every InstanceMap attribute into Attributes
+            reference -- store the InstanceMap key in InstanceKey and only the attribute_fields in Attributes
+                         (resolve the rest with InstanceMap.resolve)
+        :param attribute_fields: list of attributes to denormalize in reference mode (default None - no Attributes)
+        :param rollup: DailyRollup to add the rows to, flushed after each period read (default None - no rollup)
         """
+        if enrichment not in self.__enrichmentModes:
+            raise ValueError("Invalid enrichment mode: {}".format(enrichment))
+
         self.__period = period * 60
         self.__instances = instances
         self.__writer = writer
         self.pretty = pretty
+        self.enrichment = enrichment
+        self.attribute_fields = attribute_fields if attribute_fields is not None else []
+        self.__attribute_cache = {}
+        self.__rollup = rollup
 
         if end.tzinfo is None or end.tzinfo.utcoffset(end) is None:
             end = utc.localize(end)
@@ -48,7 +64,7 @@ class EnhanceSpotPriceData:
         :return: pair: (start, end)
         """
         end = end if end is not None else self.end
-        end_epoch = (to_epoch(end) / self.__period) * self.__period
+        end_epoch = (to_epoch(end) // self.__period) * self.__period
         start = utc.localize(from_epoch(end_epoch - self.__period))
         end = utc.localize(from_epoch(end_epoch))
         return start, end
@@ -61,7 +77,7 @@ class EnhanceSpotPriceData:
         :return: None
         """
         end = end if end is not None else self.end
-        period = period if period is not None else self.__period / 60
+        period = period if period is not None else self.__period // 60
         self.__period = period * 60
         (self.start, self.end) = self.get_period(end=end)
 
@@ -106,24 +122,91 @@ class EnhanceSpotPriceData:
         else:
             i = 1
 
-        for region in self.__instances.get_regions():
+        from botocore.exceptions import ClientError
+        for region in list(self.__instances.get_regions()):
             try:
-                ec2 = boto3.client('ec2', region_name=region)
-                history = ec2.describe_spot_price_history(
-                    InstanceTypes=self.__instances.get_types(),
-                    StartTime=self.start,
-                    EndTime=self.end)
+                with Instrumentation.timed_key("region", region):
+                    for rowdict in self.get_region_history(region):
+                        i = self.write_row(rowdict, i)
             except ClientError:
                 eprint('Insufficient Privileges in AWS for region {0}'.format(region))
                 self.__instances.regions.remove(region)
                 continue
 
-            for rowdict in history.get('SpotPriceHistory'):
-                i = self.write_row(rowdict, i)
+        if self.__rollup is not None:
+            self.__rollup.flush(until=self.end)
 
         if (continue_flag == 0 or continue_flag == 3) and self.__byte_writer:
             self.__writer.fetch('\n]\n')
 
+    @classmethod
+    def get_client(cls, region):
+        """
+        Gets the EC2 client for a region (created on first use and shared, boto3 clients are thread safe)
+        :param region: region name (e.g. us-west-1)
+        :return: boto3 EC2 client
+        """
+        with cls.__client_lock:
+            client = cls.__clients.get(region)
+            if client is None:
+                # imported on first use, reading price files does not need boto3
+                import boto3
+                client = cls.__clients[region] = boto3.client('ec2', region_name=region)
+            return client
+
+    def get_region_history(self, region, start=None, end=None):
+        """
+        Reads the spot price history of a region, every page of it
+        :param region: region name (e.g. us-west-1)
+        :param start: datetime to read from (Default: self.start)
+        :param end: datetime to read to (Default: self.end)
+        :return: generator of rows (dict) as returned by the API, the price in effect at start included
+        """
+        paginator = self.get_client(region).get_paginator('describe_spot_price_history')
+        pages = paginator.paginate(InstanceTypes=self.__instances.get_types(),
+                                   StartTime=start if start is not None else self.start,
+                                   EndTime=end if end is not None else self.end)
+        for page in Instrumentation.timed("collect.api", pages, counter="collect.pages"):
+            for rowdict in page.get('SpotPriceHistory'):
+                yield rowdict
+
+    def read_region(self, region, start, end):
+        """
+        Reads and writes the rows of a region with timestamps from start up to end (for incremental reads from a
+        cursor, see CollectorDaemon - rows are validated against the window, so reads of other windows must not run
+        at the same time)
+        :param region: region name (e.g. us-west-1)
+        :param start: datetime to read from
+        :param end: datetime to read to
+        :return: pair: (rows written, latest row timestamp or None)
+        """
+        (self.start, self.end) = (start, end)
+        count = 0
+        latest = None
+        for rowdict in self.get_region_history(region, start, end):
+            timestamp = rowdict.get('Timestamp')
+            written = self.write_row(rowdict, count)
+            if written > count and (latest is None or timestamp > latest):
+                latest = timestamp
+            count = written
+
+        if self.__rollup is not None:
+            self.__rollup.flush(until=end)
+        return count, latest
+
+    def get_regions(self):
+        """Returns the regions read (from the InstanceMap)"""
+        return self.__instances.get_regions()
+
+    def set_instances(self, instances):
+        """
+        Replaces the InstanceMap used for enrichment (e.g. a reloaded one)
+        :param instances: InstanceMap
+        :return: None
+        """
+        self.__instances = instances
+        self.__attribute_cache = {}
+
     def read_file(self, filename, reader=csv.reader, start=utc.localize(from_epoch(0))):
         """
         Reads spot price data from a file to enhance (constructs dict to match boto3 api)
@@ -148,10 +231,33 @@ class EnhanceSpotPriceData:
                 }
                 i = self.write_row(rowdict, i)
 
+        if self.__rollup is not None:
+            self.__rollup.flush(until=self.end)
+
         if self.__byte_writer:
             self.__writer.fetch('\n]\n')
 
 
+    def get_attributes(self, region, instance):
+        """
+        Gets the Attributes to enrich a row with for the enrichment mode (built once per instance and shared between rows)
+        :param region: region name (e.g. us-west-1)
+        :param instance: instance name (e.g. r3.xlarge)
+        :return: dict: attributes (None if the instance is not in the InstanceMap)
+        """
+        key = (region, instance)
+        if key not in self.__attribute_cache:
+            record = self.__instances.get(region, instance)
+            if record is None:
+                attributes = None
+            elif self.enrichment == "reference":
+                attributes = dict((field, record.get(field)) for field in self.attribute_fields if field in record)
+            else:
+                attributes = record.to_dict(exclude=('Region', 'InstanceType'))
+            self.__attribute_cache[key] = attributes
+
+        return self.__attribute_cache[key]
+
     def write_row(self, row, i=0):
         """
         Enhances a row of spot price data and writes the data to the target
@@ -159,35 +265,43 @@ class EnhanceSpotPriceData:
         :param i: row number in file (used for file writer) (Default: 0)
         :return: the row number writen to the target (i + 1 on write, i on skip)
         """
-        row = byteify(row)
         timestamp = row.get('Timestamp')
         # Validate the API only pulls the data we are interested in
         if timestamp < self.start or timestamp >= self.end:
+            Instrumentation.count("collect.skipped")
             return i
 
-        # for a byte_writer stringify the timestamps
-        if self.__byte_writer:
-            row['Timestamp'] = timestamp.strftime('%Y-%m-%d %H:%M:%S')
+        with Instrumentation.stage("collect.enrich"):
+            # for a byte_writer stringify the timestamps
+            if self.__byte_writer:
+                row['Timestamp'] = timestamp.strftime('%Y-%m-%d %H:%M:%S')
+
+            region = self.__regionSplit.sub('', row.get('AvailabilityZone'))
+            row['Region'] = region
+            instance = row.get('InstanceType')
+            attributes = self.get_attributes(region, instance)
+            if attributes is not None:
+                if self.enrichment == "reference":
+                    row['InstanceKey'] = InstanceMap.build_key(region, instance)
+                if len(attributes) > 0:
+                    row['Attributes'] = attributes
 
-        region = self.__regionSplit.sub('', row.get('AvailabilityZone'))
-        row['Region'] = region
-        instance = row.get('InstanceType')
-        attributes = self.__instances.get(region, instance)
-        if attributes is not None:
-            attributes.pop('Region', None)
-            attributes.pop('InstanceType', None)
-            row['Attributes'] = attributes
+        if self.__rollup is not None:
+            self.__rollup.add(region, instance, row.get('ProductDescription'), row.get('AvailabilityZone'), timestamp,
+                              row.get('SpotPrice'))
 
         i = i + 1
-        if self.__byte_writer:
-            if i > 1:
-                self.__writer.fetch(',\n')
+        with Instrumentation.stage("collect.write"):
+            if self.__byte_writer:
+                if i > 1:
+                    self.__writer.fetch(',\n')
 
-            if self.pretty:
-                self.__writer.write(json.dumps(row, indent=4, sort_keys=True))
+                if self.pretty:
+                    self.__writer.write(json.dumps(row, indent=4, sort_keys=True))
+                else:
+                    self.__writer.write(json.dumps(row, sort_keys=True))
             else:
-                self.__writer.write(json.dumps(row, sort_keys=True))
-        else:
-            self.__writer.write(row)
+                self.__writer.write(row)
+        Instrumentation.count("collect.rows")
 
         return i
@@ -0,0 +1,62 @@
+from elasticsearch.serializer import JSONSerializer
+from elasticsearch.exceptions import SerializationError
+import importlib
+from .common import eprint
+
+
+class FastJSONSerializer(JSONSerializer):
+    """
+    ES client serializer backed by a faster JSON library (orjson or ujson) when one is installed
+
+    Set with the "serializer" connection option (e.g. serializer = orjson in the [elastic] section), falls back to the
+    standard library json module (the ES client default) if the requested library can not be imported.
+    """
+    backends = ["orjson", "ujson", "json"]
+
+    def __init__(self, backend="orjson"):
+        """
+        Constructor
+        :param backend: JSON library to use: orjson, ujson or json (Default: orjson)
+        """
+        if backend not in self.backends:
+            raise ValueError("Invalid serializer: {} (must be one of {})".format(backend, self.backends))
+
+        self.backend = "json"
+        self.__module = None
+        try:
+            if backend != "json":
+                self.__module = importlib.import_module(backend)
+                self.backend = backend
+        except ImportError:
+            eprint("{} is not installed, using the json module for ES requests".format(backend))
+
+    def __repr__(self):
+        # stable name so clients configured with the same serializer share a ClientRegistry entry
+        return "FastJSONSerializer({})".format(self.backend)
+
+    __str__ = __repr__
+
+    def loads(self, s):
+        if self.__module is None:
+            return JSONSerializer.loads(self, s)
+
+        try:
+            return self.__module.loads(s)
+        except ValueError as e:
+            raise SerializationError(s, e)
+
+    def dumps(self, data):
+        # bodies the client has already serialized (e.g. bulk lines) pass straight through
+        if isinstance(data, str):
+            return data
+        if self.__module is None:
+            return JSONSerializer.dumps(self, data)
+
+        try:
+            if self.backend == "orjson":
+                # the client (and the bulk helper) joins request bodies as text
+                return self.__module.dumps(data, default=self.default,
+                                           option=self.__module.OPT_SERIALIZE_NUMPY).decode("utf-8")
+            return self.__module.dumps(data, ensure_ascii=False)
+        except (ValueError, TypeError) as e:
+            raise SerializationError(data, e)
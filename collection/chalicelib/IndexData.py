@@ -1,13 +1,23 @@
-from elasticsearch import Elasticsearch, helpers, RequestsHttpConnection, NotFoundError
+from elasticsearch import helpers, NotFoundError
 import elasticsearch
 import datetime
+import dateutil.parser
 import json
+import threading
+from .ClientRegistry import ClientRegistry
+from .Instrumentation import Instrumentation
+from .LocalIndexData import LocalIndexData
 from .common import *
 import re
 
+from queue import Queue, Full
+
 
 class IndexData:
-    def __init__(self, url, index, doc_type="doc", connection_options={}, index_settings={}, index_mappings=None, alias=False):
+    __rolloverFormats = {"year": "%Y", "month": "%Y.%m", "day": "%Y.%m.%d"}
+
+    def __init__(self, url, index, doc_type="doc", connection_options={}, index_settings={}, index_mappings=None, alias=False,
+                 rollover=None, timestamp_field="Timestamp"):
         """
         Constructor
         :param url: ES URL (or list of URL's)
@@ -17,42 +27,26 @@ class IndexData:
         :param index_settings: storage settings for the index to use on creation (if needed) (Default: Empty)
         :param index_mappings: field mappings to provide for index creation (if needed) (i.e. type control) (Default: None)
         :param alias: is the provided "index" name really an alias (or should it be - on creation)
+        :param rollover: partition the data into time based indexes (year, month or day) behind the read alias "index"
+            (Default: None - single index)
+        :param timestamp_field: field used to route documents to rollover partitions and filter reads (Default: Timestamp)
         """
-
-        if type(url) is not list:
-            url = [url]
+        if rollover is not None and rollover not in self.__rolloverFormats:
+            raise ValueError("Invalid rollover period: {}".format(rollover))
 
         index_mappings = index_mappings if index_mappings is not None else {"properties": {}}
 
-        port = connection_options.pop("port", None)
-        full_urls = []
-        for addr in url:
-            if type(addr) is dict:
-                full_urls.append(addr)
-            elif ":" in addr:
-                full_urls.append({"host": addr.split(":")[0], "port": int(addr.split(":")[1])})
-            elif port is not None:
-                full_urls.append({"host": addr, "port": int(port)})
-            else:
-                full_urls.append(addr)
-
-        use_ssl = connection_options.pop("use_ssl", None)
-        if use_ssl is not None:
-             connection_options["use_ssl"] = bool(use_ssl)
-
-        verify_certs = connection_options.pop("verify_certs", None)
-        if verify_certs is not None:
-             connection_options["verify_certs"] = bool(verify_certs)
-
-        connection_class = connection_options.pop("connection_class", None)
-        if type(connection_class) is type:
-             connection_options["connection_class"] = connection_class
-        elif connection_class == "RequestsHttpConnection":
-             connection_options["connection_class"] = RequestsHttpConnection
-
-        self.__client = Elasticsearch(full_urls, **connection_options)
-        alias_exists = self.__client.indices.exists_alias(name=index)
-        self.__alias = alias_exists or alias
+        (self.__client, self.__client_key) = ClientRegistry.get_client(url, connection_options)
+        alias_exists = self.cached("alias_exists:" + index, lambda: self.__client.indices.exists_alias(name=index))
+        self.__alias = (alias_exists or alias) and rollover is None
+        self.__rollover = rollover
+        self.__timestamp_field = timestamp_field
+        self.__partitions = set()
+        self.__partition_lock = threading.Lock()
+        self.__bulk_buffer = None
+        self.__bulk_size = 0
+        self.__bulk_restore = None
+        self.__bulk_lock = threading.Lock()
         self.__doc_type = doc_type
         self.__default = index_mappings.pop("_default_", {})
         self.__index_settings = index_settings
@@ -61,11 +55,20 @@ class IndexData:
         self.__index_settings["number_of_shards"] = int(self.__index_settings.get("number_of_shards", 1))
         self.__index_settings["number_of_replicas"] = int(self.__index_settings.get("number_of_replicas", 0))
 
-        if alias_exists:
+        if rollover is not None:
+            if not alias_exists and self.cached("exists:" + index, lambda: self.__client.indices.exists(index)):
+                raise ValueError("Index {} already exists and can not be used as a rollover alias".format(index))
+            self.__alias_name = index
+            self.__index = index
+            self.__partitions = set(self.get_partitions())
+            self.created = len(self.__partitions) == 0
+        elif alias_exists:
             self.created = False
             self.__alias_name = index
-            self.__index = self.get_alias_index()
+            self.__index = self.cached("alias_index:" + index, self.get_alias_index)
         elif alias:
+            if self.cached("exists:" + index, lambda: self.__client.indices.exists(index)):
+                raise ValueError("Index {} already exists and can not be used as an alias".format(index))
             self.__alias_name = index
             self.__index = "{}-1".format(index)
             self.create_if_not_exists()
@@ -85,76 +88,284 @@ class IndexData:
         :return: creation datetime
         """
 
+        if index is None and settings is None and self.__rollover is not None:
+            # A rollover index was created when its first partition was
+            if len(self.get_partitions()) == 0:
+                return datetime.datetime.now()
+            settings = self.__client.indices.get_settings(index=self.__alias_name)
+            return min(self.get_index_creation_date(settings=partition) for partition in settings.values())
+
         if index is None:
             index = self.__index
 
         if settings is None:
-            settings = byteify(self.__client.indices.get_settings(index=index)).get(index)
+            settings = self.cached("settings:" + index,
+                                   lambda: self.__client.indices.get_settings(index=index).get(index))
 
         return from_epoch(float(settings.get("settings").get("index").get("creation_date")) / 1000)
 
     def get_alias_index(self):
         """get the first index behind an alias (used for A/B replacement index usage)"""
         self.check_is_alias()
-        alias_data = byteify(self.__client.indices.get_alias(name=self.__alias_name))
-        return alias_data.keys()[0]
+        alias_data = self.__client.indices.get_alias(name=self.__alias_name)
+        return next(iter(alias_data))
 
-    def scan(self, scroll_ttl='5m', query=None, ids=False):
+    def get_partitions(self):
+        """
+        Gets the time partition indexes behind a rollover alias
+        :return: sorted list of index names (oldest first)
+        """
+        self.check_is_rollover()
+        try:
+            return sorted(self.__client.indices.get_alias(name=self.__alias_name).keys())
+        except NotFoundError:
+            return []
+
+    def get_partition(self, timestamp):
+        """
+        Gets the name of the time partition index a timestamp belongs in
+        :param timestamp: datetime (or timestamp string)
+        :return: index name: "<alias>-<period>"
+        """
+        self.check_is_rollover()
+        if not isinstance(timestamp, datetime.datetime):
+            timestamp = dateutil.parser.parse(timestamp)
+        return "{}-{}".format(self.__alias_name, timestamp.strftime(self.__rolloverFormats[self.__rollover]))
+
+    def get_read_index(self, since=None):
+        """
+        Gets the index expression to read from, limited to the partitions that can hold data newer than since
+        :param since: datetime of the oldest data needed (Default: None - everything)
+        :return: index expression (None if no partition covers the period)
+        """
+        if self.__alias:
+            # read through the alias so an A/B swap by another process is seen straight away
+            return self.__alias_name
+        if since is None or self.__rollover is None:
+            return self.__index
+
+        first = self.get_partition(since)
+        partitions = [partition for partition in self.get_partitions() if partition >= first]
+        return ",".join(partitions) if len(partitions) > 0 else None
+
+    def ensure_partition(self, partition):
+        """
+        Creates a time partition index (and adds it to the rollover alias) if it doesn't already exist
+        :param partition: index name (from get_partition)
+        :return: index name
+        """
+        if partition not in self.__partitions:
+            with self.__partition_lock:
+                if partition not in self.__partitions:
+                    self.create_if_not_exists(partition)
+                    self.__client.indices.put_alias(partition, self.__alias_name)
+                    self.__partitions.add(partition)
+        return partition
+
+    def retire_partitions(self, older_than, drop=False, max_num_segments=1):
+        """
+        Retires time partitions that only hold data older than a cutoff
+        :param older_than: datetime cutoff (the partition holding this time is kept)
+        :param drop: delete the partitions instead of making them read-only (Default: False)
+        :param max_num_segments: segments to force merge read-only partitions to (Default: 1)
+        :return: list of retired index names
+        """
+        cutoff = self.get_partition(older_than)
+        retired = [partition for partition in self.get_partitions() if partition < cutoff]
+        for partition in retired:
+            if drop:
+                self.__client.indices.delete(partition)
+                self.__partitions.discard(partition)
+                ClientRegistry.invalidate(self.__client_key, "exists:" + partition, "settings:" + partition)
+            else:
+                self.__client.indices.put_settings(index=partition, body={"index": {"blocks": {"write": True}}})
+                self.__client.indices.forcemerge(index=partition, max_num_segments=max_num_segments)
+
+        return retired
+
+    @staticmethod
+    def project(query, source=None, docvalue_fields=None, ids_only=False):
+        """
+        Adds field projection to a query body
+        :param query: ES query body (this is not modified)
+        :param source: _source fields to return: list of fields, dict of includes/excludes or False for none
+            (Default: None - the full _source)
+        :param docvalue_fields: list of fields to read from doc values instead of _source (Default: None)
+        :param ids_only: return no fields at all, only document ids (Default: False)
+        :return: ES query body
+        """
+        if ids_only:
+            source = False
+            docvalue_fields = None
+        if source is None and docvalue_fields is None:
+            return query
+
+        query = dict(query)
+        if source is not None:
+            query["_source"] = source
+        if docvalue_fields is not None:
+            query["docvalue_fields"] = docvalue_fields
+        return query
+
+    @staticmethod
+    def unpack(hit, docvalue_fields=None):
+        """
+        Gets the document from a search hit (doc value fields are merged into the source)
+        :param hit: ES search hit
+        :param docvalue_fields: doc value fields requested (Default: None)
+        :return: dict: source
+        """
+        source = hit.get("_source", {})
+        if docvalue_fields is not None:
+            fields = hit.get("fields", {})
+            for field in docvalue_fields:
+                name = field.get("field") if type(field) is dict else field
+                values = fields.get(name)
+                if values is not None:
+                    source[name] = values[0] if len(values) == 1 else values
+
+        return source
+
+    def scan(self, scroll_ttl='5m', query=None, ids=False, index=None, slices=None, ordered=False, prefetch=1000,
+             source=None, docvalue_fields=None, ids_only=False):
         """
         Read data from the index into a generator
         :param scroll_ttl: ttl for the scroll (must fetch more results before this time expires - set longer for a slow consumer)
         :param query: ES query to submit (Default: match_all)
         :param ids: should the ES document ids be in the result set
         (if True this returns pairs of (id, source) in the result) (Default: False)
+        :param index: index expression to read from (Default: self)
+        :param slices: number of sliced scrolls to read in parallel (Default: None - single scroll)
+        :param ordered: with slices, return each slice in turn instead of as results arrive (Default: False)
+        :param prefetch: with slices, max results buffered ahead of the consumer (per slice if ordered) (Default: 1000)
+        :param source: _source fields to return: list of fields, dict of includes/excludes or False for none
+            (Default: None - the full _source)
+        :param docvalue_fields: list of fields to read from doc values instead of _source (Default: None)
+        :param ids_only: only return the ES document ids (Default: False)
         :return: generator of data
         """
+        index = index if index is not None else self.get_read_index()
         if query is None:
             query = {
                 "query": {
                     "match_all": {}
                 }
             }
+        query = self.project(query, source, docvalue_fields, ids_only)
 
-        results = helpers.scan(self.__client, index=self.__index, doc_type=self.__doc_type, query=query, scroll=scroll_ttl)
-        if ids:
-            return ((byteify(result.get("_id")), byteify(result.get("_source"))) for result in results)
+        if slices is not None and slices > 1:
+            results = self.sliced_scan(index, query, scroll_ttl, slices, ordered=ordered, prefetch=prefetch)
+        else:
+            results = helpers.scan(self.__client, index=index, doc_type=self.__doc_type, query=query, scroll=scroll_ttl,
+                                   ignore_unavailable=True)
+        if ids_only:
+            return (result.get("_id") for result in results)
+        elif ids:
+            return ((result.get("_id"), self.unpack(result, docvalue_fields)) for result in results)
         else:
-            return (byteify(result.get("_source")) for result in results)
+            return (self.unpack(result, docvalue_fields) for result in results)
 
-    def load(self, ids=False):
+    def sliced_scan(self, index, query, scroll_ttl, slices, ordered=False, prefetch=1000):
+        """
+        Reads raw hits with a sliced scroll, one worker thread per slice
+        :param index: index expression to read from
+        :param query: ES query to submit
+        :param scroll_ttl: ttl for each slice's scroll
+        :param slices: number of slices
+        :param ordered: return each slice in turn instead of as results arrive (Default: False)
+        :param prefetch: max hits buffered ahead of the consumer (per slice if ordered) (Default: 1000)
+        :return: generator of hits
+        """
+        stop = threading.Event()
+        done = object()
+        if ordered:
+            queues = [Queue(maxsize=prefetch) for i in range(slices)]
+        else:
+            queues = [Queue(maxsize=prefetch)] * slices
+
+        def put(queue, item):
+            # Blocks while the consumer is behind (backpressure), gives up if the consumer went away
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=1)
+                    return True
+                except Full:
+                    pass
+            return False
+
+        def read_slice(slice_id, queue):
+            error = None
+            try:
+                slice_query = dict(query, slice={"id": slice_id, "max": slices})
+                for hit in helpers.scan(self.__client, index=index, doc_type=self.__doc_type, query=slice_query,
+                                        scroll=scroll_ttl, ignore_unavailable=True):
+                    if not put(queue, hit):
+                        return
+            except Exception as e:
+                error = e
+            put(queue, (done, error))
+
+        threads = [threading.Thread(target=read_slice, args=(i, queues[i])) for i in range(slices)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            remaining = slices
+            for queue in (queues if ordered else queues[:1]):
+                while remaining > 0:
+                    hit = queue.get()
+                    if type(hit) is tuple and hit[0] is done:
+                        if hit[1] is not None:
+                            raise hit[1]
+                        remaining = remaining - 1
+                        if ordered:
+                            break
+                    else:
+                        yield hit
+        finally:
+            stop.set()
+
+    def load(self, ids=False, slices=None, source=None, docvalue_fields=None):
         """
         load data to memory from an elastic search index
         :param ids: should the result be a dictionary keyed on ES doc id's or a list of source (Default: false)
+        :param slices: number of sliced scrolls to read in parallel (Default: None - single scroll)
+        :param source: _source fields to return (see scan) (Default: None - the full _source)
+        :param docvalue_fields: list of fields to read from doc values instead of _source (Default: None)
         :return: a list or dict of source
         """
         if ids:
-            return dict(self.scan(ids=True))
+            return dict(self.scan(ids=True, slices=slices, source=source, docvalue_fields=docvalue_fields))
         else:
-            return list(self.scan())
+            return list(self.scan(slices=slices, source=source, docvalue_fields=docvalue_fields))
 
-    def search_terms(self, terms, numeric_as_min=False):
+    def search_terms(self, terms, numeric_as_min=False, since=None, slices=None, page_size=100, source=None,
+                     docvalue_fields=None, ids_only=False, until=None):
         """
         searches an ES index for a series of terms
         :param terms: a dictionary of attributes to search with either a single or list of terms to match
         :param numeric_as_min: should numbers be treated as min values (or absolute) (Default: False)
+        :param since: only return documents with a timestamp_field at or after this datetime
+            (for a rollover index only the partitions covering this period are read) (Default: None - everything)
+        :param until: only return documents with a timestamp_field before this datetime (Default: None - everything)
+        :param slices: number of sliced scrolls to read in parallel (Default: None - single scroll)
+        :param page_size: run a single plain search and only scroll if there are more hits than this
+            (Default: 100, 0 - always scroll, e.g. for reads known to be large)
+        :param source: _source fields to return (see scan) (Default: None - the full _source)
+        :param docvalue_fields: list of fields to read from doc values instead of _source (Default: None)
+        :param ids_only: only return the ES document ids (Default: False)
         :return: generator of data
         """
+        index = self.get_read_index(since)
+        if index is None:
+            return iter([])
 
-        # Get a list of numeric fields if numbers_as_min set and I don't already have this cached
-        if numeric_as_min and self.__numeric_fields is None:
-            field_mapping = byteify(
-                self.__client.indices.get_mapping(index=self.__index, doc_type=self.__doc_type))
-            field_mapping = field_mapping.get(field_mapping.keys()[0])\
-                .get("mappings")\
-                .get(self.__doc_type)\
-                .get("properties")
-            self.__numeric_fields = [field for field in field_mapping if
-                              field_mapping.get(field).get("type") in ["float", "long", "int"]]
-
+        numeric_fields = self.get_numeric_fields() if numeric_as_min else []
         term_list = []
         for term in terms:
             value = terms.get(term)
-            if numeric_as_min and term in self.__numeric_fields:
+            if term in numeric_fields:
                 if type(value) is list:
                     value = min(value)
 
@@ -167,21 +378,130 @@ class IndexData:
 
                 term_list.append({op: {term: value}})
 
+        if since is not None:
+            term_list.append({"range": {self.__timestamp_field: {"gte": since.strftime('%Y-%m-%dT%H:%M:%S%z')}}})
+        if until is not None:
+            term_list.append({"range": {self.__timestamp_field: {"lt": until.strftime('%Y-%m-%dT%H:%M:%S%z')}}})
+
         query = {"query": {"constant_score": {"filter": {"bool": {"must": term_list}}}}}
         # print "DEBUG QUERY: {}".format(json.dumps(query, indent=4, sort_keys=True))
-        return self.scan(query=query)
+        if page_size > 0:
+            # Small results fit in one page, avoid the scroll setup/cleanup round trips and server side context
+            hits = self.__client.search(index=index, doc_type=self.__doc_type, size=page_size, ignore_unavailable=True,
+                                        body=self.project(query, source, docvalue_fields, ids_only)).get("hits")
+            total = hits.get("total")
+            if type(total) is dict:
+                total = total.get("value")
+            if total <= page_size:
+                if ids_only:
+                    return (hit.get("_id") for hit in hits.get("hits"))
+                return (self.unpack(hit, docvalue_fields) for hit in hits.get("hits"))
+
+        return self.scan(query=query, index=index, slices=slices, source=source, docvalue_fields=docvalue_fields,
+                         ids_only=ids_only)
+
+    def get_numeric_fields(self):
+        """
+        Gets the fields mapped as numbers (treated as minimums by search_terms with numeric_as_min), cached
+        :return: list of field names
+        """
+        if self.__numeric_fields is None:
+            field_mapping = self.__client.indices.get_mapping(index=self.__index, doc_type=self.__doc_type)
+            field_mapping = field_mapping.get(next(iter(field_mapping)))\
+                .get("mappings")\
+                .get(self.__doc_type)\
+                .get("properties")
+            self.__numeric_fields = [field for field in field_mapping if
+                              field_mapping.get(field).get("type") in ["float", "long", "int"]]
+        return self.__numeric_fields
 
-    def get_doc(self, id, default=None):
+    def get_doc(self, id, default=None, source=None):
         """
         Gets a single document
         :param id: ES Document id
+        :param default: value to return if the document does not exist (Default: None)
+        :param source: _source fields to return: list of fields, dict of includes/excludes or False for none
+            (Default: None - the full _source)
         :return: ES Source
         """
+        if self.__rollover is not None:
+            # a get can only address a single index, so look the id up across the partitions
+            body = self.project({"query": {"ids": {"values": [id]}}, "size": 1}, source)
+            hits = self.__client.search(index=self.__index, doc_type=self.__doc_type, ignore_unavailable=True,
+                                        body=body).get("hits").get("hits")
+            return self.unpack(hits[0]) if len(hits) > 0 else default
+
+        params = {}
+        if source is False:
+            params["_source"] = False
+        elif type(source) is dict:
+            if source.get("includes") is not None:
+                params["_source_include"] = source.get("includes")
+            if source.get("excludes") is not None:
+                params["_source_exclude"] = source.get("excludes")
+        elif source is not None:
+            params["_source_include"] = source
+
         try:
-            return byteify(self.__client.get(self.__index, self.__doc_type, id).get("_source"))
+            return self.__client.get(self.get_read_index(), self.__doc_type, id, **params).get("_source", {})
         except NotFoundError:
             return default
 
+    def get_docs(self, ids, source=None, batch_size=1000):
+        """
+        Gets several documents, in one request per batch_size ids
+        :param ids: list of ES Document ids
+        :param source: _source fields to return (see get_doc) (Default: None - the full _source)
+        :param batch_size: ids per request (Default: 1000)
+        :return: dict of id to ES Source (ids that do not exist are left out)
+        """
+        docs = {}
+        for i in range(0, len(ids), batch_size):
+            batch = ids[i:i + batch_size]
+            if self.__rollover is not None:
+                # a get can only address a single index, so look the ids up across the partitions
+                body = self.project({"query": {"ids": {"values": batch}}, "size": len(batch)}, source)
+                hits = self.__client.search(index=self.__index, doc_type=self.__doc_type, ignore_unavailable=True,
+                                            body=body).get("hits").get("hits")
+                docs.update((hit.get("_id"), self.unpack(hit)) for hit in hits)
+            else:
+                # source filtering per doc in the body (the same for every client version)
+                docs_body = [{"_id": id} if source is None else {"_id": id, "_source": source} for id in batch]
+                found = self.__client.mget(body={"docs": docs_body}, index=self.get_read_index(),
+                                           doc_type=self.__doc_type).get("docs")
+                docs.update((doc.get("_id"), doc.get("_source", {})) for doc in found if doc.get("found"))
+        return docs
+
+    def get_versioned(self, id):
+        """
+        Gets a single document with its version, for compare_and_write (reads are real time, no refresh is needed)
+        :param id: ES Document id
+        :return: pair: (ES Source, version) - (None, None) if the document does not exist
+        """
+        self.check_is_not_rollover()
+        try:
+            doc = self.__client.get(self.get_read_index(), self.__doc_type, id)
+        except NotFoundError:
+            return None, None
+        return doc.get("_source", {}), doc.get("_version")
+
+    def compare_and_write(self, data, id, version=None):
+        """
+        Writes a document only if it is unchanged since it was read (optimistic concurrency for documents several
+        processes update, e.g. leases)
+        :param data: source data to write into the index
+        :param id: document id to write to
+        :param version: version from get_versioned (Default: None - create, the document must not exist yet)
+        :return: the new version (None if another writer changed or created the document first)
+        """
+        self.check_is_not_rollover()
+        params = {"op_type": "create"} if version is None else {"version": version}
+        try:
+            return self.__client.index(index=self.__index, doc_type=self.__doc_type, id=id, body=data,
+                                       **params).get("_version")
+        except elasticsearch.exceptions.ConflictError:
+            return None
+
     def purge_alias_index(self, ttl=86400):
         """
         purges old indexes that used to be tied to an alias (used for A/B replacement index usage)
@@ -195,11 +515,30 @@ class IndexData:
             if index == self.__index or index == alias_index:
                 continue
 
-            settings = byteify(self.__client.indices.get_settings(index=index)).get(index)
+            settings = self.__client.indices.get_settings(index=index).get(index)
             creation_date = self.get_index_creation_date(settings=settings)
             index_age = to_epoch(datetime.datetime.now()) - to_epoch(creation_date)
             if index_age > ttl:
                 self.__client.indices.delete(index)
+                ClientRegistry.invalidate(self.__client_key, "exists:" + index, "settings:" + index)
+
+    def delete_index(self, index=None):
+        """
+        Deletes an index
+        :param index: index name (Default: self - every partition of a rollover index)
+        :return: None
+        """
+        if index is None and self.__rollover is not None:
+            # the alias goes with its last partition
+            for partition in self.get_partitions():
+                self.delete_index(partition)
+                self.__partitions.discard(partition)
+            ClientRegistry.invalidate(self.__client_key, "alias_exists:" + self.__alias_name)
+            return
+
+        index = index if index is not None else self.__index
+        self.__client.indices.delete(index)
+        ClientRegistry.invalidate(self.__client_key, "exists:" + index, "settings:" + index)
 
     def get_index(self):
         """Returns the index name"""
@@ -209,6 +548,22 @@ class IndexData:
         """returns the ES client"""
         return self.__client
 
+    def cached(self, name, fetch):
+        """
+        Gets index metadata through the process wide cache (shared by every IndexData on the same cluster)
+        :param name: metadata name (e.g. "exists:<index>")
+        :param fetch: function to fetch the value from ES on a miss
+        :return: metadata value
+        """
+        return ClientRegistry.cached(self.__client_key, name, fetch)
+
+    def pool_stats(self):
+        """
+        Reports connection pool usage of this index's (shared) client
+        :return: list of dicts, one per node connection (see ClientRegistry.stats)
+        """
+        return ClientRegistry.stats(self.__client_key)
+
     def get_next_alias_index(self):
         """Gets the next index name for a given alias (used for A/B replacement index usage)"""
         self.check_is_alias()
@@ -248,6 +603,8 @@ class IndexData:
                     ]})
 
         self.__client.indices.put_alias(self.__index, self.__alias_name)
+        ClientRegistry.invalidate(self.__client_key, "alias_exists:" + self.__alias_name,
+                                  "alias_index:" + self.__alias_name)
 
     def check_is_alias(self):
         """Ensure that the alias provided really is an alias, not an index (or raise Exception)"""
@@ -261,6 +618,23 @@ class IndexData:
         """
         return self.__alias
 
+    def check_is_rollover(self):
+        """Ensure that this index is partitioned by time (or raise Exception)"""
+        if self.__rollover is None:
+            raise ValueError("Index requested is not a rollover index: {}".format(self.__index))
+
+    def check_is_not_rollover(self):
+        """raises an error if the index is partitioned by time (documents can not be addressed by id alone)"""
+        if self.__rollover is not None:
+            raise ValueError("Index requested is a rollover index: {}".format(self.__index))
+
+    def is_rollover(self):
+        """
+        Check if the current object is configured as a time partitioned rollover index
+        :return: boolean
+        """
+        return self.__rollover is not None
+
     def create_if_not_exists(self, index=None):
         """
         Creates an index if it doesn't already exist in ES
@@ -268,11 +642,18 @@ class IndexData:
         :return: None
         """
         index = index if index is not None else self.__index
-        if not self.__client.indices.exists(index):
+        if not self.cached("exists:" + index, lambda: self.__client.indices.exists(index)):
             self.created = True
-            self.__client.indices.create(index=index,
-                                         body={"mappings": {self.__doc_type: self.__index_mappings, "_default_": self.__default},
-                                               "settings": self.__index_settings})
+            try:
+                self.__client.indices.create(index=index,
+                                             body={"mappings": {self.__doc_type: self.__index_mappings, "_default_": self.__default},
+                                                   "settings": self.__index_settings})
+            except elasticsearch.exceptions.RequestError as e:
+                # created since the existence check was cached
+                if e.error != "resource_already_exists_exception":
+                    raise
+                self.created = False
+            ClientRegistry.invalidate(self.__client_key, "exists:" + index)
         else:
             self.created = False
 
@@ -283,20 +664,122 @@ class IndexData:
         :param id: document id to write to (Default: None - auto id)
         :return: None
         """
-        for key in data:
+        index = self.__index
+        if self.__rollover is not None:
+            index = self.ensure_partition(self.get_partition(data.get(self.__timestamp_field)))
+
+        for key in list(data.keys()):
             if isinstance(data.get(key), datetime.datetime):
                 data[key] = data.pop(key).strftime('%Y-%m-%dT%H:%M:%S%z')
+
+        if self.__bulk_buffer is not None:
+            action = {"_index": index, "_type": self.__doc_type, "_source": data}
+            if id is not None:
+                action["_id"] = id
+
+            with self.__bulk_lock:
+                self.__bulk_buffer.append(action)
+                full = len(self.__bulk_buffer) >= self.__bulk_size
+            Instrumentation.count("index.docs")
+            if full:
+                self.flush()
+            return
+
         try:
-            request = {"index": self.__index, "doc_type": self.__doc_type, "body": data}
+            request = {"index": index, "doc_type": self.__doc_type, "body": data}
             if id is not None:
                 request["id"] = id
 
-            self.__client.index(**request)
+            with Instrumentation.stage("index.write"):
+                self.__client.index(**request)
+            Instrumentation.count("index.docs")
         except elasticsearch.exceptions.RequestError as e:
             eprint("bad doc: {}".format(data))
             eprint(e)
             exit(1)
 
+    def write_many(self, documents):
+        """
+        Writes documents in bulk requests (without the setting changes of begin_bulk_load, for indexes being read)
+        :param documents: iterable of pairs: (id or None for an auto id, source)
+        :return: None
+        """
+        actions = []
+        for id, data in documents:
+            index = self.__index
+            if self.__rollover is not None:
+                index = self.ensure_partition(self.get_partition(data.get(self.__timestamp_field)))
+
+            for key in list(data.keys()):
+                if isinstance(data.get(key), datetime.datetime):
+                    data[key] = data.pop(key).strftime('%Y-%m-%dT%H:%M:%S%z')
+
+            action = {"_index": index, "_type": self.__doc_type, "_source": data}
+            if id is not None:
+                action["_id"] = id
+            actions.append(action)
+
+        if actions:
+            try:
+                with Instrumentation.stage("index.bulk"):
+                    helpers.bulk(self.__client, actions)
+                Instrumentation.count("index.docs", len(actions))
+                Instrumentation.count("index.bulk_requests")
+            except helpers.BulkIndexError as e:
+                eprint("bad docs: {}".format(e.errors[:10]))
+                exit(1)
+
+    def begin_bulk_load(self, buffer_size=500):
+        """
+        Prepares the (write) index for a bulk load: turns off refresh and replicas and buffers writes into bulk requests
+        (use on an index nothing reads from yet, e.g. one from get_next_alias_index, and finish with end_bulk_load)
+        :param buffer_size: documents per bulk request (Default: 500)
+        :return: None
+        """
+        settings = self.__client.indices.get_settings(index=self.__index).get(self.__index)\
+            .get("settings").get("index")
+        self.__bulk_restore = {
+            "refresh_interval": settings.get("refresh_interval"),
+            "number_of_replicas": settings.get("number_of_replicas")
+        }
+        self.__client.indices.put_settings(index=self.__index,
+                                           body={"index": {"refresh_interval": "-1", "number_of_replicas": 0}})
+        self.__bulk_size = buffer_size
+        self.__bulk_buffer = []
+
+    def flush(self):
+        """
+        Sends any buffered bulk load writes to ES
+        :return: None
+        """
+        with self.__bulk_lock:
+            actions = self.__bulk_buffer
+            self.__bulk_buffer = [] if actions is not None else None
+
+        if actions:
+            try:
+                with Instrumentation.stage("index.bulk"):
+                    helpers.bulk(self.__client, actions)
+                Instrumentation.count("index.bulk_requests")
+            except helpers.BulkIndexError as e:
+                eprint("bad docs: {}".format(e.errors[:10]))
+                exit(1)
+
+    def end_bulk_load(self, max_num_segments=1):
+        """
+        Finishes a bulk load: writes what is buffered, restores refresh and replica settings and force merges the index
+        :param max_num_segments: segments to force merge the index to (Default: 1)
+        :return: None
+        """
+        self.flush()
+        self.__bulk_buffer = None
+        if self.__bulk_restore is not None:
+            # a None setting resets it to the cluster default
+            self.__client.indices.put_settings(index=self.__index, body={"index": self.__bulk_restore})
+            self.__bulk_restore = None
+        self.__client.indices.refresh(index=self.__index)
+        self.__client.indices.forcemerge(index=self.__index, max_num_segments=max_num_segments)
+
     def dump(self, data):
         """
         Unpacks a data iterable and writes data to ES
@@ -311,3 +794,17 @@ class IndexData:
                 self.write(data.get(id), id=id)
         else:
             self.write(data)
+
+
+def open_index(url, index, **kwargs):
+    """
+    Opens an index on the backend the URL points to
+    :param url: "sqlite://<path>" for an embedded LocalIndexData, otherwise ES URL (or list of URL's) for IndexData
+    :param index: Name of the index to present
+    :param kwargs: IndexData constructor arguments
+    :return: IndexData or LocalIndexData
+    """
+    urls = url if type(url) is list else [url]
+    if len(urls) == 1 and isinstance(urls[0], str) and urls[0].startswith(LocalIndexData.scheme):
+        return LocalIndexData(urls[0], index, **kwargs)
+    return IndexData(url, index, **kwargs)
@@ -1,10 +1,14 @@
-import requests
 import json
+import ijson
 import re
 import time
 import os
 import stat
-from bs4 import BeautifulSoup
+import struct
+import marshal
+import zlib
+import tempfile
+from .InstanceRecord import InstanceRecord, intern_value
 from .common import *
 
 
@@ -16,13 +20,20 @@ class InstanceMap:
     __minRegions = 10
     __regionUrl = 'https://docs.aws.amazon.com/AmazonRDS/latest/UserGuide/Concepts.RegionsAndAvailabilityZones.html'
     __pricingJson = 'https://pricing.us-east-1.amazonaws.com/offers/v1.0/aws/AmazonEC2/current/index.json'
+    __downloadChunkSize = 1024 * 1024
+    # Snapshot header: magic, snapshot schema version, marshal version, source stamp, payload length, payload crc32
+    __snapshotHeader = struct.Struct('<4sHHQII')
+    __snapshotMagic = b'IMAP'
+    __snapshotVersion = 1
 
-    def __init__(self, file=None, elastic_index=None, ttl=86400):
+    def __init__(self, file=None, elastic_index=None, ttl=86400, snapshot=None):
         """
         Create a new Instance Map for Instance Lookup
         :param file: filename to write cache json to (mutex w/ elastic_index)
         :param elastic_index: IndexData object to write to (mutex w/ file)
         :param ttl: TTL in seconds for the local cache json before re-creating (default 86400)
+        :param snapshot: filename of the binary snapshot cache
+            (Default: cache json name with a .snap extension for a file, no snapshot for an index)
         """
 
         if file is not None and elastic_index is not None:
@@ -30,12 +41,19 @@ class InstanceMap:
         self.__elastic_index = elastic_index
         self.__mapFile = file
         self.__ttl = ttl
+        if snapshot is None and file is not None:
+            snapshot = os.path.splitext(file)[0] + '.snap'
+        self.__snapshotFile = snapshot
         self.instances = self.load()
         self.instanceTypes = self.load_types()
         self.regions = self.load_regions()
     
     def get_region_map(self):
-        html = requests.get(self.__regionUrl).content
+        # requests and BeautifulSoup are only needed to rebuild the map, not to load it from the cache
+        import requests
+        from bs4 import BeautifulSoup
+
+        html = requests.get(self.__regionUrl).text
         tableid = re.search('<table id="([^"]*)"', html).groups(0)[0] 
         soup = BeautifulSoup(html, "lxml")
         #table = soup.find("table", attrs={"id": self.__regionTableId})
@@ -47,7 +65,7 @@ class InstanceMap:
         regions = {}
         for row in table.find_all("tr")[1:]:
             region = dict(zip(headings, (td.get_text() for td in row.find_all("td"))))
-            regions[region.get('region name')] = byteify(region).get('region')
+            regions[region.get('region name')] = region.get('region')
 
         # arbitrary test to make sure we didn't completely fail on parsing data
         if len(regions.keys()) < self.__minRegions:
@@ -74,14 +92,51 @@ class InstanceMap:
         """
         return key.split('~')
 
+    @classmethod
+    def compact(cls, instances):
+        """
+        Converts a "<region>~<instance>" keyed dict of attribute dicts (cache/ES format) to the in memory format
+        :param instances: dict of attributes keyed on build_key
+        :return: dict of InstanceRecord keyed on (region, instance) tuples
+        """
+        return dict((tuple(intern_value(part) for part in cls.split_key(key)), InstanceRecord(attributes))
+                    for key, attributes in instances.items())
+
+    def expand(self):
+        """
+        Converts this map back to the "<region>~<instance>" keyed dict of attribute dicts used for the cache/ES
+        :return: dict of attributes keyed on build_key
+        """
+        return dict((self.build_key(*key), record.to_dict()) for key, record in self.instances.items())
+
     def get(self, region, instance):
         """
         Simple get from a loaded instance map
         :param region: region name (e.g. us-west-1)
         :param instance: instance name (e.g. r3.xlarge)
-        :return: dict: attributes
+        :return: InstanceRecord: attributes (immutable)
         """
-        return self.instances.get(self.build_key(region, instance))
+        return self.instances.get((region, instance))
+
+    def resolve(self, row):
+        """
+        Fills in the full Attributes of a reference enriched spot price row from this map
+        (denormalized attributes already on the row are kept)
+        :param row: spot price row (dict) with an InstanceKey (or Region and InstanceType)
+        :return: the row
+        """
+        key = row.get('InstanceKey')
+        if key is None:
+            attributes = self.get(row.get('Region'), row.get('InstanceType'))
+        else:
+            attributes = self.get(*self.split_key(key))
+
+        if attributes is not None:
+            resolved = attributes.to_dict(exclude=('Region', 'InstanceType'))
+            resolved.update(row.get('Attributes', {}))
+            row['Attributes'] = resolved
+
+        return row
 
     def get_types(self):
         """Returns a list of instance types"""
@@ -93,7 +148,7 @@ class InstanceMap:
 
     def keys(self):
         """Returns the set of region/instance pairs that are known"""
-        return [self.split_key(key) for key in self.instances.keys()]
+        return list(self.instances.keys())
 
     def __iter__(self):
         return iter(self.keys())
@@ -102,19 +157,105 @@ class InstanceMap:
         """Loads InstanceMap from either cache file or from source data based on TTL and file age"""
         if self.__mapFile is not None:
             if os.path.isfile(self.__mapFile):
-                file_age = time.time() - os.stat(self.__mapFile)[stat.ST_MTIME]
-                if file_age < self.__ttl:
+                file_mtime = os.stat(self.__mapFile)[stat.ST_MTIME]
+                if time.time() - file_mtime < self.__ttl:
+                    instances = self.read_snapshot(file_mtime)
+                    if instances is not None:
+                        eprint("Fetching instance map from snapshot")
+                        return instances
+
                     with open(self.__mapFile) as json_data:
                         eprint("Fetching instance map from cache")
-                        return byteify(json.load(json_data))
+                        instances = self.compact(json.load(json_data))
+                    self.write_snapshot(instances, file_mtime)
+                    return instances
         elif self.__elastic_index is not None:
-            index_age = to_epoch(datetime.datetime.now()) - to_epoch(self.__elastic_index.creation_date)
+            creation_epoch = to_epoch(self.__elastic_index.creation_date)
+            index_age = to_epoch(datetime.datetime.now()) - creation_epoch
             if index_age < self.__ttl and not self.__elastic_index.created:
+                instances = self.read_snapshot(creation_epoch)
+                if instances is not None:
+                    eprint("Fetching instance map from snapshot")
+                    return instances
+
                 eprint("Fetching instance map from cache")
-                return self.__elastic_index.load(ids=True)
+                instances = self.compact(self.__elastic_index.load(ids=True))
+                self.write_snapshot(instances, creation_epoch)
+                return instances
 
         eprint("Cache not found or to old, re-fetching instance data")
-        return self.fetch()
+        instances = self.compact(self.fetch())
+        if self.__mapFile is not None:
+            self.write_snapshot(instances, os.stat(self.__mapFile)[stat.ST_MTIME])
+        else:
+            self.write_snapshot(instances, to_epoch(self.__elastic_index.get_index_creation_date()))
+        return instances
+
+    def read_snapshot(self, stamp):
+        """
+        Reads the binary snapshot cache
+        :param stamp: epoch of the source the snapshot must have been built from (cache json mtime or index creation)
+        :return: dict of InstanceRecord keyed on (region, instance) - None if there is no valid snapshot
+        """
+        if self.__snapshotFile is None or not os.path.isfile(self.__snapshotFile):
+            return None
+
+        with open(self.__snapshotFile, 'rb') as snapshot:
+            header = snapshot.read(self.__snapshotHeader.size)
+            if len(header) != self.__snapshotHeader.size:
+                eprint("Instance map snapshot truncated, ignoring: {}".format(self.__snapshotFile))
+                return None
+
+            magic, version, marshal_version, source_stamp, length, checksum = self.__snapshotHeader.unpack(header)
+            if magic != self.__snapshotMagic or version != self.__snapshotVersion \
+                    or marshal_version != marshal.version:
+                eprint("Instance map snapshot format not supported, ignoring: {}".format(self.__snapshotFile))
+                return None
+            if source_stamp != int(stamp):
+                return None
+
+            payload = snapshot.read(length)
+
+        if len(payload) != length or zlib.crc32(payload) & 0xffffffff != checksum:
+            eprint("Instance map snapshot checksum mismatch, ignoring: {}".format(self.__snapshotFile))
+            return None
+
+        schemas, records = marshal.loads(payload)
+        return dict(((region, instance), InstanceRecord.from_packed(schemas[schema], values))
+                    for region, instance, schema, values in records)
+
+    def write_snapshot(self, instances, stamp):
+        """
+        Writes the binary snapshot cache (atomic write)
+        :param instances: dict of InstanceRecord keyed on (region, instance)
+        :param stamp: epoch of the source the snapshot is built from (cache json mtime or index creation)
+        :return: None
+        """
+        if self.__snapshotFile is None:
+            return
+
+        schemas = []
+        schema_ids = {}
+        records = []
+        for (region, instance), record in instances.items():
+            fields, values = record.packed()
+            if fields not in schema_ids:
+                schema_ids[fields] = len(schemas)
+                schemas.append(fields)
+            records.append((region, instance, schema_ids[fields], values))
+
+        payload = marshal.dumps((tuple(schemas), tuple(records)))
+        header = self.__snapshotHeader.pack(self.__snapshotMagic, self.__snapshotVersion, marshal.version, int(stamp),
+                                            len(payload), zlib.crc32(payload) & 0xffffffff)
+        try:
+            with open(self.__snapshotFile + '.tmp', 'wb') as outfile:
+                outfile.write(header)
+                outfile.write(payload)
+
+            # Rename to remove .tmp (atomic write)
+            os.rename(self.__snapshotFile + '.tmp', self.__snapshotFile)
+        except (IOError, OSError) as e:
+            eprint("Unable to write instance map snapshot: {}".format(e))
    
     def load_types(self):
         """Gets the distinct list of instance types from the set of keys in this InstanceMap"""
@@ -134,97 +275,131 @@ class InstanceMap:
 
         return list(regions)
 
+    def download_offers(self):
+        """
+        Streams the EC2 pricing offer file to a temporary file (the file is too large to hold in memory)
+        :return: temporary filename (caller is responsible for removing it)
+        """
+        import requests
+
+        fd, filename = tempfile.mkstemp(prefix='ec2_offers_', suffix='.json')
+        try:
+            with os.fdopen(fd, 'wb') as outfile:
+                response = requests.get(self.__pricingJson, stream=True)
+                response.raise_for_status()
+                for chunk in response.iter_content(chunk_size=self.__downloadChunkSize):
+                    outfile.write(chunk)
+        except Exception:
+            os.remove(filename)
+            raise
+
+        return filename
+
+    def parse_product(self, attributes, regions):
+        """
+        Converts the attributes of a single offer file product into an InstanceMap entry
+        :param attributes: product attributes from the offer file (dict)
+        :param regions: map of location name to region name (from get_region_map)
+        :return: pair: (key, attributes) - returns None if the product is not a usable instance
+        """
+        location = attributes.pop('location', None)
+        region = regions.get(location)
+        if 'vcpu' not in attributes or region is None:
+            return None
+
+        # attributes we are going to process
+        instance_type = attributes.pop('instanceType', None)
+        attributes['InstanceType'] = instance_type
+        attributes['Region'] = region
+        features = attributes.pop('processorFeatures', None)
+        storage = attributes.pop('storage', None)
+        memory = attributes.pop('memory', None)
+
+        # remove un-needed attributes
+        attributes.pop('locationType', None)
+        attributes.pop('operatingSystem', None)
+        attributes.pop('operation', None)
+        attributes.pop('preInstalledSw', None)
+        attributes.pop('servicecode', None)
+        attributes.pop('servicename', None)
+        attributes.pop('usagetype', None)
+
+        # change type to number
+        ecu = attributes.pop('ecu', None)
+        try:
+            attributes['ecu'] = float(ecu)
+        except ValueError:
+            pass
+        normalization_size_factor = attributes.pop('normalizationSizeFactor', None)
+        try:
+            attributes['normalizationSizeFactor'] = int(normalization_size_factor)
+        except ValueError:
+            pass
+        attributes['vcpu'] = int(attributes.get('vcpu'))
+
+        # generate the table key
+        key = self.build_key(region, instance_type)
+
+        if features is not None:
+            attributes['processorFeatures'] = [feature.strip() for feature in self.__splitter.split(features)]
+
+        # Parse storage info
+        if storage is None:
+            attributes['storageType'] = 'None'
+        elif 'EBS' in storage:
+            attributes['storageType'] = 'EBS'
+        elif 'x' in storage:
+            storage_features = [feature.strip() for feature in self.__storageSplitter.match(storage).groups()]
+            attributes['driveQuantity'] = int(storage_features[0])
+            attributes['driveSize'] = float(storage_features[1].replace(',', ''))
+            if storage_features[2] == '':
+                attributes['storageType'] = 'Unknown'
+            else:
+                attributes['storageType'] = storage_features[2]
+        else:
+            attributes['storageType'] = 'None'
+
+        # Parse memory info
+        memory_features = (memory + ' ').split(' ')
+        try:
+            memory_unit = memory_features[1]
+            memory_size = float(memory_features[0])
+
+            if memory_unit == "MiB":
+                memory_size = memory_size / 1024.0
+                memory_unit = "GiB"
+            elif memory_unit == "TiB":
+                memory_size = memory_size * 1024.0
+                memory_unit = "GiB"
+
+            attributes['memorySize'] = memory_size
+            attributes['memorySizeUnit'] = memory_unit
+        except ValueError:
+            pass
+
+        # Parse clockspeed
+        try:
+            attributes['clockSpeed'] = float(attributes.get('clockSpeed', 'NA').split(' ')[0])
+        except ValueError:
+            pass
+
+        return key, attributes
+
     def fetch(self):
         """Creates an InstanceMap from source data and saves to disk cache as JSON"""
         regions = self.get_region_map()
-        json_data = requests.get(self.__pricingJson).content
-        products = json.loads(json_data).get('products')
-        
+        offer_file = self.download_offers()
+
         instances = {}
-        for product in products:
-            attributes = byteify(products.get(product).get('attributes'))
-            location = attributes.pop('location', None)
-            region = regions.get(location)
-            if 'vcpu' not in attributes or region is None:
-                continue
-         
-            # attributes we are going to process
-            instance_type = attributes.pop('instanceType', None)
-            attributes['InstanceType'] = instance_type
-            attributes['Region'] = region
-            features = attributes.pop('processorFeatures', None)
-            storage = attributes.pop('storage', None)
-            memory = attributes.pop('memory', None)
-        
-            # remove un-needed attributes
-            attributes.pop('locationType', None)
-            attributes.pop('operatingSystem', None)
-            attributes.pop('operation', None)
-            attributes.pop('preInstalledSw', None)
-            attributes.pop('servicecode', None)
-            attributes.pop('servicename', None)
-            attributes.pop('usagetype', None)
-        
-            # change type to number
-            ecu = attributes.pop('ecu', None)
-            try:
-                attributes['ecu'] = float(ecu)
-            except ValueError:
-                pass
-            normalization_size_factor = attributes.pop('normalizationSizeFactor', None)
-            try:
-                attributes['normalizationSizeFactor'] = int(normalization_size_factor)
-            except ValueError:
-                pass
-            attributes['vcpu'] = int(attributes.get('vcpu'))
-        
-            # generate the table key
-            key = self.build_key(region, instance_type)
-        
-            if features is not None:
-                attributes['processorFeatures'] = [feature.strip() for feature in self.__splitter.split(features)]
-        
-            # Parse storage info
-            if storage is None:
-                attributes['storageType'] = 'None'
-            elif 'EBS' in storage:
-                attributes['storageType'] = 'EBS'
-            elif 'x' in storage:
-                storage_features = [feature.strip() for feature in self.__storageSplitter.match(storage).groups()]
-                attributes['driveQuantity'] = int(storage_features[0])
-                attributes['driveSize'] = float(storage_features[1].replace(',', ''))
-                if storage_features[2] == '':
-                    attributes['storageType'] = 'Unknown'
-                else:
-                    attributes['storageType'] = storage_features[2]
-            else:
-                attributes['storageType'] = 'None'
-        
-            # Parse memory info
-            memory_features = (memory + ' ').split(' ')
-            try:
-                memory_unit = memory_features[1]
-                memory_size = float(memory_features[0])
-
-                if memory_unit == "MiB":
-                    memory_size = memory_size / 1024.0
-                    memory_unit = "GiB"
-                elif memory_unit == "TiB":
-                    memory_size = memory_size * 1024.0
-                    memory_unit = "GiB"
-
-                attributes['memorySize'] = memory_size
-                attributes['memorySizeUnit'] = memory_unit
-            except ValueError:
-                pass
-        
-            # Parse clockspeed
-            try:
-                attributes['clockSpeed'] = float(attributes.get('clockSpeed', 'NA').split(' ')[0])
-            except ValueError:
-                pass
-        
-            instances[key] = attributes
+        try:
+            with open(offer_file, 'rb') as offers:
+                # Parse one product at a time so memory is bounded by the size of the map, not the offer file
+                for sku, product in ijson.kvitems(offers, 'products'):
+                    entry = self.parse_product(product.get('attributes', {}), regions)
+                    if entry is not None:
+                        instances[entry[0]] = entry[1]
+        finally:
+            os.remove(offer_file)
 
         if self.__mapFile is not None:
             # Write json to cache file .tmp
@@ -0,0 +1,94 @@
+from collections.abc import Mapping
+from sys import intern
+
+
+class InstanceRecord(Mapping):
+    """
+    Immutable, compact attribute record for a single InstanceMap entry
+
+    Field names are stored once per distinct set of attributes (schema) and shared by every record with that
+    schema, string values are interned and lists are stored as tuples.
+    """
+    __slots__ = ("__schema", "__values")
+    __schemas = {}
+
+    def __init__(self, attributes):
+        """
+        Constructor
+        :param attributes: dict of instance attributes
+        """
+        fields = tuple(sorted(intern_value(field) for field in attributes))
+        self.__schema = self.get_schema(fields)
+        self.__values = tuple(intern_value(attributes.get(field)) for field in fields)
+
+    @classmethod
+    def from_packed(cls, fields, values):
+        """
+        Builds a record from the output of packed (used for fast snapshot loads)
+        :param fields: sorted tuple of field names
+        :param values: tuple of (already interned) values in field order
+        :return: InstanceRecord
+        """
+        record = cls.__new__(cls)
+        record.__schema = cls.get_schema(fields)
+        record.__values = values
+        return record
+
+    def packed(self):
+        """
+        Returns the record as plain tuples (used for fast snapshot writes)
+        :return: pair: (fields, values)
+        """
+        return self.__schema[0], self.__values
+
+    @classmethod
+    def get_schema(cls, fields):
+        """
+        Gets the shared schema for a tuple of field names
+        :param fields: sorted tuple of field names
+        :return: pair: (fields, dict of field name to value position)
+        """
+        schema = cls.__schemas.get(fields)
+        if schema is None:
+            schema = (fields, dict((field, i) for i, field in enumerate(fields)))
+            cls.__schemas[fields] = schema
+
+        return schema
+
+    def __getitem__(self, field):
+        return self.__values[self.__schema[1][field]]
+
+    def __contains__(self, field):
+        return field in self.__schema[1]
+
+    def __iter__(self):
+        return iter(self.__schema[0])
+
+    def __len__(self):
+        return len(self.__values)
+
+    def __repr__(self):
+        return "InstanceRecord({})".format(self.to_dict())
+
+    def to_dict(self, exclude=()):
+        """
+        Converts the record to a plain dict (e.g. for JSON or ES output)
+        :param exclude: fields to leave out (Default: none)
+        :return: dict of attributes
+        """
+        return dict((field, list(value) if type(value) is tuple else value)
+                    for field, value in zip(self.__schema[0], self.__values) if field not in exclude)
+
+
+def intern_value(value):
+    """
+    Interns strings (and the strings in lists) so repeated attribute values share memory
+    :param value: attribute value
+    :return: interned value (lists are returned as tuples)
+    """
+    if type(value) is str:
+        return intern(value)
+    elif type(value) is list or type(value) is tuple:
+        return tuple(intern_value(element) for element in value)
+    else:
+        return value
@@ -0,0 +1,248 @@
+import cProfile
+import heapq
+import json
+import pstats
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from .common import *
+
+
+class Instrumentation:
+    """
+    Process wide stage timers, counters and slowest key reports
+
+    Stages record wall and CPU (thread) time and nest per thread: time is counted in the innermost stage only, so e.g.
+    the scroll read while parsing rows is not counted in the parse as well. Timed iterators count the time spent
+    producing each item as a stage, for the lazily chained reads and conversions of the history. Optionally a cProfile
+    of every thread is kept as well (see start_profile).
+    """
+    __stages = {}
+    __counters = {}
+    __slowest = {}
+    __lock = threading.Lock()
+    __local = threading.local()
+    __started = time.time()
+    __cpu_started = time.process_time()
+    __profiles = None
+    slowest_keys = 10
+
+    @classmethod
+    def reset(cls):
+        """Clears every timer, counter and key report"""
+        with cls.__lock:
+            cls.__stages = {}
+            cls.__counters = {}
+            cls.__slowest = {}
+            cls.__started = time.time()
+            cls.__cpu_started = time.process_time()
+
+    @classmethod
+    def __enter(cls):
+        """Starts timing a stage on the calling thread: returns the stage frame (start times and time of inner stages)"""
+        stack = getattr(cls.__local, "stack", None)
+        if stack is None:
+            stack = cls.__local.stack = []
+        frame = [time.perf_counter(), time.thread_time(), 0.0, 0.0]
+        stack.append(frame)
+        return frame
+
+    @classmethod
+    def __exit(cls, frame):
+        """Stops timing a stage: returns pair: (wall, CPU) seconds spent in the stage and not in inner stages"""
+        wall = time.perf_counter() - frame[0]
+        cpu = time.thread_time() - frame[1]
+        stack = cls.__local.stack
+        stack.pop()
+        if len(stack) > 0:
+            stack[-1][2] += wall
+            stack[-1][3] += cpu
+        return wall - frame[2], cpu - frame[3]
+
+    @classmethod
+    def add(cls, name, wall, cpu, calls=1):
+        """
+        Adds time to a stage
+        :param name: stage name (e.g. history.scroll)
+        :param wall: wall seconds
+        :param cpu: CPU seconds
+        :param calls: number of times the stage ran (Default: 1)
+        :return: None
+        """
+        with cls.__lock:
+            totals = cls.__stages.get(name)
+            if totals is None:
+                totals = cls.__stages[name] = [0, 0.0, 0.0]
+            totals[0] += calls
+            totals[1] += wall
+            totals[2] += cpu
+
+    @classmethod
+    @contextmanager
+    def stage(cls, name):
+        """
+        Times the enclosed block as a stage
+        :param name: stage name
+        :return: context manager
+        """
+        frame = cls.__enter()
+        try:
+            yield
+        finally:
+            (wall, cpu) = cls.__exit(frame)
+            cls.add(name, wall, cpu)
+
+    @classmethod
+    def timed(cls, name, iterable, counter=None):
+        """
+        Times producing the items of an iterable as a stage (one call per item)
+        :param name: stage name
+        :param iterable: iterable to time
+        :param counter: counter to count the items in (Default: None - not counted)
+        :return: generator of the items
+        """
+        iterator = iter(iterable)
+        (calls, wall, cpu) = (0, 0.0, 0.0)
+        try:
+            while True:
+                frame = cls.__enter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    (item_wall, item_cpu) = cls.__exit(frame)
+                    wall += item_wall
+                    cpu += item_cpu
+                calls += 1
+                yield item
+        finally:
+            cls.add(name, wall, cpu, calls)
+            if counter is not None:
+                cls.count(counter, calls)
+
+    @classmethod
+    def count(cls, name, n=1):
+        """
+        Adds to a counter
+        :param name: counter name (e.g. history.rows)
+        :param n: amount to add (Default: 1)
+        :return: None
+        """
+        with cls.__lock:
+            cls.__counters[name] = cls.__counters.get(name, 0) + n
+
+    @classmethod
+    def record_key(cls, category, key, seconds):
+        """
+        Records the time a key took, only the slowest_keys slowest per category are kept
+        :param category: report name (e.g. train)
+        :param key: key name (e.g. the bid key)
+        :param seconds: time taken
+        :return: None
+        """
+        with cls.__lock:
+            slowest = cls.__slowest.setdefault(category, [])
+            if len(slowest) < cls.slowest_keys:
+                heapq.heappush(slowest, (seconds, key))
+            elif seconds > slowest[0][0]:
+                heapq.heapreplace(slowest, (seconds, key))
+
+    @classmethod
+    @contextmanager
+    def timed_key(cls, category, key):
+        """
+        Times the enclosed block (wall time, inner stages included) for the slowest key report
+        :param category: report name
+        :param key: key name
+        :return: context manager
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            cls.record_key(category, key, time.perf_counter() - started)
+
+    @classmethod
+    def summary(cls):
+        """
+        Gets the instrumentation totals since the start (or reset)
+        :return: dict: wall_seconds, cpu_seconds (process), stages (name to calls, wall and cpu seconds), counters
+            and slowest (report name to list of [key, seconds], slowest first)
+        """
+        with cls.__lock:
+            return {
+                "wall_seconds": round(time.time() - cls.__started, 3),
+                "cpu_seconds": round(time.process_time() - cls.__cpu_started, 3),
+                "stages": dict((name, {"calls": calls, "wall": round(wall, 3), "cpu": round(cpu, 3)})
+                               for name, (calls, wall, cpu) in sorted(cls.__stages.items())),
+                "counters": dict(sorted(cls.__counters.items())),
+                "slowest": dict((category, [[key, round(seconds, 3)] for (seconds, key) in sorted(slowest, reverse=True)])
+                                for category, slowest in cls.__slowest.items())
+            }
+
+    @classmethod
+    def report(cls):
+        """
+        Logs the stages by wall time and the counters
+        :return: None
+        """
+        summary = cls.summary()
+        eprint("Run: {} wall seconds, {} CPU seconds".format(summary["wall_seconds"], summary["cpu_seconds"]))
+        for name, totals in sorted(summary["stages"].items(), key=lambda item: -item[1]["wall"]):
+            eprint("Stage {}: {} calls, {} wall seconds, {} CPU seconds".format(name, totals["calls"], totals["wall"],
+                                                                                  totals["cpu"]))
+        for name, value in summary["counters"].items():
+            eprint("Count {}: {}".format(name, value))
+
+    @classmethod
+    def start_profile(cls):
+        """
+        Starts a cProfile of the calling thread and of every thread started after this
+        :return: None
+        """
+        cls.__profiles = []
+
+        def start_thread_profile(*args):
+            # the first profile event of a new thread hands it over to a profile of its own (the threading hook stays
+            # set for the threads started later, write_profile clears it)
+            sys.setprofile(None)
+            cls.__enable_profile()
+
+        threading.setprofile(start_thread_profile)
+        cls.__enable_profile()
+
+    @classmethod
+    def __enable_profile(cls):
+        """Enables a cProfile on the calling thread"""
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # only one profiler at a time on Python versions with a process wide profiler
+            return
+        with cls.__lock:
+            cls.__profiles.append(profile)
+
+    @classmethod
+    def write_profile(cls, prefix):
+        """
+        Writes the run's JSON summary to <prefix>.json and the merged profile (see start_profile) to <prefix>.prof (for
+        pstats, snakeviz etc.), and logs the report
+        :param prefix: output path prefix (None - nothing is written)
+        :return: None
+        """
+        if prefix is None:
+            return
+
+        if cls.__profiles is not None:
+            threading.setprofile(None)
+            [profile.disable() for profile in cls.__profiles]
+            stats = pstats.Stats(*cls.__profiles)
+            stats.dump_stats(prefix + ".prof")
+            cls.__profiles = None
+
+        with open(prefix + ".json", "w") as out:
+            json.dump(cls.summary(), out, indent=4)
+        cls.report()
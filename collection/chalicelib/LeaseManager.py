@@ -0,0 +1,260 @@
+import os
+import random
+import socket
+import threading
+import time
+from .common import *
+
+
+class LeaseManager:
+    """
+    Work unit leases for training a run across several processes or hosts
+
+    Each unit of a run (e.g. an instance type) has a lease document in a shared index, claimed with a compare and write
+    so exactly one worker holds it. Holders heartbeat their leases to extend the expiry: the lease of a worker that
+    crashed or hung expires and is claimed again by another worker. Trained units are marked done, units that failed
+    max_attempts times are marked failed, and the run is complete when every unit is one or the other.
+    """
+    __final = ["done", "failed"]
+
+    def __init__(self, lease_index, run, owner=None, ttl=300, heartbeat=60, poll=30, max_attempts=3):
+        """
+        Constructor
+        :param lease_index: IndexData (or LocalIndexData) shared by the workers of the run
+        :param run: run id, leases of other runs are ignored (e.g. the date of a nightly training)
+        :param owner: name of this worker in the leases (Default: None - host:pid)
+        :param ttl: seconds a lease lasts without a heartbeat (Default: 300)
+        :param heartbeat: seconds between heartbeats, well below ttl (Default: 60)
+        :param poll: seconds to wait for units held by other workers before checking again (Default: 30)
+        :param max_attempts: claims of a unit before it is given up as failed (Default: 3)
+        """
+        self.__lease_index = lease_index
+        self.run = run
+        self.owner = owner if owner is not None else "{}:{}".format(socket.gethostname(), os.getpid())
+        self.ttl = ttl
+        self.heartbeat = heartbeat
+        self.poll = poll
+        self.max_attempts = max_attempts
+
+        self.__held = {}
+        self.__finished = set()
+        self.__lock = threading.Lock()
+        self.__unit_locks = {}
+        self.__stop = threading.Event()
+
+    def get_lease_id(self, unit):
+        """ Generates the lease document id for a unit """
+        return "{}~{}".format(self.run, unit)
+
+    def get_unit_lock(self, unit):
+        """
+        Gets the lock serializing the updates of a held lease (the heartbeat thread's renew and the worker's release
+        write against the same lease version)
+        :param unit: unit name
+        :return: threading.RLock
+        """
+        with self.__lock:
+            return self.__unit_locks.setdefault(unit, threading.RLock())
+
+    def claim(self, unit):
+        """
+        Claims a unit if it is free (never claimed, released or expired)
+        :param unit: unit name
+        :return: boolean: claimed
+        """
+        (lease, version) = self.__lease_index.get_versioned(self.get_lease_id(unit))
+        now = time.time()
+        if lease is not None:
+            if lease.get("state") in self.__final:
+                with self.__lock:
+                    self.__finished.add(unit)
+                return False
+            if lease.get("expires", 0) > now:
+                return False
+            if lease.get("state") == "running":
+                if lease.get("attempts", 0) >= self.max_attempts:
+                    # the unit keeps taking its workers down (crash, OOM kill), stop handing it out
+                    eprint("Giving up on {} after {} attempts, the lease held by {} expired".format(
+                        unit, lease.get("attempts"), lease.get("owner")))
+                    failed = dict(lease, state="failed", heartbeat=now, expires=0)
+                    if self.__lease_index.compare_and_write(failed, self.get_lease_id(unit), version) is not None:
+                        with self.__lock:
+                            self.__finished.add(unit)
+                    return False
+                eprint("Lease on {} held by {} expired, reclaiming".format(unit, lease.get("owner")))
+
+        lease = {
+            "run": self.run,
+            "unit": unit,
+            "owner": self.owner,
+            "state": "running",
+            "attempts": (lease.get("attempts", 0) if lease is not None else 0) + 1,
+            "claimed": now,
+            "heartbeat": now,
+            "expires": now + self.ttl
+        }
+        version = self.__lease_index.compare_and_write(lease, self.get_lease_id(unit), version)
+        if version is None:
+            return False
+
+        with self.__lock:
+            self.__held[unit] = (lease, version)
+        return True
+
+    def update(self, unit, **fields):
+        """
+        Updates a held lease
+        :param unit: unit name
+        :param fields: lease fields to change
+        :return: boolean: False if the lease was lost (expired and claimed by another worker)
+        """
+        with self.get_unit_lock(unit):
+            with self.__lock:
+                held = self.__held.get(unit)
+            if held is None:
+                return False
+
+            lease = dict(held[0], **fields)
+            version = self.__lease_index.compare_and_write(lease, self.get_lease_id(unit), held[1])
+            with self.__lock:
+                if version is None or lease.get("state") != "running":
+                    self.__held.pop(unit, None)
+                else:
+                    self.__held[unit] = (lease, version)
+        if version is None:
+            eprint("Lease on {} was lost".format(unit))
+        return version is not None
+
+    def renew(self, unit):
+        """
+        Extends a held lease
+        :param unit: unit name
+        :return: boolean: False if the lease was lost
+        """
+        now = time.time()
+        return self.update(unit, heartbeat=now, expires=now + self.ttl)
+
+    def release(self, unit, done=True):
+        """
+        Releases a held lease
+        :param unit: unit name
+        :param done: the unit is trained (Default: True), otherwise it is free to claim again (or failed after
+            max_attempts)
+        :return: boolean: False if the lease was lost
+        """
+        with self.get_unit_lock(unit):
+            with self.__lock:
+                held = self.__held.get(unit)
+            if done:
+                state = "done"
+            elif held is not None and held[0].get("attempts", 0) >= self.max_attempts:
+                eprint("Giving up on {} after {} attempts".format(unit, held[0].get("attempts")))
+                state = "failed"
+            else:
+                state = "free"
+            released = self.update(unit, state=state, heartbeat=time.time(), expires=0)
+        if released and state in self.__final:
+            with self.__lock:
+                self.__finished.add(unit)
+        return released
+
+    def heartbeat_leases(self):
+        """
+        Renews every held lease until stop is called (runs in its own thread)
+        :return: None
+        """
+        while not self.__stop.wait(self.heartbeat):
+            with self.__lock:
+                units = list(self.__held)
+            [self.renew(unit) for unit in units]
+
+    def next_unit(self, units):
+        """
+        Claims the next free unit
+        :param units: list of unit names in the run
+        :return: pair: (claimed unit or None, number of units not finished yet)
+        """
+        with self.__lock:
+            pending = [unit for unit in units if unit not in self.__finished]
+        # workers start at different units, so they rarely race for the same lease
+        random.shuffle(pending)
+        for unit in pending:
+            if self.claim(unit):
+                return unit, len(pending)
+
+        with self.__lock:
+            return None, len([unit for unit in pending if unit not in self.__finished])
+
+    def process_units(self, units, process):
+        """
+        Claims and processes units until the run is complete (units held by other workers are waited for, and
+        reclaimed if their leases expire)
+        :param units: list of unit names in the run
+        :param process: function called with each claimed unit
+        :return: number of units processed
+        """
+        count = 0
+        while not self.__stop.is_set():
+            (unit, pending) = self.next_unit(units)
+            if unit is None:
+                if pending == 0:
+                    break
+                self.__stop.wait(self.poll)
+                continue
+
+            try:
+                process(unit)
+                self.release(unit, done=True)
+                count += 1
+            except Exception as e:
+                eprint("Processing {} failed: {}".format(unit, e))
+                self.release(unit, done=False)
+
+        return count
+
+    def run_units(self, units, process, workers=1):
+        """
+        Works through the units of the run with worker threads, heartbeating the leases they hold
+        :param units: list of unit names in the run (every worker of the run should get the same list)
+        :param process: function called with each claimed unit
+        :param workers: units processed concurrently (Default: 1)
+        :return: number of units processed here
+        """
+        units = [str(unit) for unit in units]
+        beat = threading.Thread(target=self.heartbeat_leases)
+        beat.daemon = True
+        beat.start()
+
+        counts = []
+        threads = [threading.Thread(target=lambda: counts.append(self.process_units(units, process)))
+                   for _ in range(workers)]
+        [thread.start() for thread in threads]
+        [thread.join() for thread in threads]
+
+        self.__stop.set()
+        beat.join()
+        return sum(counts)
+
+    def get_status(self, units):
+        """
+        Gets the lease state of every unit in the run
+        :param units: list of unit names in the run
+        :return: dict of state (unclaimed, running, expired, free, done or failed) to number of units
+        """
+        now = time.time()
+        status = {}
+        for unit in units:
+            (lease, version) = self.__lease_index.get_versioned(self.get_lease_id(unit))
+            if lease is None:
+                state = "unclaimed"
+            elif lease.get("state") == "running" and lease.get("expires", 0) <= now:
+                state = "expired"
+            else:
+                state = lease.get("state")
+            status[state] = status.get(state, 0) + 1
+
+        return status
+
+    def stop(self):
+        """Stops claiming units, units in processing finish"""
+        self.__stop.set()
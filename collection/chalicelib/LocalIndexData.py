@@ -0,0 +1,616 @@
+import sqlite3
+import threading
+import datetime
+import json
+import time
+import uuid
+import re
+from .Instrumentation import Instrumentation
+from .common import *
+
+
+class LocalIndexData:
+    """
+    Embedded (SQLite) stand-in for IndexData, for small deployments, tests and benchmarks
+
+    Documents are stored as JSON with a row per (flattened) field value in a term table indexed on keyword and numeric
+    values, so search_terms is answered from indexes in process. Aliases (A/B replacement) are kept in their own table
+    and resolved on every read, so an update_alias is seen by readers immediately.
+    """
+    scheme = "sqlite://"
+    __schema = [
+        "CREATE TABLE IF NOT EXISTS indices (name TEXT PRIMARY KEY, doc_type TEXT, created REAL, settings TEXT, "
+        "mappings TEXT)",
+        "CREATE TABLE IF NOT EXISTS aliases (alias TEXT PRIMARY KEY, name TEXT)",
+        "CREATE TABLE IF NOT EXISTS docs (idx TEXT, id TEXT, version INTEGER, timestamp TEXT, source TEXT, "
+        "PRIMARY KEY (idx, id))",
+        "CREATE INDEX IF NOT EXISTS docs_timestamp ON docs (idx, timestamp)",
+        "CREATE TABLE IF NOT EXISTS terms (idx TEXT, id TEXT, field TEXT, kval TEXT, nval REAL)",
+        "CREATE INDEX IF NOT EXISTS terms_keyword ON terms (idx, field, kval)",
+        "CREATE INDEX IF NOT EXISTS terms_numeric ON terms (idx, field, nval)",
+        "CREATE INDEX IF NOT EXISTS terms_doc ON terms (idx, id)",
+    ]
+    __range_operators = {"gte": ">=", "gt": ">", "lte": "<=", "lt": "<"}
+
+    def __init__(self, url, index, doc_type="doc", connection_options={}, index_settings={}, index_mappings=None,
+                 alias=False, rollover=None, timestamp_field="Timestamp"):
+        """
+        Constructor
+        :param url: database URL: "sqlite://<path>" (e.g. sqlite:///var/lib/spot/spot.db or sqlite://spot.db)
+        :param index: Name of the index to present
+        :param doc_type: document type name to present from the index (Default: doc)
+        :param connection_options: ignored (ES client options)
+        :param index_settings: storage settings, kept with the index (Default: Empty)
+        :param index_mappings: field mappings, kept with the index (Default: None)
+        :param alias: is the provided "index" name really an alias (or should it be - on creation)
+        :param rollover: ignored, time filtered reads use the timestamp index instead of partitions
+        :param timestamp_field: field indexed for time filtered reads (Default: Timestamp)
+        """
+        if type(url) is list:
+            url = url[0]
+        if not url.startswith(self.scheme):
+            raise ValueError("Invalid local index URL: {}".format(url))
+
+        self.__path = url[len(self.scheme):]
+        self.__local = threading.local()
+        self.__doc_type = doc_type
+        self.__index_settings = index_settings
+        self.__index_mappings = index_mappings if index_mappings is not None else {"properties": {}}
+        self.__timestamp_field = timestamp_field
+        self.__numeric_fields = None
+
+        with self.get_client() as connection:
+            for statement in self.__schema:
+                connection.execute(statement)
+
+        alias_exists = self.get_alias_target(index) is not None
+        self.__alias = alias_exists or alias
+        if alias_exists:
+            self.created = False
+            self.__alias_name = index
+            self.__index = self.get_alias_index()
+        elif alias:
+            self.__alias_name = index
+            self.__index = "{}-1".format(index)
+            self.create_if_not_exists()
+            self.update_alias()
+        else:
+            self.__index = index
+            self.create_if_not_exists()
+
+        self.creation_date = self.get_index_creation_date()
+
+    def get_client(self):
+        """returns the SQLite connection for the calling thread"""
+        connection = getattr(self.__local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.__path, timeout=60, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.__local.connection = connection
+        return connection
+
+    def pool_stats(self):
+        """No connection pools for an embedded index"""
+        return []
+
+    def get_index_creation_date(self, index=None, settings=None):
+        """
+        Retrieves an indexes creation timestamp
+        :param index: index name to lookup (Default: self)
+        :param settings: ignored
+        :return: creation datetime
+        """
+        index = index if index is not None else self.__index
+        row = self.get_client().execute("SELECT created FROM indices WHERE name = ?", (index,)).fetchone()
+        return from_epoch(row[0])
+
+    def get_alias_target(self, alias):
+        """
+        Gets the index an alias points to
+        :param alias: alias name
+        :return: index name (None if the alias does not exist)
+        """
+        row = self.get_client().execute("SELECT name FROM aliases WHERE alias = ?", (alias,)).fetchone()
+        return str(row[0]) if row is not None else None
+
+    def get_alias_index(self):
+        """get the index behind an alias (used for A/B replacement index usage)"""
+        self.check_is_alias()
+        return self.get_alias_target(self.__alias_name)
+
+    def get_read_index(self, since=None):
+        """
+        Gets the index to read from (aliases are resolved on every read)
+        :param since: ignored
+        :return: index name
+        """
+        if self.__alias:
+            return self.get_alias_index()
+        return self.__index
+
+    def check_is_rollover(self):
+        """Local indexes are never partitioned by time"""
+        raise ValueError("Index requested is not a rollover index: {}".format(self.__index))
+
+    def is_rollover(self):
+        """Local indexes are never partitioned by time"""
+        return False
+
+    def scan(self, scroll_ttl='5m', query=None, ids=False, index=None, slices=None, ordered=False, prefetch=1000,
+             source=None, docvalue_fields=None, ids_only=False):
+        """
+        Read data from the index into a generator
+        :param scroll_ttl: ignored
+        :param query: ES query of match_all or term, terms and range filters (see get_query_conditions)
+            (Default: match_all)
+        :param ids: should the document ids be in the result set
+        (if True this returns pairs of (id, source) in the result) (Default: False)
+        :param index: index to read from (Default: self)
+        :param slices: ignored
+        :param ordered: ignored
+        :param prefetch: ignored
+        :param source: fields to return: list of fields, dict of includes/excludes or False for none
+            (Default: None - the full document)
+        :param docvalue_fields: list of extra fields to return (Default: None)
+        :param ids_only: only return the document ids (Default: False)
+        :return: generator of data
+        """
+        index = index if index is not None else self.get_read_index()
+        (conditions, params) = self.get_query_conditions(index, query)
+        return self.select(index, conditions, params, ids=ids, source=source, docvalue_fields=docvalue_fields,
+                           ids_only=ids_only)
+
+    def get_query_conditions(self, index, query):
+        """
+        Translates an ES query to select conditions: match_all, or the term, terms and range filters (in a bool or
+        constant_score query) that IndexData.search_terms builds
+        :param index: index name
+        :param query: ES query (None - match_all)
+        :return: pair: (list of conditions, list of parameters)
+        """
+        query = query.get("query", {"match_all": {}}) if query is not None else {"match_all": {}}
+        if "constant_score" in query:
+            query = query.get("constant_score").get("filter", {"match_all": {}})
+        if "bool" in query:
+            clauses = []
+            for occur, occur_clauses in query.get("bool").items():
+                if occur not in ["must", "filter"]:
+                    raise ValueError("Local indexes only support must and filter bool clauses, not {}".format(occur))
+                clauses.extend(occur_clauses if type(occur_clauses) is list else [occur_clauses])
+        else:
+            clauses = [query]
+
+        conditions = []
+        params = []
+        for clause in clauses:
+            if len(clause) != 1:
+                raise ValueError("Invalid query clause: {}".format(clause))
+            (op, spec) = next(iter(clause.items()))
+            if op == "match_all":
+                continue
+            if op not in ["term", "terms", "range"] or len(spec) != 1:
+                raise ValueError("Local indexes only support match_all, term, terms and range queries, not {}"
+                                 .format(clause))
+
+            (field, value) = next(iter(spec.items()))
+            if op == "range":
+                for (bound, limit) in value.items():
+                    if bound not in self.__range_operators:
+                        raise ValueError("Unsupported range bound: {}".format(bound))
+                    if field == self.__timestamp_field:
+                        conditions.append("timestamp {} ?".format(self.__range_operators[bound]))
+                        params.append(limit)
+                    else:
+                        conditions.append("id IN (SELECT id FROM terms WHERE idx = ? AND field = ? AND nval {} ?)"
+                                          .format(self.__range_operators[bound]))
+                        params.extend([index, field, limit])
+            else:
+                (condition, condition_params) = self.get_term_condition(index, field, value)
+                conditions.append(condition)
+                params.extend(condition_params)
+
+        return conditions, params
+
+    def get_term_condition(self, index, term, value):
+        """
+        Builds the select condition matching a field to one or any of several values
+        :param index: index name
+        :param term: field name
+        :param value: value or list of values
+        :return: pair: (condition, list of parameters)
+        """
+        values = value if type(value) is list else [value]
+        keywords = [self.keyword(v) for v in values]
+        numbers = [n for n in (self.number(v) for v in values) if n is not None]
+        match = "kval IN ({})".format(",".join("?" * len(keywords)))
+        if len(numbers) > 0:
+            match = "({} OR nval IN ({}))".format(match, ",".join("?" * len(numbers)))
+        return ("id IN (SELECT id FROM terms WHERE idx = ? AND field = ? AND {})".format(match),
+                [index, term] + keywords + numbers)
+
+    def load(self, ids=False, slices=None, source=None, docvalue_fields=None):
+        """
+        load data to memory from the index
+        :param ids: should the result be a dictionary keyed on doc id's or a list of source (Default: false)
+        :param slices: ignored
+        :param source: fields to return (see scan) (Default: None - the full document)
+        :param docvalue_fields: list of extra fields to return (Default: None)
+        :return: a list or dict of source
+        """
+        if ids:
+            return dict(self.scan(ids=True, source=source, docvalue_fields=docvalue_fields))
+        else:
+            return list(self.scan(source=source, docvalue_fields=docvalue_fields))
+
+    def search_terms(self, terms, numeric_as_min=False, since=None, slices=None, page_size=100, source=None,
+                     docvalue_fields=None, ids_only=False, until=None):
+        """
+        searches the index for a series of terms
+        :param terms: a dictionary of attributes to search with either a single or list of terms to match
+        :param numeric_as_min: should numbers be treated as min values (or absolute) (Default: False)
+        :param since: only return documents with a timestamp_field at or after this datetime (Default: None - everything)
+        :param until: only return documents with a timestamp_field before this datetime (Default: None - everything)
+        :param slices: ignored
+        :param page_size: ignored
+        :param source: fields to return (see scan) (Default: None - the full document)
+        :param docvalue_fields: list of extra fields to return (Default: None)
+        :param ids_only: only return the document ids (Default: False)
+        :return: generator of data
+        """
+        index = self.get_read_index()
+
+        numeric_fields = self.get_numeric_fields() if numeric_as_min else []
+        conditions = []
+        params = []
+        for term in terms:
+            value = terms.get(term)
+            values = value if type(value) is list else [value]
+            if term in numeric_fields:
+                conditions.append("id IN (SELECT id FROM terms WHERE idx = ? AND field = ? AND nval >= ?)")
+                params.extend([index, term, min(values)])
+            else:
+                (condition, condition_params) = self.get_term_condition(index, term, values)
+                conditions.append(condition)
+                params.extend(condition_params)
+
+        if since is not None:
+            conditions.append("timestamp >= ?")
+            params.append(since.strftime('%Y-%m-%dT%H:%M:%S%z'))
+        if until is not None:
+            conditions.append("timestamp < ?")
+            params.append(until.strftime('%Y-%m-%dT%H:%M:%S%z'))
+
+        return self.select(index, conditions, params, source=source, docvalue_fields=docvalue_fields,
+                           ids_only=ids_only)
+
+    def select(self, index, conditions, params, ids=False, source=None, docvalue_fields=None, ids_only=False):
+        """
+        Reads documents matching SQL conditions on the docs table
+        :param index: index name
+        :param conditions: list of SQL conditions (ANDed)
+        :param params: SQL parameters for the conditions
+        :param ids: return pairs of (id, source) (Default: False)
+        :param source: fields to return (see scan) (Default: None - the full document)
+        :param docvalue_fields: list of extra fields to return (Default: None)
+        :param ids_only: only return the document ids (Default: False)
+        :return: generator of data
+        """
+        sql = "SELECT id{} FROM docs WHERE {}".format("" if ids_only else ", source",
+                                                     " AND ".join(["idx = ?"] + conditions))
+        cursor = self.get_client().execute(sql, [index] + params)
+        if ids_only:
+            return (str(row[0]) for row in cursor)
+        elif ids:
+            return ((str(row[0]), self.project(row[1], source, docvalue_fields)) for row in cursor)
+        else:
+            return (self.project(row[1], source, docvalue_fields) for row in cursor)
+
+    @staticmethod
+    def project(document, source=None, docvalue_fields=None):
+        """
+        Decodes a stored document and applies field projection
+        :param document: JSON document
+        :param source: fields to return (see scan) (Default: None - the full document)
+        :param docvalue_fields: list of extra fields to return (Default: None)
+        :return: dict: source
+        """
+        document = json.loads(document)
+        if source is None:
+            return document
+
+        if source is False:
+            includes, excludes = [], []
+        elif type(source) is dict:
+            includes, excludes = source.get("includes"), source.get("excludes", [])
+        else:
+            includes, excludes = source, []
+
+        if includes is not None:
+            includes = list(includes) + [field.get("field") if type(field) is dict else field
+                                         for field in (docvalue_fields or [])]
+        return dict((field, value) for field, value in document.items()
+                    if (includes is None or field in includes) and field not in excludes)
+
+    def get_numeric_fields(self):
+        """
+        Gets the fields stored with numeric values, like an ES dynamic mapping (treated as minimums by search_terms with
+        numeric_as_min), cached
+        :return: list of field names
+        """
+        if self.__numeric_fields is None:
+            self.__numeric_fields = [str(row[0]) for row in self.get_client().execute(
+                "SELECT DISTINCT field FROM terms WHERE idx = ? AND nval IS NOT NULL", (self.get_read_index(),))]
+        return self.__numeric_fields
+
+    def get_doc(self, id, default=None, source=None):
+        """
+        Gets a single document
+        :param id: Document id
+        :param default: value to return if the document does not exist (Default: None)
+        :param source: fields to return (see scan) (Default: None - the full document)
+        :return: Source
+        """
+        row = self.get_client().execute("SELECT source FROM docs WHERE idx = ? AND id = ?",
+                                        (self.get_read_index(), id)).fetchone()
+        return self.project(row[0], source) if row is not None else default
+
+    def get_docs(self, ids, source=None, batch_size=500):
+        """
+        Gets several documents
+        :param ids: list of Document ids
+        :param source: fields to return (see scan) (Default: None - the full document)
+        :param batch_size: ids per query (Default: 500)
+        :return: dict of id to Source (ids that do not exist are left out)
+        """
+        index = self.get_read_index()
+        docs = {}
+        for i in range(0, len(ids), batch_size):
+            batch = ids[i:i + batch_size]
+            rows = self.get_client().execute("SELECT id, source FROM docs WHERE idx = ? AND id IN ({})".format(
+                ",".join("?" * len(batch))), [index] + list(batch)).fetchall()
+            docs.update((str(id), self.project(doc, source)) for (id, doc) in rows)
+        return docs
+
+    def get_versioned(self, id):
+        """
+        Gets a single document with its version, for compare_and_write
+        :param id: Document id
+        :return: pair: (Source, version) - (None, None) if the document does not exist
+        """
+        row = self.get_client().execute("SELECT source, version FROM docs WHERE idx = ? AND id = ?",
+                                        (self.get_read_index(), id)).fetchone()
+        return (self.project(row[0]), row[1]) if row is not None else (None, None)
+
+    def compare_and_write(self, data, id, version=None):
+        """
+        Writes a document only if it is unchanged since it was read (optimistic concurrency, safe across processes
+        sharing the database)
+        :param data: source data to write into the index
+        :param id: document id to write to
+        :param version: version from get_versioned (Default: None - create, the document must not exist yet)
+        :return: the new version (None if another writer changed or created the document first)
+        """
+        index = self.__index
+        id = str(id)
+        timestamp = data.get(self.__timestamp_field)
+        timestamp = timestamp if isinstance(timestamp, str) else None
+        with self.get_client() as connection:
+            if version is None:
+                cursor = connection.execute(
+                    "INSERT OR IGNORE INTO docs (idx, id, version, timestamp, source) VALUES (?, ?, 1, ?, ?)",
+                    (index, id, timestamp, json.dumps(data)))
+            else:
+                cursor = connection.execute(
+                    "UPDATE docs SET version = version + 1, timestamp = ?, source = ? "
+                    "WHERE idx = ? AND id = ? AND version = ?", (timestamp, json.dumps(data), index, id, version))
+            if cursor.rowcount == 0:
+                return None
+
+            connection.execute("DELETE FROM terms WHERE idx = ? AND id = ?", (index, id))
+            connection.executemany("INSERT INTO terms (idx, id, field, kval, nval) VALUES (?, ?, ?, ?, ?)",
+                                   self.terms(index, id, data))
+        return 1 if version is None else version + 1
+
+    def purge_alias_index(self, ttl=86400):
+        """
+        purges old indexes that used to be tied to an alias (used for A/B replacement index usage)
+        :param ttl: how long to wait before removing an index that used to be tied to the alias (Default: 86400)
+        :return: None
+        """
+        self.check_is_alias()
+        alias_index = self.get_alias_index()
+        rows = self.get_client().execute("SELECT name, created FROM indices WHERE name LIKE ?",
+                                         (self.__alias_name + "-%",)).fetchall()
+        for index, created in rows:
+            if index == self.__index or index == alias_index:
+                continue
+
+            if time.time() - created > ttl:
+                self.delete_index(str(index))
+
+    def delete_index(self, index=None):
+        """
+        Deletes an index and its documents
+        :param index: index name (Default: self)
+        :return: None
+        """
+        index = index if index is not None else self.__index
+        with self.get_client() as connection:
+            connection.execute("DELETE FROM terms WHERE idx = ?", (index,))
+            connection.execute("DELETE FROM docs WHERE idx = ?", (index,))
+            connection.execute("DELETE FROM aliases WHERE name = ?", (index,))
+            connection.execute("DELETE FROM indices WHERE name = ?", (index,))
+
+    def get_index(self):
+        """Returns the index name"""
+        return self.__index
+
+    def get_next_alias_index(self):
+        """Gets the next index name for a given alias (used for A/B replacement index usage)"""
+        self.check_is_alias()
+
+        index = None
+        if re.match("^{}-\\d+$".format(self.__alias_name), self.__index) is not None:
+            i = int(re.sub("^{}-".format(self.__alias_name), "", self.__index))
+        else:
+            i = 0
+
+        while index is None:
+            i = i + 1
+            index = "{}-{}".format(self.__alias_name, i)
+            if self.exists(index):
+                index = None
+            else:
+                self.__index = index
+                self.create_if_not_exists()
+
+        return index
+
+    def update_alias(self):
+        """
+        Updates the alias to point to the current index
+        (to be used after populating a new index created by get_next_alias_index)
+        (used for A/B replacement index usage)
+        """
+        self.check_is_alias()
+        with self.get_client() as connection:
+            connection.execute("INSERT OR REPLACE INTO aliases (alias, name) VALUES (?, ?)",
+                               (self.__alias_name, self.__index))
+
+    def check_is_alias(self):
+        """Ensure that the alias provided really is an alias, not an index (or raise Exception)"""
+        if not self.__alias:
+            raise ValueError("Index requested not an alias: {}".format(self.__index))
+
+    def is_alias(self):
+        """
+        Check if the current object is configured as an alias
+        :return: boolean
+        """
+        return self.__alias
+
+    def exists(self, index):
+        """
+        Check if an index exists
+        :param index: index name
+        :return: boolean
+        """
+        return self.get_client().execute("SELECT 1 FROM indices WHERE name = ?", (index,)).fetchone() is not None
+
+    def create_if_not_exists(self, index=None):
+        """
+        Creates an index if it doesn't already exist
+        :param index: index name to create
+        :return: None
+        """
+        index = index if index is not None else self.__index
+        with self.get_client() as connection:
+            cursor = connection.execute(
+                "INSERT OR IGNORE INTO indices (name, doc_type, created, settings, mappings) VALUES (?, ?, ?, ?, ?)",
+                (index, self.__doc_type, time.time(), json.dumps(self.__index_settings),
+                 json.dumps(self.__index_mappings)))
+            self.created = cursor.rowcount > 0
+
+    @staticmethod
+    def keyword(value):
+        """Gets the keyword representation of a value (as matched by term searches)"""
+        if type(value) is bool:
+            return "true" if value else "false"
+        return value if isinstance(value, str) else json.dumps(value)
+
+    @staticmethod
+    def number(value):
+        """Gets the numeric representation of a value (None if it is not a number)"""
+        if type(value) is bool:
+            return None
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None
+
+    def terms(self, index, id, data, prefix=""):
+        """
+        Flattens a document into term rows (nested fields are dotted, list values get a row per element)
+        :param index: index name
+        :param id: document id
+        :param data: document (dict)
+        :param prefix: field name prefix for nested documents
+        :return: generator of (idx, id, field, kval, nval)
+        """
+        for key, value in data.items():
+            field = prefix + key
+            if type(value) is dict:
+                for term in self.terms(index, id, value, field + "."):
+                    yield term
+                continue
+
+            for element in (value if type(value) is list else [value]):
+                if element is None or type(element) is dict:
+                    continue
+                if isinstance(element, (int, float)) and type(element) is not bool:
+                    yield (index, id, field, None, float(element))
+                else:
+                    yield (index, id, field, self.keyword(element), None)
+
+    def write_many(self, documents):
+        """
+        Writes documents into the index in a single transaction
+        :param documents: iterable of pairs: (id or None for an auto id, source)
+        :return: None
+        """
+        index = self.__index
+        with Instrumentation.stage("index.write"), self.get_client() as connection:
+            for id, data in documents:
+                for key in list(data.keys()):
+                    if isinstance(data.get(key), datetime.datetime):
+                        data[key] = data.pop(key).strftime('%Y-%m-%dT%H:%M:%S%z')
+                id = str(id) if id is not None else uuid.uuid4().hex
+                timestamp = data.get(self.__timestamp_field)
+
+                connection.execute("DELETE FROM terms WHERE idx = ? AND id = ?", (index, id))
+                connection.execute(
+                    "INSERT OR REPLACE INTO docs (idx, id, version, timestamp, source) VALUES "
+                    "(?, ?, COALESCE((SELECT version FROM docs WHERE idx = ? AND id = ?), 0) + 1, ?, ?)",
+                    (index, id, index, id, timestamp if isinstance(timestamp, str) else None, json.dumps(data)))
+                connection.executemany("INSERT INTO terms (idx, id, field, kval, nval) VALUES (?, ?, ?, ?, ?)",
+                                       self.terms(index, id, data))
+                Instrumentation.count("index.docs")
+
+    def begin_bulk_load(self, buffer_size=500):
+        """Nothing to prepare, local writes are already transactional (kept for the IndexData interface)"""
+        pass
+
+    def flush(self):
+        """Nothing is buffered locally (kept for the IndexData interface)"""
+        pass
+
+    def end_bulk_load(self, max_num_segments=1):
+        """
+        Finishes a bulk load by compacting the database
+        :param max_num_segments: ignored
+        :return: None
+        """
+        self.get_client().execute("PRAGMA optimize")
+
+    def write(self, data, id=None):
+        """
+        Writes data into the index
+        :param data: source data to write into the index
+        :param id: document id to write to (Default: None - auto id)
+        :return: None
+        """
+        self.write_many([(id, data)])
+
+    def dump(self, data):
+        """
+        Unpacks a data iterable and writes data to the index
+        :param data: data to write to the index (dictionary will use the dictionary key as the doc id)
+        :return: None
+        """
+        if type(data) is list:
+            self.write_many((None, row) for row in data)
+        elif type(data) is dict:
+            self.write_many(data.items())
+        else:
+            self.write(data)
@@ -1,35 +1,92 @@
 import numpy as np
 import pandas as pd
 import scipy.stats as stats
+from scipy import sparse
+import itertools
 import sklearn
 import glob, os
-from common import eprint
-from sklearn.linear_model import LinearRegression
+from .common import eprint
 
 
 class SpotBidPredictor:
+    """
+    Linear spot price model over one-hot encoded instance type, region and OS
+
+    Trains out of core: the data generator is read in chunks, category codes are assigned as new values are seen and
+    each chunk only adds to the normal equations (X'X and X'y), so memory is bounded by the chunk size and the number
+    of categories rather than by the size of the history.
+    """
+    category_fields = ['InstanceType', 'Region', 'ProductDescription']
 
-    _lm_model = None
+    _coef = None
     _az_category_code = None
     _os_category_code = None
     _type_category_code = None
 
-    def __init__(self, data_generator):
-        # Init a predictor
-        eprint("Converting data to DataFrame")
-        self._int_df = pd.DataFrame(data_generator)
-        eprint("Setting Target")
-        self._target_price = self._int_df['SpotPrice']
-        eprint("Pre-Processing")
-        self._pre_process_train_data()
-        eprint("Training")
+    def __init__(self, data_generator, chunk_size=100000):
+        """
+        Constructor (trains the model)
+        :param data_generator: iterable of dicts, fields: InstanceType, Region, ProductDescription, SpotPrice
+        :param chunk_size: rows read and encoded at a time (Default: 100000)
+        """
+        self._type_category_code = {}
+        self._az_category_code = {}
+        self._os_category_code = {}
+        # column 0 is the intercept, every category value gets its own column after that
+        self._n_features = 1
+        self._xtx = np.zeros((1, 1))
+        self._xty = np.zeros(1)
+        self._rows = 0
+
+        eprint("Streaming training data")
+        data_generator = iter(data_generator)
+        for chunk in iter(lambda: list(itertools.islice(data_generator, chunk_size)), []):
+            self.partial_fit(chunk)
+        eprint("Training on {} rows, {} features".format(self._rows, self._n_features))
         self.train()
 
+    def partial_fit(self, rows):
+        """
+        Adds a chunk of training rows to the normal equations (call train to update the model)
+        :param rows: list of dicts, fields: InstanceType, Region, ProductDescription, SpotPrice
+        :return: None
+        """
+        df = pd.DataFrame(rows, columns=self.category_fields + ['SpotPrice'])
+        n = len(df)
+        if n == 0:
+            return
+
+        width = len(self.category_fields) + 1
+        columns = np.zeros((n, width), dtype=np.int64)
+        for i, (field, codes) in enumerate(zip(self.category_fields, self._get_category_codes())):
+            for value in pd.unique(df[field].values):
+                if value not in codes:
+                    codes[value] = self._n_features
+                    self._n_features += 1
+            columns[:, i + 1] = df[field].map(codes).values
+
+        if self._n_features > len(self._xty):
+            grow = self._n_features - len(self._xty)
+            self._xtx = np.pad(self._xtx, ((0, grow), (0, grow)), 'constant')
+            self._xty = np.pad(self._xty, (0, grow), 'constant')
+
+        X = self._design_matrix(columns)
+        y = df['SpotPrice'].values.astype(float)
+        self._xtx += (X.T @ X).toarray()
+        self._xty += X.T @ y
+        self._rows += n
+
     def train(self):
-        self._lm_model = LinearRegression()
-        X = self._train_data.drop('SpotPrice', axis=1)
-        Y = self._target_price
-        self._lm_model.fit(X,Y)
+        """
+        Solves the normal equations for the rows seen so far (least norm solution, the one-hot columns of each field
+        are collinear with the intercept)
+        :return: None
+        """
+        self._coef = np.linalg.lstsq(self._xtx, self._xty, rcond=None)[0]
+        # plain floats for single predictions, indexes of the category values for batch lookups
+        self._coef_list = self._coef.tolist()
+        self._category_indexes = [(pd.Index(list(codes.keys())), np.array(list(codes.values()), dtype=np.int64))
+                                  for codes in self._get_category_codes()]
 
     # Sample input dict
     # {'InstanceType':['c3.8xlarge'], 'Region':['ap-northeast-1a'], 'ProductDescription':['Windows']}
@@ -37,64 +94,47 @@ class SpotBidPredictor:
         type_code = self._type_category_code.get(instance_type)
         region_code = self._az_category_code.get(region)
         os_code = self._os_category_code.get(product_description)
-        if type_code is None or region is None or os is None:
+        if type_code is None or region_code is None or os_code is None:
             return None
-        input = self._get_df_from_values(type_code, region_code, os_code)
-        return self._lm_model.predict(input)[0]
-
-    def get_train_data(self):
-        return self._train_data
-
-    def get_target_bid_price(self):
-        return self._target_price
-
-    def _pre_process_train_data(self):
-        self._train_data = self._int_df
-        self._categorize_train_data()
-        self._prune_train_data()
-
-    """
-    def get_az_cat_code(self, value):
-        return self._get_key_from_value(self._az_category_code, value);
-
-    def get_os_cat_code(self, value):
-        return self._get_key_from_value(self._os_category_code, value);
-
-    def get_type_cat_code(self, value):
-        return self._get_key_from_value(self._type_category_code, value);
-
-    def _get_key_from_value(self, data, value):
-        for code, name in data.iteritems():
-            if value == name:
-                return code
-        return None
-    """
-
-    def _get_df_from_values(self, type_code, region_code, os_code):
-        temp = {'InstanceType':[type_code], 'Region':[region_code], 'ProductDescription':[os_code]}
-        #eprint("Getting bid for params - {}".format(temp))
-        return pd.DataFrame(temp)
-
-    def _categorize_train_data(self):
-        self._train_data['InstanceType'] = self._train_data['InstanceType'].astype('category')
-        self._train_data['ProductDescription'] = self._train_data['ProductDescription'].astype('category')
-        self._train_data['Region'] = self._train_data['Region'].astype('category')
-        self._train_data['OS'] = self._train_data['ProductDescription'].cat.codes
-        self._train_data['LOC'] = self._train_data['Region'].cat.codes
-        self._train_data['TYPE'] = self._train_data['InstanceType'].cat.codes
-        self._az_category_code = dict([(v[1], v[0]) for v in list(enumerate(self._train_data['Region'].cat.categories))])
-        self._os_category_code = dict([(v[1], v[0]) for v in list(enumerate(self._train_data['ProductDescription'].cat.categories))])
-        self._type_category_code = dict([(v[1], v[0]) for v in list(enumerate(self._train_data['InstanceType'].cat.categories))])
-
-        #self._az_category_code = dict(enumerate(self._train_data['Region'].cat.categories))
-        #self._os_category_code = dict(enumerate(self._train_data['ProductDescription'].cat.categories))
-        #self._type_category_code = dict(enumerate(self._train_data['InstanceType'].cat.categories))
-
-    def _prune_train_data(self):
-        #self._train_data = self._train_data.drop('Timestamp', axis=1)
-        self._train_data = self._train_data.drop('InstanceType', axis=1)
-        self._train_data = self._train_data.drop('Region', axis=1)
-        self._train_data = self._train_data.drop('ProductDescription', axis=1)
+        coef = self._coef_list
+        return coef[0] + coef[type_code] + coef[region_code] + coef[os_code]
+
+    def predict_many(self, instance_types, regions, product_descriptions):
+        """
+        Predicts prices for a batch of queries
+        :param instance_types: array (or list) of instance types
+        :param regions: array (or list) of regions, same length
+        :param product_descriptions: array (or list) of OS descriptions, same length
+        :return: numpy array of prices (NaN where any of the values was not seen in training)
+        """
+        queries = [instance_types, regions, product_descriptions]
+        n = len(instance_types)
+        columns = np.zeros((n, len(queries) + 1), dtype=np.int64)
+        unknown = np.zeros(n, dtype=bool)
+        for i, ((index, codes), values) in enumerate(zip(self._category_indexes, queries)):
+            positions = index.get_indexer(np.asarray(values, dtype=object))
+            missing = positions < 0
+            unknown |= missing
+            # unknown values point at the intercept column, their result is masked out below
+            columns[:, i + 1] = np.where(missing, 0, codes[positions])
+
+        result = self._design_matrix(columns) @ self._coef
+        result[unknown] = np.nan
+        return result
+
+    def _design_matrix(self, columns):
+        """
+        Builds the sparse one-hot matrix for encoded rows
+        :param columns: int array (rows x 4) of the intercept and category columns set in each row
+        :return: scipy CSR matrix (rows x features)
+        """
+        n, width = columns.shape
+        return sparse.csr_matrix((np.ones(n * width), columns.ravel(), np.arange(0, n * width + 1, width)),
+                                 shape=(n, self._n_features))
+
+    def _get_category_codes(self):
+        """Returns the category code dicts in category_fields order"""
+        return [self._type_category_code, self._az_category_code, self._os_category_code]
 
 # Unit Testing predict
 def get_test_generator():
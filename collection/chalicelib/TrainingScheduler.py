@@ -0,0 +1,235 @@
+import heapq
+import math
+import os
+import re
+import threading
+import time
+import datetime
+import dateutil.parser
+from .common import *
+
+
+class TrainingScheduler:
+    """
+    Long running, priority driven bid training
+
+    Keeps a priority queue of (region, instance, os) keys scored by request popularity (read from the API log), staleness
+    (time since the key was last trained) and new data (history ticks since then). Each cycle the scores are refreshed and
+    the highest priority keys are retrained by worker threads until the cycle's CPU budget is spent. Keys with new ticks
+    are due again after min_interval seconds, keys without only after max_staleness seconds.
+    """
+    __requestPattern = re.compile(r"Bid served - \['([^']*)', '([^']*)', '([^']*)'")
+    __historyFields = ["Region", "InstanceType", "ProductDescription", "AvailabilityZone", "Timestamp"]
+
+    def __init__(self, predictor, history_index, bid_index, api_log=None, workers=2, cycle_seconds=300,
+                 cpu_budget=None, min_interval=300, max_staleness=604800, popularity_weight=1.0, data_weight=1.0,
+                 staleness_weight=1.0, popularity_half_life=3600, tick_lag=3600):
+        """
+        Constructor
+        :param predictor: BidPredictor to train with
+        :param history_index: IndexData of the price history (polled for new ticks)
+        :param bid_index: IndexData of the bids (read once for when each key was last trained)
+        :param api_log: API log file to read requests from (Default: None - no popularity)
+        :param workers: keys trained concurrently (Default: 2)
+        :param cycle_seconds: seconds between scheduling cycles (Default: 300)
+        :param cpu_budget: CPU seconds to spend training per cycle (Default: None - no limit)
+        :param min_interval: seconds before a key with new ticks is retrained (Default: 300)
+        :param max_staleness: seconds before a key without new ticks is retrained (Default: 604800)
+        :param popularity_weight: priority weight of requests (Default: 1.0)
+        :param data_weight: priority weight of new ticks (Default: 1.0)
+        :param staleness_weight: priority weight of time since training, relative to max_staleness (Default: 1.0)
+        :param popularity_half_life: seconds for request counts to decay by half (Default: 3600)
+        :param tick_lag: seconds a tick can be written after its timestamp, e.g. the collection period (Default: 3600)
+        """
+        self.__predictor = predictor
+        self.__history_index = history_index
+        self.__bid_index = bid_index
+        self.api_log = api_log
+        self.workers = workers
+        self.cycle_seconds = cycle_seconds
+        self.cpu_budget = cpu_budget
+        self.min_interval = min_interval
+        self.max_staleness = max_staleness
+        self.popularity_weight = popularity_weight
+        self.data_weight = data_weight
+        self.staleness_weight = staleness_weight
+        self.popularity_half_life = popularity_half_life
+        self.tick_lag = tick_lag
+
+        self.__trained = {}
+        self.__requests = {}
+        self.__new_ticks = {}
+        self.__log_offset = None
+        self.__polled = None
+        self.__seen_ticks = {}
+        self.__stop = threading.Event()
+
+    def load_trained(self):
+        """
+        Reads when every key in the bid index was last trained
+        :return: None
+        """
+        for (id, bid) in self.__bid_index.scan(ids=True, source=["trained"]):
+            key = tuple(id.split("~"))
+            trained = bid.get("trained")
+            self.__trained[key] = to_epoch(dateutil.parser.parse(trained)) if trained is not None else 0
+
+    def read_requests(self):
+        """
+        Reads requests added to the API log since the last read, counts decay with popularity_half_life
+        :return: number of requests read
+        """
+        decay = 0.5 ** (float(self.cycle_seconds) / self.popularity_half_life)
+        for key in list(self.__requests):
+            self.__requests[key] *= decay
+            if self.__requests[key] < 0.01:
+                self.__requests.pop(key)
+
+        if self.api_log is None or not os.path.exists(self.api_log):
+            return 0
+
+        size = os.path.getsize(self.api_log)
+        if self.__log_offset is None:
+            # only count requests from when the scheduler started
+            self.__log_offset = size
+        elif size < self.__log_offset:
+            # rotated or truncated
+            self.__log_offset = 0
+
+        count = 0
+        with open(self.api_log, 'r') as log:
+            log.seek(self.__log_offset)
+            for line in log:
+                match = self.__requestPattern.search(line)
+                if match is not None:
+                    (instance, region, os_name) = match.groups()
+                    key = (region, instance, os_name)
+                    self.__requests[key] = self.__requests.get(key, 0) + 1
+                    count += 1
+            self.__log_offset = log.tell()
+
+        return count
+
+    def read_new_ticks(self):
+        """
+        Counts the history added since the last poll per key (keys seen for the first time are queued)
+        :return: number of ticks read
+        """
+        now = utc.localize(datetime.datetime.utcnow())
+        polled = self.__polled if self.__polled is not None else now - datetime.timedelta(seconds=self.cycle_seconds)
+        self.__polled = now
+        # ticks are timestamped by EC2, not when they were written: read back over the lag and skip ticks already seen
+        since = polled - datetime.timedelta(seconds=self.tick_lag)
+        cutoff = to_epoch(since)
+        self.__seen_ticks = dict((tick, seen) for tick, seen in self.__seen_ticks.items() if seen >= cutoff)
+
+        count = 0
+        for h in self.__history_index.search_terms({}, since=since, page_size=0, source=self.__historyFields):
+            tick = (h.get("AvailabilityZone"), h.get("InstanceType"), h.get("ProductDescription"), h.get("Timestamp"))
+            if tick in self.__seen_ticks:
+                continue
+            self.__seen_ticks[tick] = to_epoch(dateutil.parser.parse(h.get("Timestamp")))
+
+            key = (h.get("Region"), h.get("InstanceType"), h.get("ProductDescription").lower())
+            self.__new_ticks[key] = self.__new_ticks.get(key, 0) + 1
+            self.__trained.setdefault(key, 0)
+            count += 1
+
+        return count
+
+    def get_priority(self, key, now):
+        """
+        Scores a key
+        :param key: (region, instance, os)
+        :param now: epoch seconds
+        :return: priority (None if the key is not due for training)
+        """
+        age = now - self.__trained.get(key, 0)
+        ticks = self.__new_ticks.get(key, 0)
+        if not ((ticks > 0 and age >= self.min_interval) or age >= self.max_staleness):
+            return None
+
+        return self.popularity_weight * math.log1p(self.__requests.get(key, 0)) + \
+            self.data_weight * math.log1p(ticks) + \
+            self.staleness_weight * min(float(age) / self.max_staleness, 1.0)
+
+    def get_queue(self):
+        """
+        Builds the priority queue of keys due for training
+        :return: heap of (-priority, key)
+        """
+        now = time.time()
+        queue = []
+        for key in set(self.__trained) | set(self.__requests):
+            priority = self.get_priority(key, now)
+            if priority is not None:
+                queue.append((-priority, key))
+
+        heapq.heapify(queue)
+        return queue
+
+    def train_key(self, key):
+        """
+        Trains a key and records it as trained
+        :param key: (region, instance, os)
+        :return: None
+        """
+        (region, instance, os_name) = key
+        started = time.time()
+        self.__predictor.model_key(region, instance, os_name)
+        self.__trained[key] = started
+        self.__new_ticks.pop(key, None)
+
+    def run_cycle(self):
+        """
+        Runs one scheduling cycle: refresh the scores and train the highest priority keys within the CPU budget
+        :return: number of keys trained
+        """
+        requests = self.read_requests()
+        ticks = self.read_new_ticks()
+        queue = self.get_queue()
+        eprint("Schedule: {} keys due, {} requests, {} new ticks".format(len(queue), requests, ticks))
+
+        lock = threading.Lock()
+        cpu_start = time.process_time()
+        trained = []
+
+        def worker():
+            while not self.__stop.is_set():
+                with lock:
+                    if len(queue) == 0:
+                        return
+                    if self.cpu_budget is not None and time.process_time() - cpu_start >= self.cpu_budget:
+                        return
+                    (priority, key) = heapq.heappop(queue)
+                try:
+                    self.train_key(key)
+                    trained.append(key)
+                except Exception as e:
+                    eprint("Training failed for {}: {}".format(key, e))
+
+        threads = [threading.Thread(target=worker) for _ in range(self.workers)]
+        [thread.start() for thread in threads]
+        [thread.join() for thread in threads]
+
+        eprint("Schedule: trained {} keys in {:.1f} CPU seconds, {} deferred".format(
+            len(trained), time.process_time() - cpu_start, len(queue)))
+        return len(trained)
+
+    def run(self):
+        """
+        Runs scheduling cycles until stop is called
+        :return: None
+        """
+        self.load_trained()
+        while not self.__stop.is_set():
+            started = time.time()
+            try:
+                self.run_cycle()
+            except Exception as e:
+                eprint("Schedule cycle failed: {}".format(e))
+            self.__stop.wait(max(self.cycle_seconds - (time.time() - started), 0))
+
+    def stop(self):
+        """Stops the scheduler after the keys in training finish"""
+        self.__stop.set()
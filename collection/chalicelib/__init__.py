@@ -1,7 +1,50 @@
+from importlib import import_module as _import_module
+from types import ModuleType as _ModuleType
 from .ConfigStage import ConfigStage
+from .Instrumentation import Instrumentation
 from .InstanceMap import InstanceMap
+from .InstanceRecord import InstanceRecord
 from .EnhanceSpotPriceData import EnhanceSpotPriceData
-from .IndexData import IndexData
-from .BidPredictor import BidPredictor
+from .CollectorDaemon import CollectorDaemon
+from .DailyRollup import DailyRollup
+from .LocalIndexData import LocalIndexData
+from .BidSnapshot import BidSnapshot
+from .TrainingScheduler import TrainingScheduler
+from .LeaseManager import LeaseManager
 from .common import *
 
+# classes needing NumPy or the ES client (which loads NumPy and pandas when they are installed) are imported on first
+# use, so entry points that do not use them (e.g. the Chalice app or collection.py writing files) do not load them.
+# The other heavy dependencies are imported by the methods using them: boto3 (EnhanceSpotPriceData), requests and
+# BeautifulSoup (InstanceMap) and pandas, SciPy and scikit-learn (BidPredictor training)
+_lazy_classes = {
+    "ClientRegistry": ".ClientRegistry",
+    "FastJSONSerializer": ".FastJSONSerializer",
+    "IndexData": ".IndexData",
+    "open_index": ".IndexData",
+    "BidArtifact": ".BidArtifact",
+    "BidPredictor": ".BidPredictor",
+    "Backtester": ".Backtester",
+}
+
+
+def __getattr__(name):
+    """
+    Imports a lazily loaded class on first use
+    :param name: class name
+    :return: class
+    """
+    if name not in _lazy_classes:
+        raise AttributeError("module {} has no attribute {}".format(__name__, name))
+    value = getattr(_import_module(_lazy_classes[name], __name__), name)
+    globals()[name] = value
+
+    # importing a submodule binds it to its name here, put back the classes of the ones imported along the way
+    for lazy_name, module in _lazy_classes.items():
+        if isinstance(globals().get(lazy_name), _ModuleType):
+            globals()[lazy_name] = getattr(globals()[lazy_name], lazy_name)
+    return value
+
+
+# star imports (the scripts) still get every class, importing the lazy ones
+__all__ = [name for name in list(globals()) if not name.startswith("_")] + sorted(_lazy_classes)
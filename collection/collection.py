@@ -1,18 +1,31 @@
-from chalicelib import *
+from chalicelib import ConfigStage, CollectorDaemon, DailyRollup, EnhanceSpotPriceData, InstanceMap, Instrumentation, \
+    eprint, from_epoch, utc
 from optparse import OptionParser
+import atexit
 import dateutil
 import os
 import json
 
 config = ConfigStage('chalicelib/collection.ini')
+# the instance map snapshot is kept next to the script, whatever directory cron or a daemon runs it from
+instance_snapshot = os.path.join(os.path.dirname(os.path.abspath(__file__)), "instanceIndex.snap")
 
 minutes = int(config.get("main", "minutes", 60))
 input_type = config.get("main", "input", "api")
 output_type = config.get("main", "output", "file")
 pretty = bool(config.get("main", "pretty", False))
+enrichment = config.get("main", "enrichment", "full")
+attribute_fields = config.get("main", "attribute_fields", "")
 
 outfile = config.get("file", "outfile", "output.json")
 
+collector_dict = config.items("collector", {})
+cursor_file = collector_dict.pop("cursor_file", "collector_cursors.json")
+region_poll = collector_dict.pop("region_poll", "")
+region_poll = dict((region.strip(), float(seconds)) for region, seconds in
+                   (entry.split(":") for entry in region_poll.split(",") if entry.strip() != ""))
+collector_options = dict((option, float(value)) for option, value in collector_dict.items())
+
 elastic_dict = config.items("elastic", {})
 elastic_url = elastic_dict.pop("url", "localhost")
 
@@ -20,13 +33,19 @@ index_dict = config.items("history_index", {})
 index = index_dict.pop("name", "spot_price_history")
 doc_type = index_dict.pop("doc_type", "price")
 mappings = json.loads(index_dict.pop("mappings", "{}"))
+rollover = index_dict.pop("rollover", None)
 
 instance_index_dict = config.items("instance_index", {})
 instance_index = instance_index_dict.pop("name", "instance_map")
 instance_doc_type = instance_index_dict.pop("doc_type", "instance")
 instance_mappings = json.loads(instance_index_dict.pop("mappings", "{}"))
 
-usage_msg="""usage: %prog [-i <api|file>] [-f <filename>] [-m <N>] [-s <timestamp>] [-o <filename>]"""
+rollup_index_dict = config.items("rollup_index", {})
+rollup_index = rollup_index_dict.pop("name", "spot_price_daily")
+rollup_doc_type = rollup_index_dict.pop("doc_type", "daily")
+rollup_mappings = json.loads(rollup_index_dict.pop("mappings", "{}"))
+
+usage_msg="""usage: %prog [-i <api|file>] [-f <filename>] [-m <N>] [-s <timestamp>] [-o <filename>] [-r <full|reference>] [-a <fields>]"""
 opt_parser = OptionParser(usage_msg)
 opt_parser.add_option("--input", "-i", action="store", type="string", dest="input", default=input_type,
                       help="Input for this run (Default: {})".format(input_type), metavar="api|file")
@@ -46,26 +65,70 @@ opt_parser.add_option("--elasticurl", "-e", action="store", type="string", dest=
                       help="URL for the elasticsearch server (Default: {})".format(elastic_url))
 opt_parser.add_option("--indexname", "-x", action="store", type="string", dest="index", default=index,
                       help="elasticsearch index name (Default: {})".format(index))
+opt_parser.add_option("--enrichment", "-r", action="store", type="string", dest="enrichment", default=enrichment,
+                      help="Instance enrichment mode (Default: {})".format(enrichment), metavar="full|reference")
+opt_parser.add_option("--attributes", "-a", action="store", type="string", dest="attribute_fields", default=attribute_fields,
+                      help="Comma separated attributes to keep on reference enriched rows", metavar="fields")
+opt_parser.add_option("--no-rollup", action="store_false", dest="rollup", default=True,
+                      help="Do not update the daily rollup index (only with elastic output)")
+opt_parser.add_option("--daemon", "-D", action="store_true", dest="daemon", default=False,
+                      help="Keep running, polling each region for the prices since its cursor (see [collector] config, "
+                           "needs elastic output)")
+opt_parser.add_option("--profile", action="store", type="string", dest="profile", default=None,
+                      help="Profile the run: write a cProfile to <prefix>.prof and stage timings to <prefix>.json",
+                      metavar="prefix")
 (options, args) = opt_parser.parse_args()
+if options.profile is not None:
+    Instrumentation.start_profile()
+    # written however the run ends
+    atexit.register(Instrumentation.write_profile, options.profile)
 elastic_url = options.elastic_url.split(',')
+attribute_fields = [field.strip() for field in options.attribute_fields.split(',') if field.strip() != '']
 
 
 # Open the writer
+rollup = None
 if options.output_type.lower().startswith("f"):
     tmpfile = ".{}.tmp".format(options.outfile)
     out = open(tmpfile, 'w')
     instances = InstanceMap(file="instanceMap.json", ttl=8640000)
 elif options.output_type.lower().startswith("e"):
-    out = IndexData(elastic_url, options.index, doc_type=doc_type, connection_options=elastic_dict, index_settings=index_dict, index_mappings=mappings)
-    instance_out = IndexData(elastic_url, instance_index, doc_type=instance_doc_type, connection_options=elastic_dict,
-                             index_settings=instance_index_dict, index_mappings=instance_mappings, alias=True)
-    instances = InstanceMap(elastic_index=instance_out, ttl=8640000)
+    # the ES client (and the NumPy and pandas it loads) is only imported for index output
+    from chalicelib import open_index
+
+    out = open_index(elastic_url, options.index, doc_type=doc_type, connection_options=elastic_dict, index_settings=index_dict,
+                     index_mappings=mappings, rollover=rollover)
+    instance_out = open_index(elastic_url, instance_index, doc_type=instance_doc_type, connection_options=elastic_dict,
+                              index_settings=instance_index_dict, index_mappings=instance_mappings, alias=True)
+    instances = InstanceMap(elastic_index=instance_out, ttl=8640000, snapshot=instance_snapshot)
+    if options.rollup:
+        rollup = DailyRollup(open_index(elastic_url, rollup_index, doc_type=rollup_doc_type,
+                                        connection_options=elastic_dict, index_settings=rollup_index_dict,
+                                        index_mappings=rollup_mappings, rollover=rollover))
 else:
     eprint("ERROR: Invalid output type provided: {}".format(options.output_type))
     exit(1)
 
 # Initialize the reader class
-reader = EnhanceSpotPriceData(instances=instances, period=options.minutes, writer=out, pretty=options.pretty)
+reader = EnhanceSpotPriceData(instances=instances, period=options.minutes, writer=out, pretty=options.pretty,
+                              enrichment=options.enrichment, attribute_fields=attribute_fields, rollup=rollup)
+
+if options.daemon:
+    if not options.output_type.lower().startswith("e"):
+        eprint("ERROR: daemon mode needs elastic output. Aborting.")
+        exit(1)
+
+    # the clients, instance map and reader stay warm between polls, the instance map is reloaded on a schedule
+    daemon = CollectorDaemon(reader, cursor_file=cursor_file, region_poll=region_poll, initial_minutes=options.minutes,
+                             instance_loader=lambda: InstanceMap(elastic_index=instance_out, ttl=8640000,
+                                                                 snapshot=instance_snapshot),
+                             **collector_options)
+    eprint("Collector daemon started")
+    try:
+        daemon.run()
+    except KeyboardInterrupt:
+        daemon.stop()
+    exit(0)
 if options.start is not None:
     start = utc.localize(dateutil.parser.parse(options.start))
 else:
@@ -1,18 +1,42 @@
-from chalicelib import *
+from chalicelib import ConfigStage, open_index, eprint, utc
 from optparse import OptionParser
+import datetime
 
 config = ConfigStage('chalicelib/collection.ini')
 
 elastic_dict = config.items("elastic", {})
 elastic_url = elastic_dict.pop("url", "localhost")
 
+index_dict = config.items("history_index", {})
+history_index = index_dict.pop("name", "spot_price_history")
+rollover = index_dict.pop("rollover", None)
+# the indexes the scripts open with the [history_index] rollover (see collection.py and predict.py)
+rollover_indexes = [history_index, config.items("rollup_index", {}).pop("name", "spot_price_daily")]
+
 opt_parser = OptionParser()
 opt_parser.add_option("--elasticurl", "-e", action="store", type="string", dest="elastic_url", default=elastic_url,
                       help="URL for the elasticsearch server (Default: {})".format(elastic_url))
 opt_parser.add_option("--indexname", "-x", action="store", type="string", dest="index", default=None,
-                      help="elasticsearch index name")
+                      help="elasticsearch index name (Default with --retire-days: {})".format(history_index))
+opt_parser.add_option("--retire-days", "-r", action="store", type="int", dest="retire_days", default=None,
+                      help="Retire the rollover partitions of the index older than this many days instead of deleting it")
+opt_parser.add_option("--drop", "-d", action="store_true", dest="drop", default=False,
+                      help="Drop retired partitions (Default: force merge them and make them read-only)")
 (options, args) = opt_parser.parse_args()
 elastic_url = options.elastic_url.split(',')
+if options.retire_days is not None and rollover is None:
+    opt_parser.error("--retire-days needs a rollover index (set rollover in the [history_index] section)")
+if options.retire_days is None and options.index is None:
+    opt_parser.error("--indexname is needed to delete an index")
 
-out = IndexData(elastic_url, index=options.index, doc_type="price")
-out.get_client().indices.delete(options.index)
+if options.retire_days is not None:
+    index = options.index if options.index is not None else history_index
+    out = open_index(elastic_url, index=index, doc_type="price", rollover=rollover)
+    cutoff = utc.localize(datetime.datetime.now()) - datetime.timedelta(days=options.retire_days)
+    retired = out.retire_partitions(cutoff, drop=options.drop)
+    eprint("Retired partitions: {}".format(retired))
+else:
+    # a rollover index is deleted with all of its partitions (and its alias), not just the first one behind the alias
+    out = open_index(elastic_url, index=options.index, doc_type="price",
+                     rollover=rollover if options.index in rollover_indexes else None)
+    out.delete_index()
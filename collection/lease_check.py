@@ -0,0 +1,93 @@
+from chalicelib import LocalIndexData, LeaseManager, eprint
+from optparse import OptionParser
+import multiprocessing
+import tempfile
+import time
+import os
+
+opt_parser = OptionParser(usage="usage: %prog [options]\n\n"
+                                "Checks distributed training leases on one box: several local processes work through "
+                                "a run on a shared sqlite:// lease index while one of them crashes holding a lease and "
+                                "one unit always fails. Exits non zero if a unit is lost, processed twice or the "
+                                "failing unit is not given up")
+opt_parser.add_option("--processes", "-p", action="store", type="int", dest="processes", default=3,
+                      help="Worker processes (Default: 3)")
+opt_parser.add_option("--workers", "-w", action="store", type="int", dest="workers", default=2,
+                      help="Worker threads per process (Default: 2)")
+opt_parser.add_option("--units", "-u", action="store", type="int", dest="units", default=20,
+                      help="Units in the run (Default: 20)")
+opt_parser.add_option("--ttl", "-t", action="store", type="float", dest="ttl", default=2,
+                      help="Lease ttl in seconds, the crashed process' lease is reclaimed after it (Default: 2)")
+(options, args) = opt_parser.parse_args()
+
+units = ["unit{:03d}".format(i) for i in range(options.units)]
+failing_unit = units[len(units) // 2]
+max_attempts = 3
+
+
+def worker(url, n, crash):
+    """
+    Works through the run in a process of its own
+    :param url: lease database URL
+    :param n: worker number
+    :param crash: exit (as a crash would) while holding the first unit claimed
+    :return: None
+    """
+    processed = LocalIndexData(url, "processed")
+    leases = LeaseManager(LocalIndexData(url, "leases"), "check", owner="worker{}".format(n), ttl=options.ttl,
+                          heartbeat=options.ttl / 4, poll=options.ttl / 4, max_attempts=max_attempts)
+
+    def process(unit):
+        if crash:
+            os._exit(3)
+        if unit == failing_unit:
+            raise RuntimeError("unit always fails")
+        time.sleep(0.05)
+        processed.write({"unit": unit, "owner": leases.owner})
+
+    leases.run_units(units, process, workers=options.workers)
+
+
+if __name__ == '__main__':
+    (fd, path) = tempfile.mkstemp(prefix='lease_check_', suffix='.db')
+    os.close(fd)
+    url = "sqlite://" + path
+    try:
+        # create the indexes up front, not in the racing workers
+        LocalIndexData(url, "leases")
+        LocalIndexData(url, "processed")
+
+        processes = [multiprocessing.Process(target=worker, args=(url, n, n == 0)) for n in range(options.processes)]
+        started = time.time()
+        [process.start() for process in processes]
+        [process.join() for process in processes]
+
+        status = LeaseManager(LocalIndexData(url, "leases"), "check").get_status(units)
+        done = [document.get("unit") for document in LocalIndexData(url, "processed").scan()]
+        (failed, version) = LocalIndexData(url, "leases").get_versioned("check~" + failing_unit)
+
+        errors = []
+        if processes[0].exitcode != 3:
+            errors.append("the crashing worker exited with {}".format(processes[0].exitcode))
+        if any(process.exitcode != 0 for process in processes[1:]):
+            errors.append("workers exited with {}".format([process.exitcode for process in processes[1:]]))
+        missing = sorted(set(units) - set(done) - {failing_unit})
+        if len(missing) > 0:
+            errors.append("units never processed: {}".format(missing))
+        duplicates = sorted(set(unit for unit in done if done.count(unit) > 1))
+        if len(duplicates) > 0:
+            errors.append("units processed more than once: {}".format(duplicates))
+        if failed is None or failed.get("state") != "failed" or failed.get("attempts") != max_attempts:
+            errors.append("the failing unit was not given up after {} attempts: {}".format(max_attempts, failed))
+
+        eprint("{} processes, {} units in {:.1f} seconds: {}".format(options.processes, len(units),
+                                                                     time.time() - started, status))
+        for error in errors:
+            eprint("FAILED: {}".format(error))
+        if len(errors) == 0:
+            eprint("PASSED")
+        exit(1 if len(errors) > 0 else 0)
+    finally:
+        for suffix in ["", "-wal", "-shm"]:
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
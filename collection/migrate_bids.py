@@ -0,0 +1,67 @@
+from chalicelib import ConfigStage, BidPredictor, open_index, eprint
+from optparse import OptionParser
+import json
+
+config = ConfigStage('chalicelib/collection.ini')
+
+elastic_dict = config.items("elastic", {})
+elastic_url = elastic_dict.pop("url", "localhost")
+
+bid_index_dict = config.items("bid_index", {})
+bid_index = bid_index_dict.pop("name", "spot_bids")
+bid_doc_type = bid_index_dict.pop("doc_type", "bid")
+bid_mappings = json.loads(bid_index_dict.pop("mappings", "{}"))
+bid_index_dict.pop("artifacts", None)
+
+opt_parser = OptionParser(usage="usage: %prog [options]\n\n"
+                                "Converts bid documents from \"az/price\" summary strings to the typed bid schema")
+opt_parser.add_option("--elasticurl", "-e", action="store", type="string", dest="elastic_url", default=elastic_url,
+                      help="URL for the elasticsearch server (Default: {})".format(elastic_url))
+opt_parser.add_option("--indexname", "-x", action="store", type="string", dest="index", default=bid_index,
+                      help="bid index name (Default: {})".format(bid_index))
+opt_parser.add_option("--rebuild", "-r", action="store_true", dest="rebuild", default=False,
+                      help="Write to a new index with the typed mappings and swap the bid alias over, a plain bid index is "
+                           "replaced by the alias (Default: convert the documents in place)")
+(options, args) = opt_parser.parse_args()
+elastic_url = options.elastic_url.split(',')
+
+bid_index = open_index(elastic_url, options.index, doc_type=bid_doc_type, connection_options=elastic_dict,
+                       index_settings=bid_index_dict, index_mappings=bid_mappings)
+source_index = bid_index.get_read_index()
+target_index = bid_index
+# a plain (pre alias) bid index can not be swapped: it is copied into "<name>-1", deleted and replaced by the alias
+plain_rebuild = options.rebuild and not bid_index.is_alias()
+if plain_rebuild:
+    target_index = open_index(elastic_url, "{}-1".format(options.index), doc_type=bid_doc_type,
+                              connection_options=elastic_dict, index_settings=bid_index_dict,
+                              index_mappings=bid_mappings)
+    eprint("Migrating {} into {}".format(source_index, target_index.get_index()))
+    target_index.begin_bulk_load()
+elif options.rebuild:
+    eprint("Migrating {} into {}".format(source_index, bid_index.get_next_alias_index()))
+    bid_index.begin_bulk_load()
+
+converted = 0
+copied = 0
+for (id, bid) in bid_index.scan(ids=True, index=source_index):
+    if "summary" in bid:
+        bid = BidPredictor.convert_bid(bid)
+        converted += 1
+    elif not options.rebuild:
+        continue
+    else:
+        copied += 1
+    target_index.write(bid, id)
+
+if options.rebuild:
+    target_index.end_bulk_load()
+    if plain_rebuild:
+        # the bid index is missing between the delete and the alias creation (ES can not alias an index's name)
+        bid_index.delete_index()
+        target_index = open_index(elastic_url, options.index, doc_type=bid_doc_type, connection_options=elastic_dict,
+                                  index_settings=bid_index_dict, index_mappings=bid_mappings, alias=True)
+    else:
+        target_index.update_alias()
+    eprint("Bid index swapped to {}".format(target_index.get_index()))
+
+eprint("Converted {} bids ({} already typed)".format(converted, copied))
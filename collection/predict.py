@@ -1,12 +1,18 @@
-from chalicelib import *
+from chalicelib import ConfigStage, BidPredictor, ClientRegistry, InstanceMap, Instrumentation, LeaseManager, \
+    TrainingScheduler, open_index, eprint
 from optparse import OptionParser
+import atexit
 import dateutil
+import datetime
 import json
+import os
 
 import multiprocessing
 
 
 config = ConfigStage('chalicelib/collection.ini')
+# the instance map snapshot is kept next to the script, whatever directory cron or a daemon runs it from
+instance_snapshot = os.path.join(os.path.dirname(os.path.abspath(__file__)), "instanceIndex.snap")
 
 minutes = int(config.get("main", "minutes", 60))
 input_type = config.get("main", "input", "api")
@@ -22,6 +28,7 @@ index_dict = config.items("history_index", {})
 index = index_dict.pop("name", "spot_price_history")
 doc_type = index_dict.pop("doc_type", "price")
 mappings = json.loads(index_dict.pop("mappings", "{}"))
+rollover = index_dict.pop("rollover", None)
 
 instance_index_dict = config.items("instance_index", {})
 instance_index = instance_index_dict.pop("name", "instance_map")
@@ -32,8 +39,35 @@ bid_index_dict = config.items("bid_index", {})
 bid_index = bid_index_dict.pop("name", "spot_bids")
 bid_doc_type = bid_index_dict.pop("doc_type", "bid")
 bid_mappings = json.loads(bid_index_dict.pop("mappings", "{}"))
-
-cores = max(multiprocessing.cpu_count() / 2 - 1, 1)
+bid_artifacts = bid_index_dict.pop("artifacts", "index")
+bid_artifacts = bid_artifacts if bid_artifacts != "none" else None
+
+rollup_index_dict = config.items("rollup_index", {})
+rollup_index = rollup_index_dict.pop("name", "spot_price_daily")
+rollup_doc_type = rollup_index_dict.pop("doc_type", "daily")
+rollup_mappings = json.loads(rollup_index_dict.pop("mappings", "{}"))
+
+history_days = int(config.get("predict", "history_days", 0))
+scan_slices = int(config.get("predict", "scan_slices", 0))
+rebuild = str(config.get("predict", "rebuild", "false")).lower() in ("true", "1", "yes")
+model = config.get("predict", "model", "linear")
+quantile = float(config.get("predict", "quantile", 0.95))
+source = config.get("predict", "source", "rollup")
+
+daemon_dict = config.items("daemon", {})
+api_log = daemon_dict.pop("api_log", None)
+cpu_budget = daemon_dict.pop("cpu_budget", None)
+daemon_options = dict((option, float(value)) for option, value in daemon_dict.items())
+
+lease_index_dict = config.items("lease_index", {})
+lease_index = lease_index_dict.pop("name", "training_leases")
+lease_doc_type = lease_index_dict.pop("doc_type", "lease")
+lease_mappings = json.loads(lease_index_dict.pop("mappings", "{}"))
+lease_options = dict((option, float(lease_index_dict.pop(option))) for option in ["ttl", "heartbeat", "poll"]
+                     if option in lease_index_dict)
+lease_options["max_attempts"] = int(lease_index_dict.pop("max_attempts", 3))
+
+cores = max(multiprocessing.cpu_count() // 2 - 1, 1)
 opt_parser = OptionParser()
 opt_parser.add_option("--pretty", "-p", action="store_true", dest="pretty", default=pretty,
                       help="Pretty format output")
@@ -42,23 +76,103 @@ opt_parser.add_option("--elasticurl", "-e", action="store", type="string", dest=
 opt_parser.add_option("--threads", "-t", action="store", type="int", dest="threads",
                       default=cores,
                       help="Number of threads to use (Default: {})".format(cores))
-
+opt_parser.add_option("--days", "-d", action="store", type="int", dest="history_days", default=history_days,
+                      help="Days of history to train on, 0 for all (Default: {})".format(history_days))
+opt_parser.add_option("--slices", "-s", action="store", type="int", dest="scan_slices", default=scan_slices,
+                      help="Parallel scroll slices per history read, 0 for a single scroll (Default: {})".format(scan_slices))
+
+opt_parser.add_option("--model", "-m", action="store", type="choice", dest="model", default=model,
+                      choices=BidPredictor.get_model_names(),
+                      help="Bid model to train: {} (Default: {})".format(", ".join(BidPredictor.get_model_names()), model))
+opt_parser.add_option("--quantile", "-q", action="store", type="float", dest="quantile", default=quantile,
+                      help="Share of past windows a quantile model bid survives (Default: {})".format(quantile))
+opt_parser.add_option("--source", "-S", action="store", type="choice", dest="source", default=source,
+                      choices=["rollup", "history"],
+                      help="Train on the daily rollup or the history ticks: rollup, history (Default: {})".format(source))
+opt_parser.add_option("--rebuild", "-r", action="store_true", dest="rebuild", default=rebuild,
+                      help="Train into a fresh bid index and swap the alias over when complete")
+
+opt_parser.add_option("--daemon", "-D", action="store_true", dest="daemon", default=False,
+                      help="Keep running, retraining keys by popularity, staleness and new data (see [daemon] config)")
+opt_parser.add_option("--apilog", "-l", action="store", type="string", dest="api_log", default=api_log,
+                      help="API log to read request popularity from in daemon mode (Default: {})".format(api_log))
+opt_parser.add_option("--cpu-budget", "-b", action="store", type="float", dest="cpu_budget",
+                      default=float(cpu_budget) if cpu_budget is not None else None,
+                      help="CPU seconds to spend per daemon cycle (Default: {})".format(cpu_budget))
+
+opt_parser.add_option("--distributed", "-w", action="store_true", dest="distributed", default=False,
+                      help="Share the training with other processes or hosts through leases (see [lease_index] config)")
+opt_parser.add_option("--run", action="store", type="string", dest="run", default=None,
+                      help="Run id the distributed workers share (Default: today's UTC date)")
+
+opt_parser.add_option("--profile", action="store", type="string", dest="profile", default=None,
+                      help="Profile the run: write a cProfile to <prefix>.prof and stage timings to <prefix>.json",
+                      metavar="prefix")
 (options, args) = opt_parser.parse_args()
+if options.profile is not None:
+    Instrumentation.start_profile()
+    # written however the run ends (including the exit of a daemon or distributed run)
+    atexit.register(Instrumentation.write_profile, options.profile)
+if options.distributed and (options.rebuild or options.daemon):
+    opt_parser.error("--distributed can not be combined with --rebuild or --daemon")
 elastic_url = options.elastic_url.split(',')
-
-
-history_index = IndexData(elastic_url, index, doc_type=doc_type, connection_options=elastic_dict, index_settings=index_dict, index_mappings=mappings)
-instance_index = IndexData(elastic_url, instance_index, doc_type=instance_doc_type, connection_options=elastic_dict,
-                           index_settings=instance_index_dict, index_mappings=instance_mappings, alias=True)
-bid_index = IndexData(elastic_url, bid_index, doc_type=bid_doc_type, connection_options=elastic_dict,
-                      index_settings=bid_index_dict, index_mappings=bid_mappings)
-instances = InstanceMap(elastic_index=instance_index, ttl=8640000).get_types()
-
+# every training thread (and scroll slice) shares one client, size its connection pools to match
+elastic_dict.setdefault("maxsize", options.threads * max(options.scan_slices, 1) + 1)
+
+
+history_index = open_index(elastic_url, index, doc_type=doc_type, connection_options=elastic_dict, index_settings=index_dict,
+                           index_mappings=mappings, rollover=rollover)
+instance_index = open_index(elastic_url, instance_index, doc_type=instance_doc_type, connection_options=elastic_dict,
+                            index_settings=instance_index_dict, index_mappings=instance_mappings, alias=True)
+bid_index = open_index(elastic_url, bid_index, doc_type=bid_doc_type, connection_options=elastic_dict,
+                       index_settings=bid_index_dict, index_mappings=bid_mappings, alias=options.rebuild)
+instances = InstanceMap(elastic_index=instance_index, ttl=8640000, snapshot=instance_snapshot).get_types()
+rollup_index = None
+if options.source == "rollup":
+    rollup_index = open_index(elastic_url, rollup_index, doc_type=rollup_doc_type, connection_options=elastic_dict,
+                              index_settings=rollup_index_dict, index_mappings=rollup_mappings, rollover=rollover)
+
+
+if options.daemon:
+    predictor = BidPredictor(history_index, bid_index, history_days=options.history_days,
+                             scan_slices=options.scan_slices, model=options.model, quantile=options.quantile,
+                             artifacts=bid_artifacts, rollup_index=rollup_index)
+    scheduler = TrainingScheduler(predictor, history_index, bid_index, api_log=options.api_log,
+                                  workers=int(options.threads), cpu_budget=options.cpu_budget, **daemon_options)
+    eprint("Training daemon started")
+    try:
+        scheduler.run()
+    except KeyboardInterrupt:
+        scheduler.stop()
+    exit(0)
+
+if options.rebuild:
+    # bulk load a new index while the API keeps reading the current one through the alias
+    eprint("Rebuilding into {}".format(bid_index.get_next_alias_index()))
+    bid_index.begin_bulk_load()
 
 eprint("Training")
 instances.sort()
 cores = int(options.threads)
-predictor = BidPredictor(history_index, bid_index)
+predictor = BidPredictor(history_index, bid_index, history_days=options.history_days, scan_slices=options.scan_slices,
+                         model=options.model, quantile=options.quantile, artifacts=bid_artifacts,
+                         rollup_index=rollup_index)
+
+if options.distributed:
+    lease_index = open_index(elastic_url, lease_index, doc_type=lease_doc_type, connection_options=elastic_dict,
+                             index_settings=lease_index_dict, index_mappings=lease_mappings)
+    run = options.run if options.run is not None else datetime.datetime.utcnow().strftime('%Y-%m-%d')
+    leases = LeaseManager(lease_index, run, **lease_options)
+    eprint("Distributed training run {} as {}".format(run, leases.owner))
+    try:
+        count = leases.run_units(instances, lambda instance: predictor.model_instance(instance, history_index),
+                                 workers=cores)
+    except KeyboardInterrupt:
+        leases.stop()
+        exit(1)
+    eprint("Training Complete: {} instances trained here, run status {}".format(count, leases.get_status(instances)))
+    exit(0)
+
 threads = []
 for core in range(0, cores):
     instances_slice = [instance for instance in instances if hash(instance) % cores == core]
@@ -68,6 +182,13 @@ for core in range(0, cores):
 [thread.join() for thread in threads]
 eprint("Training Complete")
 
+if options.rebuild:
+    bid_index.end_bulk_load()
+    bid_index.update_alias()
+    bid_index.purge_alias_index()
+    eprint("Bid index swapped to {}".format(bid_index.get_index()))
+eprint("Connection pools: {}".format(ClientRegistry.stats()))
+
 
 
 
@@ -0,0 +1,57 @@
+from chalicelib import ConfigStage, DailyRollup, open_index, eprint, utc
+from optparse import OptionParser
+import dateutil.parser
+import datetime
+import json
+
+config = ConfigStage('chalicelib/collection.ini')
+
+elastic_dict = config.items("elastic", {})
+elastic_url = elastic_dict.pop("url", "localhost")
+
+index_dict = config.items("history_index", {})
+index = index_dict.pop("name", "spot_price_history")
+doc_type = index_dict.pop("doc_type", "price")
+mappings = json.loads(index_dict.pop("mappings", "{}"))
+rollover = index_dict.pop("rollover", None)
+
+rollup_index_dict = config.items("rollup_index", {})
+rollup_index = rollup_index_dict.pop("name", "spot_price_daily")
+rollup_doc_type = rollup_index_dict.pop("doc_type", "daily")
+rollup_mappings = json.loads(rollup_index_dict.pop("mappings", "{}"))
+
+opt_parser = OptionParser(usage="usage: %prog [options]\n\n"
+                                "Builds the daily rollup index from the price history (collection.py keeps it "
+                                "up to date after that)")
+opt_parser.add_option("--elasticurl", "-e", action="store", type="string", dest="elastic_url", default=elastic_url,
+                      help="URL for the elasticsearch server (Default: {})".format(elastic_url))
+opt_parser.add_option("--days", "-d", action="store", type="int", dest="days", default=0,
+                      help="Days of history to roll up, 0 for all (Default: 0)")
+opt_parser.add_option("--batch", "-b", action="store", type="int", dest="batch", default=100000,
+                      help="History rows read between rollup writes (Default: 100000)")
+(options, args) = opt_parser.parse_args()
+elastic_url = options.elastic_url.split(',')
+
+history_index = open_index(elastic_url, index, doc_type=doc_type, connection_options=elastic_dict,
+                           index_settings=index_dict, index_mappings=mappings, rollover=rollover)
+rollup = DailyRollup(open_index(elastic_url, rollup_index, doc_type=rollup_doc_type, connection_options=elastic_dict,
+                                index_settings=rollup_index_dict, index_mappings=rollup_mappings, rollover=rollover))
+
+since = None
+if options.days:
+    since = utc.localize(datetime.datetime.utcnow()) - datetime.timedelta(days=options.days)
+
+# ticks of a day read in different batches are merged into the day's document
+rows = 0
+days = 0
+for h in history_index.search_terms({}, since=since, page_size=0, source=DailyRollup.fields[:4] +
+                                    ["Timestamp", "SpotPrice"]):
+    rollup.add(h.get("Region"), h.get("InstanceType"), h.get("ProductDescription"), h.get("AvailabilityZone"),
+               dateutil.parser.parse(h.get("Timestamp")), h.get("SpotPrice"))
+    rows += 1
+    if rows % options.batch == 0:
+        days += rollup.flush()
+        eprint("Rolled up {} rows".format(rows))
+
+days += rollup.flush()
+eprint("Rolled up {} rows, {} daily document writes".format(rows, days))
@@ -0,0 +1,42 @@
+from chalicelib import ConfigStage, BidSnapshot, open_index, eprint
+from optparse import OptionParser
+import os
+import json
+
+config = ConfigStage('chalicelib/collection.ini')
+
+elastic_dict = config.items("elastic", {})
+elastic_url = elastic_dict.pop("url", "localhost")
+
+instance_index_dict = config.items("instance_index", {})
+instance_index = instance_index_dict.pop("name", "instance_map")
+instance_doc_type = instance_index_dict.pop("doc_type", "instance")
+instance_mappings = json.loads(instance_index_dict.pop("mappings", "{}"))
+
+bid_index_dict = config.items("bid_index", {})
+bid_index = bid_index_dict.pop("name", "spot_bids")
+bid_doc_type = bid_index_dict.pop("doc_type", "bid")
+bid_mappings = json.loads(bid_index_dict.pop("mappings", "{}"))
+bid_index_dict.pop("artifacts", None)
+
+snapshot_file = os.path.join("chalicelib", config.get("snapshot", "file", "bid_snapshot.json.gz"))
+
+opt_parser = OptionParser(usage="usage: %prog [options]\n\n"
+                                "Builds the bid and instance snapshot the Chalice app serves bids from "
+                                "(run after training, before chalice deploy)")
+opt_parser.add_option("--elasticurl", "-e", action="store", type="string", dest="elastic_url", default=elastic_url,
+                      help="URL for the elasticsearch server (Default: {})".format(elastic_url))
+opt_parser.add_option("--outfile", "-o", action="store", type="string", dest="outfile", default=snapshot_file,
+                      help="Snapshot file name (Default: {})".format(snapshot_file))
+(options, args) = opt_parser.parse_args()
+elastic_url = options.elastic_url.split(',')
+
+instance_index = open_index(elastic_url, instance_index, doc_type=instance_doc_type, connection_options=elastic_dict,
+                            index_settings=instance_index_dict, index_mappings=instance_mappings, alias=True)
+bid_index = open_index(elastic_url, bid_index, doc_type=bid_doc_type, connection_options=elastic_dict,
+                       index_settings=bid_index_dict, index_mappings=bid_mappings)
+
+snapshot = BidSnapshot.build(bid_index, instance_index)
+snapshot.save(options.outfile)
+eprint("Snapshot of {} bids and {} instances written to {} ({} bytes)".format(
+    len(snapshot.bids), len(snapshot.instances), options.outfile, os.path.getsize(options.outfile)))
@@ -1,5 +1,5 @@
 from optparse import OptionParser
-from chalicelib import *
+from chalicelib import ConfigStage, open_index
 import dateutil
 from pprint import pformat
 import json
@@ -16,17 +16,18 @@ index_dict = config.items("history_index", {})
 index = index_dict.pop("name", "spot_price_history")
 doc_type = index_dict.pop("doc_type", "price")
 mappings = json.loads(index_dict.pop("mappings", "{}"))
+rollover = index_dict.pop("rollover", None)
 
 instance_index_dict = config.items("instance_index", {})
 instance_index = instance_index_dict.pop("name", "instance_map")
 instance_doc_type = instance_index_dict.pop("doc_type", "instance")
 instance_mappings = json.loads(instance_index_dict.pop("mappings", "{}"))
 
-instances_index = IndexData(elastic_url, instance_index, doc_type=instance_doc_type, connection_options=elastic_dict,
-                            index_settings=instance_index_dict, index_mappings=instance_mappings, alias=True)
+instances_index = open_index(elastic_url, instance_index, doc_type=instance_doc_type, connection_options=elastic_dict,
+                             index_settings=instance_index_dict, index_mappings=instance_mappings, alias=True)
 
-history_index = IndexData(elastic_url, index, doc_type=doc_type, connection_options=elastic_dict, index_settings=index_dict,
-                    index_mappings=mappings)
+history_index = open_index(elastic_url, index, doc_type=doc_type, connection_options=elastic_dict, index_settings=index_dict,
+                     index_mappings=mappings, rollover=rollover)
 
 
 opt_parser = OptionParser()
@@ -36,7 +37,8 @@ opt_parser.add_option("--os", "-o", action="store", type="string", dest="os", de
 opt_parser.add_option("--rows", "-n", action="store", type="int", dest="rows", default=1000, help="Number of rows")
 
 (options, args) = opt_parser.parse_args()
-history = history_index.search_terms({"Region": options.region, "InstanceType": options.instance, "ProductDescription": options.os})
+history = history_index.search_terms({"Region": options.region, "InstanceType": options.instance, "ProductDescription": options.os},
+                                     source=["Region", "InstanceType", "ProductDescription", "SpotPrice"])
 history_gen = (
     {
         "Region": r.get("Region").lower(),
@@ -47,4 +49,4 @@ history_gen = (
     } for r in history)
 
 for row in itertools.islice(history_gen, int(options.rows)):
-    print row
+    print(row)